@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+
+"""
+Throughput and latency benchmarks on synthetic data.
+
+    python -m ml.rl.benchmarks.run_benchmarks --baseline baseline.json
+
+compares the results against a stored baseline and exits with an error if
+any metric regressed by more than --tolerance.  Use --write-baseline to
+record a new baseline on the reference machine.
+"""
+
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from caffe2.python import core, workspace
+
+from ml.rl.benchmarks.synthetic_data import (
+    generate_ddpg_samples,
+    generate_dense_matrix,
+    generate_discrete_tdp,
+    generate_normalization,
+    generate_parametric_tdp,
+    generate_sparse_states,
+)
+from ml.rl.caffe_utils import C2
+from ml.rl.preprocessing.identify_types import CONTINUOUS, FEATURE_TYPES
+from ml.rl.preprocessing.preprocessor_net import PreprocessorNet
+from ml.rl.thrift.core.ttypes import (
+    ActionBudget,
+    ContinuousActionModelParameters,
+    DDPGModelParameters,
+    DDPGNetworkParameters,
+    DDPGTrainingParameters,
+    DiscreteActionModelParameters,
+    KnnParameters,
+    RLParameters,
+    TrainingParameters,
+)
+from ml.rl.training.continuous_action_dqn_trainer import ContinuousActionDQNTrainer
+from ml.rl.training.ddpg_trainer import DDPGTrainer
+from ml.rl.training.discrete_action_trainer import DiscreteActionTrainer
+from ml.rl.training.limited_discrete_action_trainer import \
+    LimitedActionDiscreteActionTrainer
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Metrics ending with these suffixes are better when higher / lower
+THROUGHPUT_SUFFIX = "_per_s"
+LATENCY_SUFFIX = "_ms"
+
+BenchmarkConfig = collections.namedtuple(
+    'BenchmarkConfig', [
+        'num_state_features',
+        'num_action_features',
+        'num_discrete_actions',
+        'num_possible_actions',
+        'features_per_row',
+        'minibatch_size',
+        'num_training_batches',
+        'preprocessing_rows',
+        'predictor_batch_sizes',
+        'predictor_iterations',
+    ]
+)
+
+DEFAULT_CONFIG = BenchmarkConfig(
+    num_state_features=2000,
+    num_action_features=50,
+    num_discrete_actions=100,
+    num_possible_actions=20,
+    features_per_row=50,
+    minibatch_size=1024,
+    num_training_batches=20,
+    preprocessing_rows=10000,
+    predictor_batch_sizes=[1, 16, 256, 1024],
+    predictor_iterations=50,
+)
+
+QUICK_CONFIG = DEFAULT_CONFIG._replace(
+    num_state_features=100,
+    num_action_features=10,
+    num_discrete_actions=10,
+    num_possible_actions=5,
+    features_per_row=10,
+    minibatch_size=128,
+    num_training_batches=3,
+    preprocessing_rows=1000,
+    predictor_batch_sizes=[1, 16],
+    predictor_iterations=5,
+)
+
+
+def _training_parameters(config):
+    return TrainingParameters(
+        layers=[-1, 256, 128, -1],
+        activations=['relu', 'relu', 'linear'],
+        minibatch_size=config.minibatch_size,
+        learning_rate=0.01,
+        optimizer='ADAM',
+    )
+
+
+def _rl_parameters():
+    return RLParameters(
+        gamma=0.9,
+        target_update_rate=0.5,
+        reward_burnin=1,
+        maxq_learning=True,
+    )
+
+
+def _time_training(train_fn, batch_size, num_batches) -> float:
+    # The first batch creates optimizer state, don't count it
+    train_fn()
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        train_fn()
+    return num_batches * batch_size / (time.perf_counter() - start)
+
+
+def _time_predictor(predict_fn, states, config, prefix, results) -> None:
+    for batch_size in config.predictor_batch_sizes:
+        batch = states[:batch_size]
+        predict_fn(batch)
+        latencies = []
+        for _ in range(config.predictor_iterations):
+            start = time.perf_counter()
+            predict_fn(batch)
+            latencies.append((time.perf_counter() - start) * 1000)
+        for percentile in [50, 99]:
+            results["{}_batch_{}_p{}{}".format(
+                prefix, batch_size, percentile, LATENCY_SUFFIX
+            )] = float(np.percentile(latencies, percentile))
+
+
+def benchmark_preprocessing(config: BenchmarkConfig) -> Dict[str, float]:
+    results = {}
+    normalization = generate_normalization(config.num_state_features)
+    for feature_type in FEATURE_TYPES:
+        type_normalization = collections.OrderedDict(
+            (k, v) for k, v in normalization.items()
+            if v.feature_type == feature_type
+        )
+        if len(type_normalization) == 0:
+            continue
+        features, matrix = generate_dense_matrix(
+            type_normalization, config.preprocessing_rows
+        )
+        for fused in [True, False]:
+            name = feature_type.lower() + ("_fused" if fused else "")
+            net = core.Net("benchmark_preprocessing_" + name)
+            C2.set_net(net)
+            preprocessor = PreprocessorNet(net, True, fused=fused)
+            input_blob = net.NextBlob("benchmark_input")
+            workspace.FeedBlob(input_blob, matrix)
+            preprocessor.normalize_dense_matrix(
+                input_blob, features, type_normalization, "benchmark"
+            )
+            workspace.CreateNet(net)
+            workspace.RunNet(net)
+            num_runs = 5
+            start = time.perf_counter()
+            for _ in range(num_runs):
+                workspace.RunNet(net)
+            elapsed = time.perf_counter() - start
+            results["preprocessing_{}_rows{}".format(
+                name, THROUGHPUT_SUFFIX
+            )] = num_runs * config.preprocessing_rows / elapsed
+            C2.set_net(None)
+    return results
+
+
+def _benchmark_discrete_trainer(
+    config: BenchmarkConfig, trainer_class, name: str, **parameters
+) -> Dict[str, float]:
+    results = {}
+    normalization = generate_normalization(config.num_state_features)
+    actions = [str(i) for i in range(config.num_discrete_actions)]
+    trainer = trainer_class(
+        DiscreteActionModelParameters(
+            actions=actions,
+            rl=_rl_parameters(),
+            training=_training_parameters(config),
+            **parameters
+        ),
+        normalization,
+    )
+    tdp = generate_discrete_tdp(
+        normalization, config.num_discrete_actions, config.minibatch_size
+    )
+    results["train_{}_samples{}".format(name, THROUGHPUT_SUFFIX)] = \
+        _time_training(
+            lambda: trainer.train_numpy(tdp, None), tdp.size(),
+            config.num_training_batches
+        )
+
+    predictor = trainer.predictor()
+    states = generate_sparse_states(
+        normalization, max(config.predictor_batch_sizes),
+        config.features_per_row
+    )
+    _time_predictor(
+        predictor.predict, states, config, "predict_" + name, results
+    )
+    return results
+
+
+def benchmark_discrete(config: BenchmarkConfig) -> Dict[str, float]:
+    return _benchmark_discrete_trainer(
+        config, DiscreteActionTrainer, "discrete"
+    )
+
+
+def benchmark_limited_discrete(config: BenchmarkConfig) -> Dict[str, float]:
+    return _benchmark_discrete_trainer(
+        config,
+        LimitedActionDiscreteActionTrainer,
+        "limited_discrete",
+        action_budget=ActionBudget(limited_action="0", action_limit=10.0),
+    )
+
+
+def benchmark_parametric(config: BenchmarkConfig) -> Dict[str, float]:
+    results = {}
+    state_normalization = generate_normalization(config.num_state_features)
+    action_normalization = generate_normalization(
+        config.num_action_features,
+        first_feature_id=config.num_state_features,
+        seed=1,
+    )
+    trainer = ContinuousActionDQNTrainer(
+        ContinuousActionModelParameters(
+            rl=_rl_parameters(),
+            training=_training_parameters(config),
+            knn=KnnParameters(model_type='DQN'),
+        ),
+        state_normalization,
+        action_normalization,
+    )
+    tdp = generate_parametric_tdp(
+        state_normalization, action_normalization,
+        config.num_possible_actions, config.minibatch_size
+    )
+    results["train_parametric_samples" + THROUGHPUT_SUFFIX] = _time_training(
+        lambda: trainer.train_numpy(tdp, None), tdp.size(),
+        config.num_training_batches
+    )
+
+    predictor = trainer.predictor()
+    num_rows = max(config.predictor_batch_sizes)
+    states = generate_sparse_states(
+        state_normalization, num_rows, config.features_per_row
+    )
+    actions = generate_sparse_states(
+        action_normalization, num_rows, config.features_per_row, seed=1
+    )
+    examples = list(zip(states, actions))
+
+    def predict(batch):
+        batch_states, batch_actions = zip(*batch)
+        return predictor.predict(list(batch_states), None, list(batch_actions))
+
+    _time_predictor(predict, examples, config, "predict_parametric", results)
+    return results
+
+
+def benchmark_ddpg(config: BenchmarkConfig) -> Dict[str, float]:
+    results = {}
+    # The exported actor takes one input column per state feature
+    state_normalization = generate_normalization(
+        config.num_state_features, type_mix={CONTINUOUS: 1.0}
+    )
+    action_normalization = generate_normalization(
+        config.num_action_features,
+        type_mix={CONTINUOUS: 1.0},
+        first_feature_id=config.num_state_features,
+        seed=1,
+    )
+    trainer = DDPGTrainer(
+        DDPGModelParameters(
+            rl=_rl_parameters(),
+            shared_training=DDPGTrainingParameters(
+                minibatch_size=config.minibatch_size
+            ),
+            actor_training=DDPGNetworkParameters(
+                layers=[-1, 256, 128, -1],
+                activations=['relu', 'relu', 'tanh'],
+            ),
+            critic_training=DDPGNetworkParameters(
+                layers=[-1, 256, 128, -1],
+                activations=['relu', 'relu', 'linear'],
+            ),
+        ),
+        {
+            "state_dim": config.num_state_features,
+            "action_dim": config.num_action_features,
+            "action_range": None,
+        },
+        state_normalization,
+        action_normalization,
+    )
+    samples = generate_ddpg_samples(
+        config.num_state_features, config.num_action_features,
+        config.minibatch_size
+    )
+    results["train_ddpg_samples" + THROUGHPUT_SUFFIX] = _time_training(
+        lambda: trainer.train(samples), config.minibatch_size,
+        config.num_training_batches
+    )
+
+    predictor = trainer.predictor(actor=True)
+    states = generate_sparse_states(
+        state_normalization, max(config.predictor_batch_sizes),
+        config.features_per_row
+    )
+    _time_predictor(
+        predictor.actor_prediction, states, config, "predict_ddpg_actor",
+        results
+    )
+    return results
+
+
+def run_benchmarks(config: BenchmarkConfig) -> Dict[str, float]:
+    results: Dict[str, float] = {}
+    for benchmark in [
+        benchmark_preprocessing,
+        benchmark_discrete,
+        benchmark_limited_discrete,
+        benchmark_parametric,
+        benchmark_ddpg,
+    ]:
+        workspace.ResetWorkspace()
+        results.update(benchmark(config))
+    return results
+
+
+def compare_to_baseline(
+    results: Dict[str, float],
+    baseline: Dict[str, float],
+    tolerance: float,
+) -> List[str]:
+    """
+    Returns a description of every metric that is worse than its baseline by
+    more than `tolerance` (a fraction).  Metrics missing on either side are
+    ignored.
+    """
+    regressions = []
+    for metric, baseline_value in sorted(baseline.items()):
+        if metric not in results:
+            continue
+        value = results[metric]
+        if metric.endswith(THROUGHPUT_SUFFIX):
+            regressed = value < baseline_value * (1 - tolerance)
+        elif metric.endswith(LATENCY_SUFFIX):
+            regressed = value > baseline_value * (1 + tolerance)
+        else:
+            continue
+        if regressed:
+            regressions.append(
+                "{}: {:.4g} (baseline {:.4g})".format(
+                    metric, value, baseline_value
+                )
+            )
+    return regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="Benchmark training, preprocessing and serving throughput."
+    )
+    parser.add_argument(
+        "-b", "--baseline", help="Path to the baseline JSON file.", default=None
+    )
+    parser.add_argument(
+        "--write-baseline",
+        help="Write the results to the baseline path instead of comparing.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        help="Allowed relative regression before failing.",
+        type=float,
+        default=0.1,
+    )
+    parser.add_argument(
+        "-o", "--output", help="Path to write the results JSON.", default=None
+    )
+    parser.add_argument(
+        "-q",
+        "--quick",
+        help="Use small sizes, e.g. to check that the suite runs.",
+        action="store_true",
+    )
+    args = parser.parse_args(args)
+
+    results = run_benchmarks(QUICK_CONFIG if args.quick else DEFAULT_CONFIG)
+    results_json = json.dumps(results, indent=2, sort_keys=True)
+    print(results_json)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(results_json)
+
+    if args.baseline is None:
+        return 0
+    if args.write_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(results_json)
+        return 0
+    if not os.path.exists(args.baseline):
+        logger.warning("No baseline at {}".format(args.baseline))
+        return 0
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
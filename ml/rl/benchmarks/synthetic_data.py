@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import collections
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from ml.rl.caffe_utils import StackedArray
+from ml.rl.preprocessing.identify_types import BINARY, PROBABILITY, \
+    CONTINUOUS, BOXCOX, ENUM, QUANTILE, FEATURE_TYPES
+from ml.rl.preprocessing.normalization import NormalizationParameters, \
+    get_num_output_features
+from ml.rl.training.training_data_page import TrainingDataPage
+
+# Fraction of features of each type in a synthetic state
+DEFAULT_TYPE_MIX = collections.OrderedDict(
+    [
+        (BINARY, 0.2),
+        (PROBABILITY, 0.1),
+        (CONTINUOUS, 0.3),
+        (BOXCOX, 0.1),
+        (ENUM, 0.1),
+        (QUANTILE, 0.2),
+    ]
+)
+
+
+def generate_normalization(
+    num_features: int,
+    type_mix: Dict[str, float] = DEFAULT_TYPE_MIX,
+    num_enum_values: int = 10,
+    num_quantiles: int = 20,
+    first_feature_id: int = 0,
+    seed: int = 0,
+) -> Dict[int, NormalizationParameters]:
+    """
+    Builds normalization parameters for `num_features` features whose types
+    follow `type_mix`, without having to fit them on data.
+    """
+    rng = np.random.RandomState(seed)
+    feature_types = rng.choice(
+        list(type_mix.keys()),
+        size=num_features,
+        p=np.array(list(type_mix.values())) / sum(type_mix.values()),
+    )
+    normalization = collections.OrderedDict()
+    for i, feature_type in enumerate(feature_types):
+        normalization[first_feature_id + i] = _normalization_for_type(
+            feature_type, num_enum_values, num_quantiles, rng
+        )
+    return normalization
+
+
+def _normalization_for_type(feature_type, num_enum_values, num_quantiles, rng):
+    boxcox_lambda = None
+    boxcox_shift = None
+    mean = 0.0
+    stddev = 1.0
+    possible_values = None
+    quantiles = None
+    if feature_type == BOXCOX:
+        boxcox_lambda = float(rng.uniform(0.1, 0.5))
+        boxcox_shift = 0.0
+    elif feature_type == CONTINUOUS:
+        mean = float(rng.normal())
+        stddev = float(rng.uniform(0.5, 2.0))
+    elif feature_type == ENUM:
+        possible_values = list(range(num_enum_values))
+    elif feature_type == QUANTILE:
+        quantiles = np.sort(rng.normal(size=num_quantiles)).tolist()
+    return NormalizationParameters(
+        feature_type=str(feature_type),
+        boxcox_lambda=boxcox_lambda,
+        boxcox_shift=boxcox_shift,
+        mean=mean,
+        stddev=stddev,
+        possible_values=possible_values,
+        quantiles=quantiles,
+    )
+
+
+def _sample_values(parameters, size, rng):
+    feature_type = parameters.feature_type
+    if feature_type == BINARY:
+        return rng.randint(0, 2, size=size).astype(np.float32)
+    if feature_type == PROBABILITY:
+        return rng.uniform(0.0, 1.0, size=size).astype(np.float32)
+    if feature_type == BOXCOX:
+        return rng.exponential(size=size).astype(np.float32)
+    if feature_type == ENUM:
+        return rng.choice(parameters.possible_values, size=size) \
+            .astype(np.float32)
+    return rng.normal(size=size).astype(np.float32)
+
+
+def generate_dense_matrix(
+    normalization: Dict[int, NormalizationParameters],
+    num_rows: int,
+    seed: int = 0,
+) -> Tuple[List[int], np.ndarray]:
+    """
+    Returns the features sorted by type (the order PreprocessorNet expects)
+    and a (num_rows, num_features) matrix of raw values.
+    """
+    rng = np.random.RandomState(seed)
+    features = [
+        feature for feature_type in FEATURE_TYPES
+        for feature, parameters in normalization.items()
+        if parameters.feature_type == feature_type
+    ]
+    matrix = np.zeros([num_rows, len(features)], dtype=np.float32)
+    for i, feature in enumerate(features):
+        matrix[:, i] = _sample_values(normalization[feature], num_rows, rng)
+    return features, matrix
+
+
+def generate_sparse_states(
+    normalization: Dict[int, NormalizationParameters],
+    num_rows: int,
+    features_per_row: int,
+    seed: int = 0,
+) -> List[Dict[int, float]]:
+    """
+    Returns `num_rows` examples that each set `features_per_row` randomly
+    chosen features, as the predictors expect them.
+    """
+    rng = np.random.RandomState(seed)
+    feature_ids = list(normalization.keys())
+    features_per_row = min(features_per_row, len(feature_ids))
+    states = []
+    for _ in range(num_rows):
+        row = {}
+        for feature in rng.choice(
+            feature_ids, size=features_per_row, replace=False
+        ):
+            row[int(feature)] = float(
+                _sample_values(normalization[feature], 1, rng)[0]
+            )
+        states.append(row)
+    return states
+
+
+def _reward_timelines(rewards):
+    return np.array([{0: float(r)} for r in rewards[:, 0]], dtype=np.object)
+
+
+def generate_discrete_tdp(
+    state_normalization: Dict[int, NormalizationParameters],
+    num_actions: int,
+    num_rows: int,
+    seed: int = 0,
+) -> TrainingDataPage:
+    """
+    A page of already-normalized transitions for DiscreteActionTrainer.
+    """
+    rng = np.random.RandomState(seed)
+    state_dim = get_num_output_features(state_normalization)
+    actions = np.zeros([num_rows, num_actions], dtype=np.float32)
+    actions[np.arange(num_rows), rng.randint(0, num_actions, num_rows)] = 1
+    next_actions = np.zeros([num_rows, num_actions], dtype=np.float32)
+    next_actions[np.arange(num_rows), rng.randint(0, num_actions, num_rows)] = 1
+    rewards = rng.normal(size=[num_rows, 1]).astype(np.float32)
+    return TrainingDataPage(
+        states=rng.normal(size=[num_rows, state_dim]).astype(np.float32),
+        actions=actions,
+        rewards=rewards,
+        next_states=rng.normal(size=[num_rows, state_dim]).astype(np.float32),
+        next_actions=next_actions,
+        possible_next_actions=(
+            rng.uniform(size=[num_rows, num_actions]) > 0.2
+        ).astype(np.float32),
+        reward_timelines=_reward_timelines(rewards),
+        not_terminals=np.ones([num_rows, 1], dtype=np.bool),
+    )
+
+
+def generate_parametric_tdp(
+    state_normalization: Dict[int, NormalizationParameters],
+    action_normalization: Dict[int, NormalizationParameters],
+    num_possible_actions: int,
+    num_rows: int,
+    seed: int = 0,
+) -> TrainingDataPage:
+    """
+    A page of already-normalized transitions for ContinuousActionDQNTrainer,
+    with `num_possible_actions` candidate actions per next state.
+    """
+    rng = np.random.RandomState(seed)
+    state_dim = get_num_output_features(state_normalization)
+    action_dim = get_num_output_features(action_normalization)
+    rewards = rng.normal(size=[num_rows, 1]).astype(np.float32)
+    pna_lengths = np.full([num_rows], num_possible_actions, dtype=np.int32)
+    pna_values = rng.normal(
+        size=[num_rows * num_possible_actions, action_dim]
+    ).astype(np.float32)
+    return TrainingDataPage(
+        states=rng.normal(size=[num_rows, state_dim]).astype(np.float32),
+        actions=rng.normal(size=[num_rows, action_dim]).astype(np.float32),
+        rewards=rewards,
+        next_states=rng.normal(size=[num_rows, state_dim]).astype(np.float32),
+        next_actions=rng.normal(size=[num_rows, action_dim]).astype(np.float32),
+        possible_next_actions=StackedArray(pna_lengths, pna_values),
+        reward_timelines=_reward_timelines(rewards),
+        not_terminals=np.ones([num_rows, 1], dtype=np.bool),
+    )
+
+
+def generate_ddpg_samples(
+    state_dim: int,
+    action_dim: int,
+    num_rows: int,
+    seed: int = 0,
+) -> List[np.ndarray]:
+    """
+    Already-normalized transitions in the column layout `DDPGTrainer.train`
+    takes: states, actions, rewards, next states, next actions, terminals,
+    possible next actions, their lengths and time diffs.
+    """
+    rng = np.random.RandomState(seed)
+    return [
+        rng.normal(size=[num_rows, state_dim]).astype(np.float32),
+        rng.uniform(-1, 1, size=[num_rows, action_dim]).astype(np.float32),
+        rng.normal(size=[num_rows]).astype(np.float32),
+        rng.normal(size=[num_rows, state_dim]).astype(np.float32),
+        rng.uniform(-1, 1, size=[num_rows, action_dim]).astype(np.float32),
+        np.zeros([num_rows], dtype=np.bool),
+        np.zeros([num_rows, 0], dtype=np.float32),
+        np.zeros([num_rows], dtype=np.int32),
+        np.ones([num_rows], dtype=np.float32),
+    ]
@@ -26,11 +26,14 @@ def fc_explicit_param_names(
     :dim_out: Number of nodes in output layer
     :weight_name: Name of blob corresponding to an initialized weight parameter
     :bias_name: Name of blob corresponding to an initialized bias parameter
+    :transposed: If True, the weight parameter is stored as (dim_in, dim_out)
+        and the layer is computed with FCTransposed
     """
     required_kwargs = ['dim_in', 'dim_out', 'weight_name', 'bias_name']
     for arg in required_kwargs:
         assert arg in kwargs, "Please supply kwarg {}".format(arg)
     dim_in, dim_out = kwargs['dim_in'], kwargs['dim_out']
+    transposed = kwargs.get('transposed', False)
 
     WeightInitializer = initializers.update_initializer(
         None, weight_init, ("XavierFill", {})
@@ -41,7 +44,7 @@ def fc_explicit_param_names(
 
     weight = model.create_param(
         param_name=kwargs['weight_name'],
-        shape=[dim_out, dim_in],
+        shape=[dim_in, dim_out] if transposed else [dim_out, dim_in],
         initializer=WeightInitializer,
         tags=ParameterTags.WEIGHT
     )
@@ -54,4 +57,6 @@ def fc_explicit_param_names(
         tags=[ParameterTags.BIAS]
     )
 
+    if transposed:
+        return model.net.FCTransposed([blob_in, weight, bias], blob_out)
     return model.net.FC([blob_in, weight, bias], blob_out)
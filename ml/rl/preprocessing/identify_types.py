@@ -16,36 +16,61 @@ COLUMN_DELIM = ';'
 DEFAULT_MAX_UNIQUE_ENUM = 1000
 
 
-def _is_probability(feature_values):
-    return np.all(0 <= feature_values) and np.all(feature_values <= 1)
+def _has_few_unique_values(columns, threshold):
+    """
+    Whether each column of integer values has at most `threshold` distinct
+    values.  Only columns whose range could exceed the threshold are sorted.
+    """
+    result = np.zeros(columns.shape[1], dtype=np.bool)
+    if columns.shape[0] == 0:
+        return result
+    small_range = (np.max(columns, axis=0) - np.min(columns, axis=0)) < \
+        threshold
+    result[small_range] = True
+    to_sort = np.where(~small_range)[0]
+    if len(to_sort) > 0:
+        sorted_columns = np.sort(columns[:, to_sort], axis=0)
+        num_unique = 1 + np.count_nonzero(
+            np.diff(sorted_columns, axis=0), axis=0
+        )
+        result[to_sort] = num_unique <= threshold
+    return result
 
 
-def _is_binary(feature_values):
-    return np.all(np.logical_or(feature_values == 0, feature_values == 1)) \
-        or np.min(feature_values) == np.max(feature_values)
-
-
-def _is_continuous(feature_values):
-    return True
-
-
-def _is_enum(feature_values, enum_threshold):
-    are_all_ints = np.vectorize(lambda val: float(val).is_integer())
-    return (
-        np.min(feature_values) >= 0 and  # All values must be positive
-        len(np.unique(feature_values)) <= enum_threshold
-        and np.all(are_all_ints(feature_values))
+def identify_types_matrix(X, enum_threshold=DEFAULT_MAX_UNIQUE_ENUM):
+    """
+    Returns the type of every column of the 2D array `X`, using a few
+    whole-matrix passes instead of one Python call per value.
+    """
+    X = np.asarray(X)
+    mins = np.min(X, axis=0)
+    maxs = np.max(X, axis=0)
+    zero_or_one = np.all(np.logical_or(X == 0, X == 1), axis=0)
+    binary = np.logical_or(zero_or_one, mins == maxs)
+    probability = np.logical_and(0 <= mins, maxs <= 1)
+    enum_candidates = np.where(
+        ~binary & ~probability & (mins >= 0) &
+        np.all(np.modf(X)[0] == 0, axis=0)
+    )[0]
+    enum = np.zeros(X.shape[1], dtype=np.bool)
+    enum[enum_candidates] = _has_few_unique_values(
+        X[:, enum_candidates], enum_threshold
     )
 
+    types = []
+    for i in range(X.shape[1]):
+        if binary[i]:
+            types.append(BINARY)
+        elif probability[i]:
+            types.append(PROBABILITY)
+        elif enum[i]:
+            types.append(ENUM)
+        else:
+            types.append(CONTINUOUS)
+    return types
+
 
 def identify_type(values, enum_threshold=DEFAULT_MAX_UNIQUE_ENUM):
-    if _is_binary(values):
-        return BINARY
-    elif _is_probability(values):
-        return PROBABILITY
-    elif _is_enum(values, enum_threshold):
-        return ENUM
-    elif _is_continuous(values):
-        return CONTINUOUS
-    else:
-        assert False
+    return identify_types_matrix(
+        np.asarray(values).reshape(-1, 1), enum_threshold
+    )[0]
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from multiprocessing import Pool, cpu_count
 from scipy import stats
 from scipy.stats.mstats import mquantiles
 import json
 import numpy as np
+import os
 import six
+import tempfile
 
 import logging
 logger = logging.getLogger(__name__)
@@ -146,16 +149,101 @@ def identify_parameter(
     )
 
 
-def get_num_output_features(normalization_parmeters):
-    return sum(
-        map(
-            lambda np: (
-                len(np.possible_values) if np.feature_type == identify_types.ENUM
-                else 1
-            ),
-            normalization_parmeters.values()
+def _identify_parameter_from_memmap(args):
+    path, dtype, size, start, end, kwargs = args
+    values = np.memmap(path, dtype=dtype, mode='r', shape=(size, ))
+    return identify_parameter(np.asarray(values[start:end]), **kwargs)
+
+
+def identify_parameters(matrix_or_columns, features=None, n_jobs=1, **kwargs):
+    """
+    Calls identify_parameter on every feature.  `matrix_or_columns` is either
+    a dict of feature -> values or a (rows, features) matrix whose columns are
+    named by `features`.  With `n_jobs` > 1 (-1 for one per CPU) the features
+    are fitted in worker processes that read the columns from a temporary
+    memory-mapped file instead of receiving pickled copies.  Extra arguments
+    are passed to identify_parameter.
+
+    Returns an OrderedDict of feature -> NormalizationParameters in input
+    order, ready for `serialize`.
+    """
+    if isinstance(matrix_or_columns, dict):
+        features = list(matrix_or_columns.keys())
+        columns = [np.asarray(matrix_or_columns[f]) for f in features]
+    else:
+        matrix = np.asarray(matrix_or_columns)
+        if features is None:
+            features = list(range(matrix.shape[1]))
+        assert len(features) == matrix.shape[1], \
+            "Expected a name for each of the {} columns".format(matrix.shape[1])
+        columns = [matrix[:, i] for i in range(matrix.shape[1])]
+
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    n_jobs = min(n_jobs, len(features))
+    if n_jobs <= 1:
+        return OrderedDict(
+            (feature, identify_parameter(values, **kwargs))
+            for feature, values in zip(features, columns)
         )
-    )
+
+    dtype = np.result_type(*columns)
+    offsets = np.cumsum([0] + [len(values) for values in columns])
+    with tempfile.TemporaryDirectory() as temp_directory_name:
+        path = os.path.join(temp_directory_name, 'columns.bin')
+        shared = np.memmap(path, dtype=dtype, mode='w+', shape=(offsets[-1], ))
+        for i, values in enumerate(columns):
+            shared[offsets[i]:offsets[i + 1]] = values
+        shared.flush()
+        del shared
+
+        tasks = [
+            (path, dtype, offsets[-1], offsets[i], offsets[i + 1], kwargs)
+            for i in range(len(columns))
+        ]
+        with Pool(n_jobs) as pool:
+            parameters = pool.map(
+                _identify_parameter_from_memmap, tasks, chunksize=1
+            )
+    return OrderedDict(zip(features, parameters))
+
+
+def get_num_output_features(
+    normalization_parmeters, enum_embedding_dim=None
+):
+    """
+    Returns the width of the first layer's input.  ENUM features take one
+    column per possible value, or `enum_embedding_dim` columns when they are
+    looked up in an embedding table instead.
+    """
+    def num_columns(np):
+        if np.feature_type != identify_types.ENUM:
+            return 1
+        if enum_embedding_dim is not None:
+            return enum_embedding_dim
+        return len(np.possible_values)
+
+    return sum(map(num_columns, normalization_parmeters.values()))
+
+
+def get_enum_embedding_layout(normalization_parameters):
+    """
+    Returns the column where the block of ENUM ids starts in a matrix
+    preprocessed with `embed_enums`, and the number of embedding rows for
+    each ENUM feature (one per possible value plus one for missing/unknown).
+    """
+    enum_type_index = identify_types.FEATURE_TYPES.index(identify_types.ENUM)
+    start_index = 0
+    num_ids = []
+    for parameters in normalization_parameters.values():
+        feature_type_index = identify_types.FEATURE_TYPES.index(
+            parameters.feature_type
+        )
+        if feature_type_index < enum_type_index:
+            start_index += 1
+        elif feature_type_index == enum_type_index:
+            num_ids.append(len(set(parameters.possible_values)) + 1)
+    return start_index, num_ids
 
 
 def deserialize(parameters_json):
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+"""
+A compact columnar binary format for normalization parameters.
+
+`normalization.serialize` stores one JSON string per feature, which is slow to
+parse when there are thousands of features.  This format stores each field as
+one aligned array (type codes, Box-Cox parameters, means, stddevs) and the
+variable-length quantiles and possible values as concatenated arrays with
+offsets, so a reader can map the file and decode features on demand.
+"""
+
+import collections
+import collections.abc
+import hashlib
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from ml.rl.preprocessing import identify_types
+from ml.rl.preprocessing.normalization import NormalizationParameters, \
+    deserialize, serialize
+
+MAGIC = b'RLNORM\x00\x00'
+VERSION = 1
+ALIGNMENT = 64
+
+# magic, version, number of features, whether the keys are strings
+_HEADER = struct.Struct('<8sIIII')
+_SECTION = struct.Struct('<QQ')
+
+# Bits of the per-feature flags marking fields that are None
+_NONE_FIELDS = [
+    'boxcox_lambda', 'boxcox_shift', 'mean', 'stddev', 'possible_values',
+    'quantiles'
+]
+
+# (name, dtype) of each section, in file order
+_SECTIONS = [
+    ('keys', np.int64),  # uint8 utf-8 bytes when the keys are strings
+    ('key_offsets', np.int64),
+    ('type_codes', np.int8),
+    ('none_flags', np.uint8),
+    ('boxcox_lambda', np.float64),
+    ('boxcox_shift', np.float64),
+    ('mean', np.float64),
+    ('stddev', np.float64),
+    ('possible_value_offsets', np.int64),
+    ('possible_values', np.int64),
+    ('quantile_offsets', np.int64),
+    ('quantiles', np.float64),
+]
+
+
+def _offsets(lists):
+    return np.cumsum([0] + [len(l) if l is not None else 0 for l in lists])
+
+
+def to_bytes(parameters):
+    """
+    Encodes a dict of feature -> NormalizationParameters.  Keys must be all
+    ints or all strings.
+    """
+    features = list(parameters.keys())
+    values = [parameters[f] for f in features]
+    string_keys = any(isinstance(f, str) for f in features)
+
+    arrays = {}
+    if string_keys:
+        encoded = [str(f).encode('utf-8') for f in features]
+        arrays['keys'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        arrays['key_offsets'] = _offsets(encoded)
+    else:
+        arrays['keys'] = np.array(features, dtype=np.int64)
+        arrays['key_offsets'] = np.zeros(0, dtype=np.int64)
+    arrays['type_codes'] = np.array(
+        [identify_types.FEATURE_TYPES.index(p.feature_type) for p in values],
+        dtype=np.int8
+    )
+    none_flags = np.zeros(len(values), dtype=np.uint8)
+    for bit, field in enumerate(_NONE_FIELDS):
+        for i, p in enumerate(values):
+            if getattr(p, field) is None:
+                none_flags[i] |= 1 << bit
+    arrays['none_flags'] = none_flags
+    for field in ['boxcox_lambda', 'boxcox_shift', 'mean', 'stddev']:
+        arrays[field] = np.array(
+            [
+                getattr(p, field) if getattr(p, field) is not None else np.nan
+                for p in values
+            ],
+            dtype=np.float64
+        )
+    for field, offsets_name in [
+        ('possible_values', 'possible_value_offsets'),
+        ('quantiles', 'quantile_offsets'),
+    ]:
+        lists = [getattr(p, field) for p in values]
+        arrays[offsets_name] = _offsets(lists)
+        arrays[field] = [v for l in lists if l is not None for v in l]
+    # ENUM values are stored as int64, so anything else would be truncated
+    for v in arrays['possible_values']:
+        if v != int(v):
+            raise Exception(
+                "ENUM possible value {} is not an integer".format(v)
+            )
+
+    header_size = _HEADER.size + _SECTION.size * len(_SECTIONS)
+    position = header_size
+    sections = []
+    payload = []
+    for name, dtype in _SECTIONS:
+        if name == 'keys' and string_keys:
+            dtype = np.uint8
+        data = np.ascontiguousarray(arrays[name], dtype=dtype).tobytes()
+        padding = -position % ALIGNMENT
+        payload.append(b'\x00' * padding)
+        position += padding
+        sections.append(_SECTION.pack(position, len(data)))
+        payload.append(data)
+        position += len(data)
+
+    header = _HEADER.pack(
+        MAGIC, VERSION, len(features), int(string_keys), 0
+    ) + b''.join(sections)
+    return header + b''.join(payload)
+
+
+def write(parameters, path):
+    with open(path, 'wb') as f:
+        f.write(to_bytes(parameters))
+
+
+class MappedNormalizationParameters(collections.abc.Mapping):
+    """
+    Read-only dict of feature -> NormalizationParameters over an encoded
+    buffer.  The per-field arrays are views into the buffer; features are
+    decoded when they are accessed.
+    """
+
+    def __init__(self, buffer) -> None:
+        self._buffer = buffer
+        magic, version, num_features, string_keys, _ = _HEADER.unpack_from(
+            buffer, 0
+        )
+        if magic != MAGIC:
+            raise Exception("Not a normalization parameters file")
+        if version != VERSION:
+            raise Exception(
+                "Unsupported normalization format version {}".format(version)
+            )
+        self._num_features = num_features
+        self._arrays = {}
+        for i, (name, dtype) in enumerate(_SECTIONS):
+            offset, nbytes = _SECTION.unpack_from(
+                buffer, _HEADER.size + i * _SECTION.size
+            )
+            if name == 'keys' and string_keys:
+                dtype = np.uint8
+            self._arrays[name] = np.frombuffer(
+                buffer,
+                dtype=dtype,
+                count=nbytes // np.dtype(dtype).itemsize,
+                offset=offset
+            )
+
+        if string_keys:
+            keys = self._arrays['keys'].tobytes()
+            offsets = self._arrays['key_offsets']
+            self._keys = [
+                keys[offsets[i]:offsets[i + 1]].decode('utf-8')
+                for i in range(num_features)
+            ]
+        else:
+            self._keys = self._arrays['keys'].tolist()
+        self._index = {key: i for i, key in enumerate(self._keys)}
+
+    @classmethod
+    def open(cls, path):
+        """
+        Maps the file at `path` read-only instead of reading it in.
+        """
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def array(self, name):
+        """
+        The raw array for one field, e.g. 'mean' or 'type_codes'.
+        """
+        return self._arrays[name]
+
+    def __getitem__(self, feature):
+        i = self._index[feature]
+        arrays = self._arrays
+        none_flags = int(arrays['none_flags'][i])
+
+        def field(name):
+            if none_flags & (1 << _NONE_FIELDS.index(name)):
+                return None
+            return float(arrays[name][i])
+
+        def values(name, offsets_name):
+            if none_flags & (1 << _NONE_FIELDS.index(name)):
+                return None
+            offsets = arrays[offsets_name]
+            return arrays[name][offsets[i]:offsets[i + 1]].tolist()
+
+        return NormalizationParameters(
+            feature_type=identify_types.FEATURE_TYPES[arrays['type_codes'][i]],
+            boxcox_lambda=field('boxcox_lambda'),
+            boxcox_shift=field('boxcox_shift'),
+            mean=field('mean'),
+            stddev=field('stddev'),
+            possible_values=values('possible_values', 'possible_value_offsets'),
+            quantiles=values('quantiles', 'quantile_offsets'),
+        )
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return self._num_features
+
+    def to_dict(self):
+        return collections.OrderedDict((k, self[k]) for k in self._keys)
+
+
+def json_to_bytes(parameters_json):
+    """
+    Converts the output of `normalization.serialize` to the binary format.
+    """
+    return to_bytes(deserialize(parameters_json))
+
+
+def bytes_to_json(data):
+    """
+    Converts the binary format back to the `normalization.serialize` format.
+    """
+    return serialize(MappedNormalizationParameters(data).to_dict())
+
+
+# File identity (path, inode, size, mtime) -> parameters, and content hash ->
+#     parameters
+_cache = {}
+_content_cache = {}
+
+
+def load(path):
+    """
+    Maps the binary file at `path` (see `MappedNormalizationParameters.open`),
+    reusing an earlier result in this process if the same file, or a file
+    with the same content, was loaded.  The file is only hashed when its
+    path, size or modification time are new, and hashing reads the mapped
+    pages without copying or decoding them.  The returned mapping is shared.
+    """
+    stat = os.stat(path)
+    key = (
+        os.path.realpath(path), stat.st_ino, stat.st_size, stat.st_mtime_ns
+    )
+    if key not in _cache:
+        parameters = MappedNormalizationParameters.open(path)
+        content_key = hashlib.sha256(parameters._buffer).hexdigest()
+        _cache[key] = _content_cache.setdefault(content_key, parameters)
+    return _cache[key]
+
+
+def clear_cache():
+    _cache.clear()
+    _content_cache.clear()
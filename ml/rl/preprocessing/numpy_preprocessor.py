@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+from typing import Dict, List
+
+import numpy as np
+
+from ml.rl.preprocessing import identify_types
+from ml.rl.preprocessing.identify_types import FEATURE_TYPES
+from ml.rl.preprocessing.normalization import NormalizationParameters, \
+    MISSING_VALUE
+
+# Lower bound BatchBoxCox applies to the shifted input
+BOX_COX_EPSILON = 1e-6
+
+
+class NumpyPreprocessor(object):
+    """
+    Applies the same transforms as PreprocessorNet with vectorized NumPy
+    operations, so offline pipelines can normalize data without building and
+    running a net.
+
+    Inputs are dense float32 matrices whose columns follow `sorted_features`
+    (features grouped by type, like PreprocessorNet expects), or lists of
+    sparse {feature: value} dicts.  The output has the same column layout as
+    `PreprocessorNet.normalize_dense_matrix`.
+    """
+
+    def __init__(
+        self,
+        normalization_parameters: Dict[int, NormalizationParameters],
+        clip_anomalies: bool,
+    ) -> None:
+        self.clip_anomalies = clip_anomalies
+        self.normalization_parameters = normalization_parameters
+        self.sorted_features: List[int] = []
+        for feature_type in FEATURE_TYPES:
+            for feature, parameters in normalization_parameters.items():
+                if parameters.feature_type == feature_type:
+                    self.sorted_features.append(feature)
+        self._feature_columns = {
+            int(feature): i
+            for i, feature in enumerate(self.sorted_features)
+        }
+
+        # (feature type, input columns, output columns, compiled parameters)
+        self._groups = []
+        input_start = 0
+        output_start = 0
+        for feature_type in FEATURE_TYPES:
+            group = [
+                normalization_parameters[f] for f in self.sorted_features
+                if normalization_parameters[f].feature_type == feature_type
+            ]
+            if len(group) == 0:
+                continue
+            if feature_type == identify_types.ENUM:
+                width = sum(len(p.possible_values) for p in group)
+            else:
+                width = len(group)
+            self._groups.append(
+                (
+                    feature_type,
+                    slice(input_start, input_start + len(group)),
+                    slice(output_start, output_start + width),
+                    self._compile(feature_type, group),
+                )
+            )
+            input_start += len(group)
+            output_start += width
+        self.num_output_features = output_start
+        self._all_dense = all(
+            group[0] != identify_types.ENUM for group in self._groups
+        )
+
+    def _compile(self, feature_type, group):
+        if feature_type == identify_types.ENUM:
+            enums = []
+            offset = 0
+            for parameters in group:
+                for x in parameters.possible_values:
+                    if x < 0:
+                        raise Exception(
+                            "Invalid enum possible value: " + str(x) + " " +
+                            str(parameters.possible_values)
+                        )
+                possible_values = np.array(
+                    parameters.possible_values, dtype=np.float32
+                )
+                order = np.argsort(possible_values, kind='mergesort')
+                enums.append((possible_values[order], order + offset))
+                offset += len(possible_values)
+            return enums
+        if feature_type == identify_types.QUANTILE:
+            return [
+                (
+                    np.array(p.quantiles, dtype=np.float32),
+                    np.arange(len(p.quantiles), dtype=np.float32) /
+                    np.float32(len(p.quantiles)),
+                ) for p in group
+            ]
+        if feature_type in (identify_types.CONTINUOUS, identify_types.BOXCOX):
+            compiled = {
+                'means': np.array([p.mean for p in group], dtype=np.float32),
+                'stddevs':
+                    np.array([p.stddev for p in group], dtype=np.float32),
+            }
+            if feature_type == identify_types.BOXCOX:
+                lambdas = np.array(
+                    [p.boxcox_lambda for p in group], dtype=np.float32
+                )
+                compiled['shifts'] = np.array(
+                    [p.boxcox_shift for p in group], dtype=np.float32
+                )
+                compiled['lambdas'] = lambdas
+                compiled['log_columns'] = np.where(lambdas == 0)[0]
+                compiled['power_columns'] = np.where(lambdas != 0)[0]
+            return compiled
+        return None
+
+    def sparse_to_dense(self, rows: List[Dict[int, float]]) -> np.ndarray:
+        """
+        Lays out sparse examples as a float32 matrix in `sorted_features`
+        order, with MISSING_VALUE for absent features.
+        """
+        matrix = np.full(
+            [len(rows), len(self.sorted_features)],
+            MISSING_VALUE,
+            dtype=np.float32
+        )
+        row_indices = []
+        column_indices = []
+        values = []
+        for i, row in enumerate(rows):
+            for feature, value in row.items():
+                column = self._feature_columns.get(int(feature))
+                if column is not None:
+                    row_indices.append(i)
+                    column_indices.append(column)
+                    values.append(value)
+        matrix[row_indices, column_indices] = values
+        return matrix
+
+    def transform_sparse(self, rows: List[Dict[int, float]]) -> np.ndarray:
+        return self.transform(self.sparse_to_dense(rows), inplace=True)
+
+    def transform(self, matrix: np.ndarray, inplace: bool = False) -> np.ndarray:
+        """
+        Normalizes a (batch, len(sorted_features)) matrix.  With `inplace`,
+        the input is overwritten and returned when there are no ENUM features
+        (which change the width); otherwise one output matrix is allocated and
+        every transform writes into it.
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        assert matrix.ndim == 2 and matrix.shape[1] == len(
+            self.sorted_features
+        ), "Expected a matrix with {} columns".format(len(self.sorted_features))
+        if inplace and self._all_dense:
+            output = matrix
+        else:
+            output = np.zeros(
+                [matrix.shape[0], self.num_output_features], dtype=np.float32
+            )
+
+        for feature_type, input_columns, output_columns, compiled in \
+                self._groups:
+            inputs = matrix[:, input_columns]
+            if feature_type == identify_types.ENUM:
+                self._one_hot(inputs, output[:, output_columns], compiled)
+                continue
+
+            missing = np.logical_and(
+                inputs > np.float32(MISSING_VALUE - 1e-4),
+                inputs < np.float32(MISSING_VALUE + 1e-4),
+            )
+            values = output[:, output_columns]
+            if output is not matrix:
+                np.copyto(values, inputs)
+            if feature_type == identify_types.BINARY:
+                np.not_equal(values, 0, out=values, casting='unsafe')
+            elif feature_type == identify_types.PROBABILITY:
+                np.clip(values, 0.01, 0.99, out=values)
+                # logit(x) = log(x / (1 - x))
+                np.divide(values, 1 - values, out=values)
+                np.log(values, out=values)
+            elif feature_type == identify_types.QUANTILE:
+                for i, (boundaries, labels) in enumerate(compiled):
+                    values[:, i] = np.interp(values[:, i], boundaries, labels)
+            else:
+                if feature_type == identify_types.BOXCOX:
+                    self._box_cox(values, compiled)
+                np.subtract(values, compiled['means'], out=values)
+                np.divide(values, compiled['stddevs'], out=values)
+                if self.clip_anomalies:
+                    np.clip(values, -3.0, 3.0, out=values)
+            values[missing] = 0
+        return output
+
+    def _box_cox(self, values, compiled):
+        np.add(values, compiled['shifts'], out=values)
+        np.maximum(values, np.float32(BOX_COX_EPSILON), out=values)
+        log_columns = compiled['log_columns']
+        if len(log_columns) > 0:
+            values[:, log_columns] = np.log(values[:, log_columns])
+        power_columns = compiled['power_columns']
+        if len(power_columns) > 0:
+            lambdas = compiled['lambdas'][power_columns]
+            values[:, power_columns] = (
+                np.power(values[:, power_columns], lambdas) - 1
+            ) / lambdas
+
+    def _one_hot(self, inputs, output, compiled):
+        # Missing and unknown values match no column and stay zero
+        rows = np.arange(inputs.shape[0])
+        for i, (sorted_values, columns) in enumerate(compiled):
+            if len(sorted_values) == 0:
+                continue
+            positions = np.searchsorted(sorted_values, inputs[:, i])
+            positions = np.minimum(positions, len(sorted_values) - 1)
+            found = sorted_values[positions] == inputs[:, i]
+            output[rows[found], columns[positions[found]]] = 1
@@ -2,6 +2,7 @@
 
 
 import numpy as np
+from collections import namedtuple
 from typing import List, Dict, Tuple
 
 from caffe2.python import workspace, core
@@ -16,6 +17,40 @@ from ml.rl.preprocessing.identify_types import FEATURE_TYPES
 import logging
 logger = logging.getLogger(__name__)
 
+# Feature types whose normalized value only depends on the value itself and a
+#     few per-feature constants, so `normalize_sparse_features` can normalize
+#     them pair by pair.
+SPARSE_FEATURE_TYPES = (
+    identify_types.BINARY,
+    identify_types.PROBABILITY,
+    identify_types.CONTINUOUS,
+)
+
+# `normalize_sparse_features` only looks up feature ids below this: keys are
+#     matched as float32, which represents every integer up to 2^24 exactly.
+MAX_SPARSE_FEATURE_ID = 2**24
+
+SparseNormalizedInput = namedtuple(
+    'SparseNormalizedInput',
+    [
+        'lengths',  # Number of (column, value) pairs in each row
+        'columns',  # Column of each pair in the normalize_sparse_matrix layout
+        'values',  # Normalized value of each pair
+        'dense_matrix',  # Columns that are not sparse, or None
+        'dense_columns',  # Column of each dense_matrix column in the layout
+        'num_columns',  # Width of the normalize_sparse_matrix layout
+    ]
+)
+
+FoldedNormalizedInput = namedtuple(
+    'FoldedNormalizedInput',
+    [
+        'matrix',  # Output of a PreprocessorNet with `fold_affine`
+        'scale',  # Per-column scale that completes the normalization
+        'shift',  # Per-column shift applied after the scale
+    ]
+)
+
 
 def sort_features_by_normalization(normalization_parameters):
     """
@@ -33,9 +68,103 @@ def sort_features_by_normalization(normalization_parameters):
     return sorted_features, feature_starts
 
 
+def get_folded_affine(
+    normalization_parameters: Dict[str, NormalizationParameters]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The per-column (scale, shift) that turns the output of
+    `normalize_sparse_matrix` with `fold_affine` into the normalized matrix:
+    1 / stddev and -mean / stddev for CONTINUOUS and BOXCOX columns, the
+    identity for the other columns (ENUM features span one column per
+    possible value).
+    """
+    sorted_features, _ = sort_features_by_normalization(
+        normalization_parameters
+    )
+    scale: List[float] = []
+    shift: List[float] = []
+    for feature in sorted_features:
+        norm = normalization_parameters[feature]
+        if norm.feature_type in (
+            identify_types.CONTINUOUS, identify_types.BOXCOX
+        ):
+            scale.append(1.0 / norm.stddev)
+            shift.append(-norm.mean / norm.stddev)
+        elif norm.feature_type == identify_types.ENUM:
+            scale.extend([1.0] * len(norm.possible_values))
+            shift.extend([0.0] * len(norm.possible_values))
+        else:
+            scale.append(1.0)
+            shift.append(0.0)
+    return np.array(scale, dtype=np.float32), np.array(shift, dtype=np.float32)
+
+
+def _neutral_value(parameters: NormalizationParameters) -> float:
+    """
+    An input that `parameters` normalizes to zero, used in place of missing
+    values by the fused preprocessing mode.
+    """
+    feature_type = parameters.feature_type
+    if feature_type == identify_types.BINARY:
+        return 0.0
+    if feature_type == identify_types.PROBABILITY:
+        return 0.5
+    if feature_type == identify_types.CONTINUOUS:
+        return parameters.mean
+    if feature_type == identify_types.BOXCOX:
+        # Inverse Box-Cox transform of the mean
+        if parameters.boxcox_lambda == 0:
+            value = np.exp(parameters.mean)
+        else:
+            value = np.power(
+                parameters.mean * parameters.boxcox_lambda + 1,
+                1.0 / parameters.boxcox_lambda
+            )
+        return float(value - parameters.boxcox_shift)
+    if feature_type == identify_types.QUANTILE:
+        # At or below the first boundary maps to the first quantile, 0
+        return parameters.quantiles[0]
+    return MISSING_VALUE
+
+
 class PreprocessorNet:
-    def __init__(self, net: core.Net, clip_anomalies: bool) -> None:
+    def __init__(
+        self,
+        net: core.Net,
+        clip_anomalies: bool,
+        embed_enums: bool = False,
+        fused: bool = False,
+        fold_affine: bool = False,
+    ) -> None:
+        """
+
+        :param net: The net to add preprocessing operators to
+        :param clip_anomalies: Clip CONTINUOUS/BOXCOX outputs to [-3, 3]
+        :param embed_enums: Output one embedding row id per ENUM feature
+            instead of expanding it into one-hot columns.  See
+            `get_enum_embedding_layout` for the id layout.
+        :param fused: Replace missing values with a value that normalizes to
+            zero once per input matrix, instead of masking the output of every
+            feature type.  Six ops per matrix replace seven full-size masking
+            ops per feature type, and the stddev division becomes a reciprocal
+            multiply.  Outputs differ from the unfused mode only for:
+            - missing BOXCOX features, which normalize to zero up to float32
+              rounding of the Box-Cox round trip (within 1e-4), not exactly;
+            - present CONTINUOUS and BOXCOX features, which differ by float32
+              rounding of the reciprocal (relative 1e-6).
+            Missing features of other types are exactly zero in both modes.
+        :param fold_affine: Leave the mean and stddev of CONTINUOUS and BOXCOX
+            features to the consumer (see `get_folded_affine`), e.g. to fold
+            them into the first layer.  These columns are not clipped.
+        """
         self.clip_anomalies = clip_anomalies
+        self.embed_enums = embed_enums
+        self.fused = fused
+        self.fold_affine = fold_affine
+        assert not (fold_affine and clip_anomalies), \
+            "Anomalies cannot be clipped once the affine part is folded"
+        assert fused or not fold_affine, \
+            "Folding needs missing values replaced by fused mode"
 
         self._net = net
         self.ONE = self._net.NextBlob('ONE')
@@ -70,7 +199,9 @@ class PreprocessorNet:
             self.MISSING_SCALAR,
         ]
 
-    def preprocess_blob(self, blob, normalization_parameters):
+    def preprocess_blob(
+        self, blob, normalization_parameters, missing_replaced=False
+    ):
         """
         Takes in a blob and its normalization parameters. Outputs a tuple
         whose first element is a blob containing the normalized input blob
@@ -78,23 +209,35 @@ class PreprocessorNet:
         create it.
 
         Call this from a CPU context and ensure the input blob exists in it.
+
+        :param missing_replaced: In fused mode, whether `replace_missing` was
+            already applied to the blob.
         """
-        is_empty_u = self._net.NextBlob(blob + "__isempty_u")
-        is_empty_l = self._net.NextBlob(blob + "__isempty_l")
-        is_empty = self._net.NextBlob(blob + "__isempty")
-        is_not_empty_bool = self._net.NextBlob(blob + "__isnotemptybool")
-        is_not_empty = self._net.NextBlob(blob + "__isnotempty")
         output_blob = self._net.NextBlob(blob + "_preprocessed")
-        zeros = self._net.NextBlob(blob + "_zeros")
-
-        self._net.GT([blob, self.MISSING_L], [is_empty_l], broadcast=1)
-        self._net.LT([blob, self.MISSING_U], [is_empty_u], broadcast=1)
-        self._net.And([is_empty_l, is_empty_u], [is_empty])
-        self._net.Not([is_empty], [is_not_empty_bool])
-        self._net.Cast(
-            [is_not_empty_bool], [is_not_empty],
-            to=caffe2_pb2.TensorProto.FLOAT
-        )
+        parameters: List[str] = []
+        first_op = len(self._net.Proto().op)
+        if self.fused:
+            if not missing_replaced:
+                blob, replace_parameters = self.replace_missing(
+                    blob, normalization_parameters
+                )
+                parameters.extend(replace_parameters)
+        else:
+            is_empty_u = self._net.NextBlob(blob + "__isempty_u")
+            is_empty_l = self._net.NextBlob(blob + "__isempty_l")
+            is_empty = self._net.NextBlob(blob + "__isempty")
+            is_not_empty_bool = self._net.NextBlob(blob + "__isnotemptybool")
+            is_not_empty = self._net.NextBlob(blob + "__isnotempty")
+            zeros = self._net.NextBlob(blob + "_zeros")
+
+            self._net.GT([blob, self.MISSING_L], [is_empty_l], broadcast=1)
+            self._net.LT([blob, self.MISSING_U], [is_empty_u], broadcast=1)
+            self._net.And([is_empty_l, is_empty_u], [is_empty])
+            self._net.Not([is_empty], [is_not_empty_bool])
+            self._net.Cast(
+                [is_not_empty_bool], [is_not_empty],
+                to=caffe2_pb2.TensorProto.FLOAT
+            )
         for i in range(len(normalization_parameters) - 1):
             if normalization_parameters[
                 i
@@ -103,7 +246,6 @@ class PreprocessorNet:
                     "Only one feature type is allowed per call to preprocess_blob!"
                 )
         feature_type = normalization_parameters[0].feature_type
-        parameters: List[str] = []
         if feature_type == identify_types.BINARY:
             is_gt_zero = self._net.NextBlob(blob + "__is_gt_zero")
             is_lt_zero = self._net.NextBlob(blob + "__is_lt_zero")
@@ -130,112 +272,14 @@ class PreprocessorNet:
                             str(parameter.possible_values)
                         )
 
-            int_blob = self._net.NextBlob('int_blob')
-            self._net.Cast(
-                [blob],
-                [int_blob],
-                to=core.DataType.INT32,
-            )
-
-            output_int_blob = self._net.NextBlob('output_int_blob')
-            feature_lengths_blob = self._net.NextBlob('feature_lengths_blob')
-            feature_values_blob = self._net.NextBlob('feature_values_blob')
-            one_hot_output = self._net.NextBlob('one_hot_output')
-
-            # Batch one hot transform with MISSING_VALUE as a possible value
-            feature_lengths = [
-                len(p.possible_values) + 1 for p in normalization_parameters
-            ]
-            workspace.FeedBlob(
-                feature_lengths_blob,
-                np.array(feature_lengths, dtype=np.int32),
-            )
-
-            feature_values = [
-                x
-                for p in normalization_parameters
-                for x in p.possible_values + [int(MISSING_VALUE)]
-            ]
-
-            workspace.FeedBlob(
-                feature_values_blob,
-                np.array(feature_values, dtype=np.int32),
-            )
-
-            parameters.extend([feature_values_blob, feature_lengths_blob])
-
-            self._net.BatchOneHot(
-                [int_blob, feature_lengths_blob, feature_values_blob],
-                [one_hot_output],
-            )
-
-            # Remove missing values with a mask
-            flattened_one_hot = self._net.NextBlob('flattened_one_hot')
-            self._net.FlattenToVec([one_hot_output], [flattened_one_hot])
-            cols_to_include = [
-                [1] * len(p.possible_values) + [0]
-                for p in normalization_parameters
-            ]
-            cols_to_include = [x for col in cols_to_include for x in col]
-            mask = self._net.NextBlob('mask')
-            workspace.FeedBlob(mask, np.array(cols_to_include, dtype=np.int32))
-            parameters.append(mask)
-
-            zero_vec = self._net.NextBlob('zero_vec')
-            self._net.ConstantFill(
-                [one_hot_output], [zero_vec],
-                value=0,
-                dtype=caffe2_pb2.TensorProto.INT32
-            )
-
-            repeated_mask_int = self._net.NextBlob('repeated_mask_int')
-            repeated_mask_bool = self._net.NextBlob('repeated_mask_bool')
-
-            self._net.Add([zero_vec, mask], [repeated_mask_int], broadcast=1)
-            self._net.Cast(
-                [repeated_mask_int], [repeated_mask_bool],
-                to=core.DataType.BOOL
-            )
-
-            flattened_repeated_mask = self._net.NextBlob(
-                'flattened_repeated_mask'
-            )
-            self._net.FlattenToVec(
-                [repeated_mask_bool], [flattened_repeated_mask]
-            )
-
-            flattened_one_hot_proc = self._net.NextBlob(
-                'flattened_one_hot_proc'
-            )
-            self._net.BooleanMask(
-                [flattened_one_hot, flattened_repeated_mask],
-                [flattened_one_hot_proc, flattened_one_hot_proc + 'indices']
-            )
-
-            one_hot_shape = self._net.NextBlob('one_hot_shape')
-            self._net.Shape([one_hot_output], [one_hot_shape])
-            target_shape = self._net.NextBlob('target_shape')
-            shape_delta = self._net.NextBlob('shape_delta')
-            workspace.FeedBlob(
-                shape_delta,
-                np.array([0, len(normalization_parameters)], dtype=np.int64)
-            )
-            parameters.append(shape_delta)
-            self._net.Sub(
-                [one_hot_shape, shape_delta], [target_shape], broadcast=1
-            )
-            self._net.Reshape(
-                [flattened_one_hot_proc, target_shape],
-                [output_int_blob, output_int_blob + '_old_shape'],
-            )
+            if self.embed_enums:
+                return self._preprocess_enum_ids(
+                    blob, normalization_parameters, output_blob
+                )
 
-            self._net.Cast(
-                [output_int_blob],
-                [output_blob],
-                to=core.DataType.FLOAT,
+            return self._preprocess_enum_one_hot(
+                blob, normalization_parameters, output_blob
             )
-
-            return output_blob, parameters
         elif feature_type == identify_types.QUANTILE:
             # This transformation replaces a set of values with their quantile.
             # The quantile boundaries are provided in the normalization params.
@@ -307,28 +351,281 @@ class PreprocessorNet:
                     [blob, boxcox_lambda, boxcox_shift], [blob]
                 )
 
-            means_blob = self._net.NextBlob('{}__preprocess_mean'.format(blob))
-            workspace.FeedBlob(means_blob, np.array([means], dtype=np.float32))
-            parameters.append(means_blob)
-            stddevs_blob = self._net.NextBlob(
-                '{}__preprocess_stddev'.format(blob)
-            )
-            workspace.FeedBlob(
-                stddevs_blob, np.array([stddevs], dtype=np.float32)
-            )
-            parameters.append(stddevs_blob)
-            self._net.Sub([blob, means_blob], [blob], broadcast=1, axis=0)
-            self._net.Div([blob, stddevs_blob], [blob], broadcast=1, axis=0)
-            if self.clip_anomalies:
-                self._net.Clip([blob], [blob], min=-3.0, max=3.0)
+            # With fold_affine, the consumer applies the mean and stddev, see
+            #     `get_folded_affine`
+            if not self.fold_affine:
+                means_blob = self._net.NextBlob(
+                    '{}__preprocess_mean'.format(blob)
+                )
+                workspace.FeedBlob(
+                    means_blob, np.array([means], dtype=np.float32)
+                )
+                parameters.append(means_blob)
+                stddevs_blob = self._net.NextBlob(
+                    '{}__preprocess_stddev'.format(blob)
+                )
+                self._net.Sub(
+                    [blob, means_blob], [blob], broadcast=1, axis=0
+                )
+                if self.fused:
+                    # Multiplying by a precomputed reciprocal is cheaper
+                    #     than Div
+                    workspace.FeedBlob(
+                        stddevs_blob,
+                        1.0 / np.array([stddevs], dtype=np.float32),
+                    )
+                    self._net.Mul(
+                        [blob, stddevs_blob], [blob], broadcast=1, axis=0
+                    )
+                else:
+                    workspace.FeedBlob(
+                        stddevs_blob, np.array([stddevs], dtype=np.float32)
+                    )
+                    self._net.Div(
+                        [blob, stddevs_blob], [blob], broadcast=1, axis=0
+                    )
+                parameters.append(stddevs_blob)
+                if self.clip_anomalies:
+                    self._net.Clip([blob], [blob], min=-3.0, max=3.0)
         else:
             raise NotImplementedError(
                 "Invalid feature type: {}".format(feature_type)
             )
 
-        self._net.ConstantFill([blob], [zeros], value=0.)
-        self._net.Mul([blob, is_not_empty], [output_blob])
+        if self.fused:
+            # Every op above writes `blob` in place, so the last one can write
+            #     `output_blob` directly instead of copying it
+            ops = self._net.Proto().op
+            if len(ops) == first_op or ops[-1].output[0] != str(blob):
+                return blob, parameters
+            ops[-1].output[0] = str(output_blob)
+        else:
+            self._net.ConstantFill([blob], [zeros], value=0.)
+            self._net.Mul([blob, is_not_empty], [output_blob])
+
+        return output_blob, parameters
+
+    def replace_missing(self, blob, normalization_parameters):
+        """
+        Replaces MISSING_VALUE entries of each column of `blob` with a value
+        that the column's normalization maps to zero (up to rounding for
+        BOXCOX).  ENUM columns keep MISSING_VALUE, which matches no possible
+        value.  Returns the new blob and the parameter blobs it uses.
+        """
+        neutral_values = self._net.NextBlob(blob + '__neutral_values')
+        workspace.FeedBlob(
+            neutral_values,
+            np.array(
+                [[_neutral_value(p) for p in normalization_parameters]],
+                dtype=np.float32
+            )
+        )
+        is_empty_u = self._net.NextBlob(blob + "__isempty_u")
+        is_empty_l = self._net.NextBlob(blob + "__isempty_l")
+        is_empty = self._net.NextBlob(blob + "__isempty")
+        neutral_matrix = self._net.NextBlob(blob + "__neutral_matrix")
+        output_blob = self._net.NextBlob(blob + "__missing_replaced")
+
+        self._net.GT([blob, self.MISSING_L], [is_empty_l], broadcast=1)
+        self._net.LT([blob, self.MISSING_U], [is_empty_u], broadcast=1)
+        self._net.And([is_empty_l, is_empty_u], [is_empty])
+        self._net.ConstantFill([blob], [neutral_matrix], value=0.)
+        self._net.Add(
+            [neutral_matrix, neutral_values], [neutral_matrix],
+            broadcast=1,
+            axis=0
+        )
+        self._net.Where([is_empty, neutral_matrix, blob], [output_blob])
+        return output_blob, [neutral_values]
+
+    def _match_enum_values(self, blob, normalization_parameters):
+        """
+        Locates every value of `blob` in a table that holds, for each feature,
+        its sorted possible values followed by one extra slot.  Returns the
+        slot of each value (int), a float blob that is 1 where the value is a
+        possible value of its feature and 0 for missing and unknown values,
+        the parameter blobs used, and each feature's sorted possible values.
+        Feature i's slots start at the sum of (len(values) + 1) before it.
+        """
+        sorted_values = []
+        boundaries = []
+        lengths = []
+        lookup_values = []
+        offsets = []
+        for parameter in normalization_parameters:
+            possible_values = sorted(set(parameter.possible_values))
+            sorted_values.append(possible_values)
+            offsets.append(len(lookup_values))
+            boundaries.extend(possible_values)
+            lengths.append(len(possible_values))
+            # BatchBucketize yields len(possible_values) + 1 buckets.  The last
+            #     one only holds values above every possible value, so it can
+            #     never match.
+            lookup_values.extend(possible_values + [MISSING_VALUE])
+
+        indices_blob = self._net.NextBlob(blob + '__enum_indices')
+        workspace.FeedBlob(
+            indices_blob,
+            np.arange(len(normalization_parameters), dtype=np.int32)
+        )
+        boundaries_blob = self._net.NextBlob(blob + '__enum_boundaries')
+        workspace.FeedBlob(
+            boundaries_blob, np.array(boundaries, dtype=np.float32)
+        )
+        lengths_blob = self._net.NextBlob(blob + '__enum_lengths')
+        workspace.FeedBlob(lengths_blob, np.array(lengths, dtype=np.int32))
+        lookup_values_blob = self._net.NextBlob(blob + '__enum_lookup_values')
+        workspace.FeedBlob(
+            lookup_values_blob, np.array(lookup_values, dtype=np.float32)
+        )
+        offsets_blob = self._net.NextBlob(blob + '__enum_offsets')
+        workspace.FeedBlob(offsets_blob, np.array(offsets, dtype=np.int32))
+        parameters = [
+            indices_blob, boundaries_blob, lengths_blob, lookup_values_blob,
+            offsets_blob
+        ]
+
+        slots = self._net.NextBlob(blob + '__enum_slots')
+        self._net.BatchBucketize(
+            [blob, indices_blob, boundaries_blob, lengths_blob], [slots]
+        )
+        self._net.Add([slots, offsets_blob], [slots], broadcast=1)
+        slot_values = self._net.NextBlob(blob + '__enum_slot_values')
+        self._net.Gather([lookup_values_blob, slots], [slot_values])
+
+        is_known_bool = self._net.NextBlob(blob + '__enum_is_known_bool')
+        self._net.EQ([slot_values, blob], [is_known_bool])
+        is_known = self._net.NextBlob(blob + '__enum_is_known')
+        self._net.Cast(
+            [is_known_bool], [is_known], to=caffe2_pb2.TensorProto.FLOAT
+        )
+        return slots, is_known, parameters, sorted_values
+
+    def _preprocess_enum_one_hot(
+        self, blob, normalization_parameters, output_blob
+    ):
+        """
+        One-hot encodes ENUM features by looking up each value's output column
+        and scattering a 1 there (0 for missing and unknown values, written to
+        a column of the same feature, so other features are unaffected).
+        Columns follow the order of each feature's possible_values.
+        """
+        slots, is_known, parameters, sorted_values = self._match_enum_values(
+            blob, normalization_parameters
+        )
+        lookup_columns = []
+        num_columns = 0
+        for parameter, values in zip(normalization_parameters, sorted_values):
+            lookup_columns.extend(
+                [num_columns + parameter.possible_values.index(v) for v in values]
+                + [num_columns]
+            )
+            num_columns += len(parameter.possible_values)
+
+        lookup_columns_blob = self._net.NextBlob(blob + '__enum_lookup_columns')
+        workspace.FeedBlob(
+            lookup_columns_blob, np.array(lookup_columns, dtype=np.int32)
+        )
+        num_columns_blob = self._net.NextBlob(blob + '__enum_num_columns')
+        workspace.FeedBlob(
+            num_columns_blob, np.array([num_columns], dtype=np.int32)
+        )
+        num_features_blob = self._net.NextBlob(blob + '__enum_num_features')
+        workspace.FeedBlob(
+            num_features_blob,
+            np.array([len(normalization_parameters)], dtype=np.int32)
+        )
+        shape_scale_blob = self._net.NextBlob(blob + '__enum_shape_scale')
+        workspace.FeedBlob(shape_scale_blob, np.array([1, 0], dtype=np.int64))
+        shape_offset_blob = self._net.NextBlob(blob + '__enum_shape_offset')
+        workspace.FeedBlob(
+            shape_offset_blob, np.array([0, num_columns], dtype=np.int64)
+        )
+        parameters.extend(
+            [
+                lookup_columns_blob, num_columns_blob, num_features_blob,
+                shape_scale_blob, shape_offset_blob
+            ]
+        )
+
+        # Flat index of each (row, feature) in the (batch, num_columns) output
+        columns = self._net.NextBlob(blob + '__enum_columns')
+        self._net.Gather([lookup_columns_blob, slots], [columns])
+        flat_columns = self._net.NextBlob(blob + '__enum_flat_columns')
+        self._net.FlattenToVec([columns], [flat_columns])
+        first_column = self._net.NextBlob(blob + '__enum_first_column')
+        self._net.Slice([blob], [first_column], starts=[0, 0], ends=[-1, 1])
+        row_lengths = self._net.NextBlob(blob + '__enum_row_lengths')
+        self._net.ConstantFill(
+            [first_column], [row_lengths],
+            value=len(normalization_parameters),
+            dtype=caffe2_pb2.TensorProto.INT32
+        )
+        flat_row_lengths = self._net.NextBlob(blob + '__enum_flat_row_lengths')
+        self._net.FlattenToVec([row_lengths], [flat_row_lengths])
+        rows = self._net.NextBlob(blob + '__enum_rows')
+        self._net.LengthsToSegmentIds([flat_row_lengths], [rows])
+        indices = self._net.NextBlob(blob + '__enum_scatter_indices')
+        self._net.Mul([rows, num_columns_blob], [indices], broadcast=1)
+        self._net.Add([indices, flat_columns], [indices])
+        values = self._net.NextBlob(blob + '__enum_scatter_values')
+        self._net.FlattenToVec([is_known], [values])
+
+        output_shape = self._net.NextBlob(blob + '__enum_output_shape')
+        self._net.Shape([blob], [output_shape])
+        self._net.Mul([output_shape, shape_scale_blob], [output_shape])
+        self._net.Add([output_shape, shape_offset_blob], [output_shape])
+        self._net.ConstantFill(
+            [output_shape], [output_blob],
+            input_as_shape=1,
+            value=0.0,
+            dtype=caffe2_pb2.TensorProto.FLOAT
+        )
+        old_shape = self._net.NextBlob(blob + '__enum_old_shape')
+        self._net.Reshape([output_blob], [output_blob, old_shape], shape=[-1])
+        self._net.ScatterAssign(
+            [output_blob, indices, values], [output_blob]
+        )
+        self._net.Reshape(
+            [output_blob, output_shape], [output_blob, old_shape]
+        )
+        return output_blob, parameters
+
+    def _preprocess_enum_ids(self, blob, normalization_parameters, output_blob):
+        """
+        Maps each ENUM value to a row id of an embedding table shared by all
+        the features in `normalization_parameters`.  Feature i owns rows
+        [offset_i, offset_i + len(possible_values_i)]: row offset_i is used for
+        missing and unknown values, the others for the sorted possible values.
+        The output has one (float) column per feature.
+        """
+        slots, is_known, parameters, sorted_values = self._match_enum_values(
+            blob, normalization_parameters
+        )
+        lookup_ids = []
+        offsets = []
+        for values in sorted_values:
+            offsets.append(len(lookup_ids))
+            lookup_ids.extend(list(range(1, len(values) + 1)) + [0])
+
+        lookup_ids_blob = self._net.NextBlob(blob + '__enum_lookup_ids')
+        workspace.FeedBlob(
+            lookup_ids_blob, np.array(lookup_ids, dtype=np.float32)
+        )
+        # The lookup tables and the embedding table use the same layout, so
+        #     the same offsets locate a feature's slots in both.
+        float_offsets_blob = self._net.NextBlob(blob + '__enum_float_offsets')
+        workspace.FeedBlob(
+            float_offsets_blob, np.array(offsets, dtype=np.float32)
+        )
+        parameters.extend([lookup_ids_blob, float_offsets_blob])
 
+        bucket_ids = self._net.NextBlob(blob + '__enum_bucket_ids')
+        self._net.Gather([lookup_ids_blob, slots], [bucket_ids])
+        self._net.Mul([bucket_ids, is_known], [bucket_ids])
+        self._net.Add(
+            [bucket_ids, float_offsets_blob], [output_blob], broadcast=1
+        )
         return output_blob, parameters
 
     def normalize_sparse_matrix(
@@ -358,6 +655,238 @@ class PreprocessorNet:
             blobname_prefix,
         )
 
+    def normalize_sparse_features(
+        self,
+        lengths_blob: str,
+        keys_blob: str,
+        values_blob: str,
+        normalization_parameters: Dict[str, NormalizationParameters],
+        blobname_prefix: str,
+    ) -> Tuple[SparseNormalizedInput, List[str]]:
+        """
+        Normalizes sparse inputs like `normalize_sparse_matrix`, but keeps
+        features of SPARSE_FEATURE_TYPES as (column, value) pairs instead of
+        writing them into a (batch, num_columns) matrix.  Each pair is
+        normalized with its feature's parameters; pairs of unknown features
+        and MISSING_VALUE pairs keep their place with a value of 0, which is
+        what `normalize_sparse_matrix` outputs for them.  The other features
+        go through `normalize_sparse_matrix` on their own.
+
+        Meant for first layers that read the pairs directly, e.g. with
+        SparseLengthsWeightedSum, so the cost of a row is proportional to the
+        features it has rather than to the number of columns.
+        """
+        assert not self.embed_enums, \
+            "Sparse normalization expects one-hot ENUM features"
+        sorted_features, _ = sort_features_by_normalization(
+            normalization_parameters
+        )
+        sparse_features = []
+        sparse_columns: List[int] = []
+        dense_features = []
+        dense_columns: List[int] = []
+        num_columns = 0
+        for feature in sorted_features:
+            norm = normalization_parameters[feature]
+            if norm.feature_type == identify_types.ENUM:
+                width = len(norm.possible_values)
+            else:
+                width = 1
+            if norm.feature_type in SPARSE_FEATURE_TYPES:
+                sparse_features.append(feature)
+                sparse_columns.append(num_columns)
+            else:
+                dense_features.append(feature)
+                dense_columns.extend(range(num_columns, num_columns + width))
+            num_columns += width
+
+        parameters: List[str] = []
+        dense_matrix = None
+        if len(dense_features) > 0:
+            dense_matrix, dense_parameters = self.normalize_sparse_matrix(
+                lengths_blob,
+                keys_blob,
+                values_blob,
+                {f: normalization_parameters[f]
+                 for f in dense_features},
+                blobname_prefix + '_dense',
+            )
+            parameters.extend(dense_parameters)
+
+        sparse_ids = [int(feature) for feature in sparse_features]
+        for feature_id in sparse_ids:
+            if feature_id < 0 or feature_id >= MAX_SPARSE_FEATURE_ID:
+                raise Exception(
+                    "Sparse normalization needs feature ids in [0, {}): {}".
+                    format(MAX_SPARSE_FEATURE_ID, feature_id)
+                )
+        # Per-feature tables indexed by the position of the feature id among
+        #     the sorted ids.  The extra last slot is where BatchBucketize puts
+        #     keys above every id; its id is not an integer so it never matches.
+        order = np.argsort(sparse_ids, kind='mergesort')
+        sorted_ids = [sparse_ids[i] for i in order]
+        sparse_parameters = [
+            normalization_parameters[sparse_features[i]] for i in order
+        ]
+        tables = {
+            'ids': (sorted_ids + [0.5], np.float32),
+            'columns': ([sparse_columns[i] for i in order] + [0], np.int32),
+            'means':
+                (
+                    [
+                        p.mean if p.feature_type == identify_types.CONTINUOUS
+                        else 0.0 for p in sparse_parameters
+                    ] + [0.0], np.float32
+                ),
+            'inverse_stddevs':
+                (
+                    [
+                        1.0 / p.stddev
+                        if p.feature_type == identify_types.CONTINUOUS else 1.0
+                        for p in sparse_parameters
+                    ] + [1.0], np.float32
+                ),
+            'is_binary':
+                (
+                    [
+                        p.feature_type == identify_types.BINARY
+                        for p in sparse_parameters
+                    ] + [False], np.bool_
+                ),
+            'is_probability':
+                (
+                    [
+                        p.feature_type == identify_types.PROBABILITY
+                        for p in sparse_parameters
+                    ] + [False], np.bool_
+                ),
+        }
+        prefix = blobname_prefix + '_sparse'
+        table_blobs = {}
+        for name, (values, dtype) in tables.items():
+            table_blobs[name] = self._net.NextBlob(prefix + '_' + name)
+            workspace.FeedBlob(table_blobs[name], np.array(values, dtype=dtype))
+            parameters.append(table_blobs[name])
+        bucketize_indices = self._net.NextBlob(prefix + '_bucketize_indices')
+        workspace.FeedBlob(bucketize_indices, np.array([0], dtype=np.int32))
+        bucketize_boundaries = self._net.NextBlob(
+            prefix + '_bucketize_boundaries'
+        )
+        workspace.FeedBlob(
+            bucketize_boundaries, np.array(sorted_ids, dtype=np.float32)
+        )
+        bucketize_lengths = self._net.NextBlob(prefix + '_bucketize_lengths')
+        workspace.FeedBlob(
+            bucketize_lengths, np.array([len(sorted_ids)], dtype=np.int32)
+        )
+        parameters.extend(
+            [bucketize_indices, bucketize_boundaries, bucketize_lengths]
+        )
+
+        with core.DeviceScope(core.DeviceOption(caffe2_pb2.CPU)):
+            # Slot of each key in the tables
+            float_keys = self._net.NextBlob(prefix + '_float_keys')
+            self._net.Cast(
+                [keys_blob], [float_keys], to=caffe2_pb2.TensorProto.FLOAT
+            )
+            key_column = self._net.NextBlob(prefix + '_key_column')
+            self._net.Reshape(
+                [float_keys], [key_column, key_column + '_old_shape'],
+                shape=[-1, 1]
+            )
+            slot_column = self._net.NextBlob(prefix + '_slot_column')
+            self._net.BatchBucketize(
+                [
+                    key_column, bucketize_indices, bucketize_boundaries,
+                    bucketize_lengths
+                ], [slot_column]
+            )
+            slots = self._net.NextBlob(prefix + '_slots')
+            self._net.FlattenToVec([slot_column], [slots])
+
+            def gather(name):
+                output = self._net.NextBlob(prefix + '_pair_' + name)
+                self._net.Gather([table_blobs[name], slots], [output])
+                return output
+
+            is_known = self._net.NextBlob(prefix + '_is_known')
+            self._net.EQ([gather('ids'), float_keys], [is_known])
+            is_missing_l = self._net.NextBlob(prefix + '_is_missing_l')
+            is_missing_u = self._net.NextBlob(prefix + '_is_missing_u')
+            is_missing = self._net.NextBlob(prefix + '_is_missing')
+            is_present = self._net.NextBlob(prefix + '_is_present')
+            is_valid = self._net.NextBlob(prefix + '_is_valid')
+            self._net.GT(
+                [values_blob, self.MISSING_L], [is_missing_l], broadcast=1
+            )
+            self._net.LT(
+                [values_blob, self.MISSING_U], [is_missing_u], broadcast=1
+            )
+            self._net.And([is_missing_l, is_missing_u], [is_missing])
+            self._net.Not([is_missing], [is_present])
+            self._net.And([is_known, is_present], [is_valid])
+
+            # Every pair goes through every transform; Where picks the one of
+            #     its feature type.  Each transform is finite for any input.
+            is_gt_zero = self._net.NextBlob(prefix + '_is_gt_zero')
+            is_lt_zero = self._net.NextBlob(prefix + '_is_lt_zero')
+            is_nonzero = self._net.NextBlob(prefix + '_is_nonzero')
+            binary_values = self._net.NextBlob(prefix + '_binary_values')
+            self._net.GT([values_blob, self.ZERO], [is_gt_zero], broadcast=1)
+            self._net.LT([values_blob, self.ZERO], [is_lt_zero], broadcast=1)
+            self._net.Or([is_gt_zero, is_lt_zero], [is_nonzero])
+            self._net.Cast(
+                [is_nonzero], [binary_values], to=caffe2_pb2.TensorProto.FLOAT
+            )
+
+            probability_values = self._net.NextBlob(
+                prefix + '_probability_values'
+            )
+            self._net.Clip(
+                [values_blob], [probability_values], min=0.01, max=0.99
+            )
+            self._net.Logit([probability_values], [probability_values])
+
+            continuous_values = self._net.NextBlob(prefix + '_continuous_values')
+            self._net.Sub([values_blob, gather('means')], [continuous_values])
+            self._net.Mul(
+                [continuous_values, gather('inverse_stddevs')],
+                [continuous_values]
+            )
+            if self.clip_anomalies:
+                self._net.Clip(
+                    [continuous_values], [continuous_values],
+                    min=-3.0,
+                    max=3.0
+                )
+
+            normalized_values = self._net.NextBlob(prefix + '_normalized_values')
+            self._net.Where(
+                [gather('is_probability'), probability_values,
+                 continuous_values], [normalized_values]
+            )
+            self._net.Where(
+                [gather('is_binary'), binary_values, normalized_values],
+                [normalized_values]
+            )
+            zeros = self._net.NextBlob(prefix + '_zeros')
+            self._net.ConstantFill([values_blob], [zeros], value=0.)
+            output_values = self._net.NextBlob(prefix + '_values')
+            self._net.Where(
+                [is_valid, normalized_values, zeros], [output_values]
+            )
+            self._net.NanCheck([output_values], [output_values])
+            columns = gather('columns')
+
+        return SparseNormalizedInput(
+            lengths=lengths_blob,
+            columns=columns,
+            values=output_values,
+            dense_matrix=dense_matrix,
+            dense_columns=dense_columns,
+            num_columns=num_columns,
+        ), parameters
+
     def normalize_dense_matrix(
         self,
         input_matrix: str,
@@ -387,6 +916,12 @@ class PreprocessorNet:
 
             normalized_input_blobs = []
             parameters: List[str] = []
+            if self.fused:
+                input_matrix, replace_parameters = self.replace_missing(
+                    input_matrix,
+                    [normalization_parameters[x] for x in features],
+                )
+                parameters.extend(replace_parameters)
             for i, feature_type in enumerate(FEATURE_TYPES):
                 start_index = feature_starts[i]
                 if (i + 1) == len(FEATURE_TYPES):
@@ -410,6 +945,7 @@ class PreprocessorNet:
                         normalization_parameters[x]
                         for x in features[start_index:end_index]
                     ],
+                    missing_replaced=self.fused,
                 )
                 parameters.extend(blob_parameters)
                 normalized_input_blobs.append(normalized_input_blob)
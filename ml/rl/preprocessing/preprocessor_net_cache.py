@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+"""
+Reuses preprocessing nets across calls.  Building a PreprocessorNet feeds
+every parameter blob and adds a few dozen ops per feature type; callers that
+normalize many small batches with the same parameters only need to feed the
+inputs and run a net that already exists.
+"""
+
+import hashlib
+import itertools
+import json
+from typing import Dict, List
+
+import numpy as np
+
+from caffe2.python import core, workspace
+
+from ml.rl.caffe_utils import C2
+from ml.rl.preprocessing import normalization
+from ml.rl.preprocessing.normalization import NormalizationParameters
+from ml.rl.preprocessing.preprocessor_net import PreprocessorNet
+
+
+def normalization_hash(
+    normalization_parameters: Dict[int, NormalizationParameters],
+    *layout
+) -> str:
+    """
+    A stable hash of a normalization map and anything else that determines
+    the preprocessing net, e.g. the input layout.
+    """
+    serialized = normalization.serialize(normalization_parameters)
+    content = json.dumps(
+        [
+            sorted((str(k), v) for k, v in serialized.items()),
+            [str(x) for x in layout],
+        ]
+    )
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class SparsePreprocessingNet(object):
+    """
+    A created net that normalizes a batch of sparse {feature: value} rows into
+    the dense matrix `PreprocessorNet.normalize_sparse_matrix` produces.
+    """
+
+    def __init__(
+        self,
+        normalization_parameters: Dict[int, NormalizationParameters],
+        clip_anomalies: bool,
+        embed_enums: bool = False,
+        fused: bool = False,
+    ) -> None:
+        self.net = core.Net('cached_preprocessing')
+        prefix = self.net.Proto().name
+        self.lengths_blob = prefix + '_lengths'
+        self.keys_blob = prefix + '_keys'
+        self.values_blob = prefix + '_values'
+        for blob, dtype in [
+            (self.lengths_blob, np.int32),
+            (self.keys_blob, np.int32),
+            (self.values_blob, np.float32),
+        ]:
+            workspace.FeedBlob(blob, np.zeros(0, dtype=dtype))
+
+        previous_model, previous_net = C2.model(), C2.net()
+        C2.set_net(self.net)
+        preprocessor = PreprocessorNet(
+            self.net, clip_anomalies, embed_enums, fused
+        )
+        self.output_blob, _ = preprocessor.normalize_sparse_matrix(
+            self.lengths_blob,
+            self.keys_blob,
+            self.values_blob,
+            normalization_parameters,
+            prefix,
+        )
+        if previous_model is not None:
+            C2.set_model(previous_model)
+        else:
+            C2.set_net(previous_net)
+
+        workspace.CreateNet(self.net)
+        self.workspace = workspace.CurrentWorkspace()
+
+    def is_valid(self) -> bool:
+        """
+        False once the net was removed, e.g. by ResetWorkspace.
+        """
+        return self.workspace == workspace.CurrentWorkspace() and \
+            self.net.Proto().name in workspace.Nets()
+
+    def normalize(self, rows: List[Dict[int, float]]) -> np.ndarray:
+        workspace.FeedBlob(
+            self.lengths_blob,
+            np.array([len(row) for row in rows], dtype=np.int32)
+        )
+        workspace.FeedBlob(
+            self.keys_blob,
+            np.array(
+                list(itertools.chain.from_iterable(row.keys() for row in rows)),
+                dtype=np.int32
+            )
+        )
+        workspace.FeedBlob(
+            self.values_blob,
+            np.array(
+                list(
+                    itertools.chain.from_iterable(row.values() for row in rows)
+                ),
+                dtype=np.float32
+            )
+        )
+        workspace.RunNet(self.net.Proto().name)
+        return workspace.FetchBlob(self.output_blob)
+
+
+_cache: Dict[str, SparsePreprocessingNet] = {}
+
+
+def get_sparse_preprocessing_net(
+    normalization_parameters: Dict[int, NormalizationParameters],
+    clip_anomalies: bool,
+    embed_enums: bool = False,
+    fused: bool = False,
+) -> SparsePreprocessingNet:
+    """
+    Returns a SparsePreprocessingNet for these parameters, building it only if
+    no valid one exists in the current workspace.  See `PreprocessorNet` for
+    the options.
+    """
+    key = normalization_hash(
+        normalization_parameters, 'sparse', clip_anomalies, embed_enums,
+        fused, workspace.CurrentWorkspace()
+    )
+    preprocessing_net = _cache.get(key)
+    if preprocessing_net is None or not preprocessing_net.is_valid():
+        preprocessing_net = SparsePreprocessingNet(
+            normalization_parameters, clip_anomalies, embed_enums, fused
+        )
+        _cache[key] = preprocessing_net
+    return preprocessing_net
+
+
+def clear_cache() -> None:
+    _cache.clear()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import math
+
+import numpy as np
+
+
+class QuantileSketch(object):
+    """ Mergeable, bounded-size quantile sketch in the spirit of the merging
+    t-digest.  Values are kept as weighted centroids.  Centroids near the tails
+    are kept small, so extreme quantiles stay accurate, and the number of
+    centroids is bounded by roughly `compression`.
+    """
+
+    def __init__(self, compression: int = 200, buffer_size: int = 100000) -> None:
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._means = np.zeros(0, dtype=np.float64)
+        self._weights = np.zeros(0, dtype=np.float64)
+        self._buffer = []
+        self._buffered = 0
+
+    def update(self, values) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.size == 0:
+            return
+        self.count += values.size
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+        self._buffer.append((values, np.ones_like(values)))
+        self._buffered += values.size
+        if self._buffered >= self.buffer_size:
+            self._compress()
+
+    def merge(self, other: 'QuantileSketch') -> None:
+        if other.count == 0:
+            return
+        other._compress()
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._buffer.append((other._means, other._weights))
+        self._buffered += other._means.size
+        self._compress()
+
+    def quantiles(self, probabilities) -> np.ndarray:
+        """
+        Returns the estimated value at each probability in [0, 1].
+        """
+        probabilities = np.asarray(probabilities, dtype=np.float64)
+        if self.count == 0:
+            return np.zeros_like(probabilities)
+        self._compress()
+        total = float(np.sum(self._weights))
+        centers = np.cumsum(self._weights) - self._weights / 2
+        return np.interp(
+            probabilities * total,
+            np.concatenate([[0.0], centers, [total]]),
+            np.concatenate([[self.min], self._means, [self.max]]),
+        )
+
+    def _compress(self) -> None:
+        if self._buffered == 0:
+            return
+        means = np.concatenate([self._means] + [m for m, _ in self._buffer])
+        weights = np.concatenate(
+            [self._weights] + [w for _, w in self._buffer]
+        )
+        self._buffer = []
+        self._buffered = 0
+
+        order = np.argsort(means, kind='mergesort')
+        means = means[order]
+        weights = weights[order]
+        total = np.sum(weights)
+        # Map the cumulative weight at each centroid's center through the k1
+        #     scale function; centroids within one unit of k are merged.
+        q = (np.cumsum(weights) - weights / 2) / total
+        k = self.compression / (2 * math.pi) * np.arcsin(2 * q - 1)
+        bins = np.floor(k - k[0]).astype(np.int64)
+        _, starts = np.unique(bins, return_index=True)
+        merged_weights = np.add.reduceat(weights, starts)
+        merged_means = np.add.reduceat(means * weights, starts) / merged_weights
+        self._means = merged_means
+        self._weights = merged_weights
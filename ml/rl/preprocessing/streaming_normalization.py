@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+"""
+Fits NormalizationParameters one chunk at a time, so that features with more
+values than fit in memory can be identified.  A NormalizationFitter keeps only
+bounded state (moments, a quantile sketch, a capped set of distinct values
+and a reservoir sample), and fitters built on separate shards can be merged.
+
+The result matches `normalization.identify_parameter` on the same data up to
+the accuracy of the sketch: moments, types and enum values are exact, while
+quantiles and the Box-Cox fit are estimated (exactly so when the data fits in
+the reservoir).
+"""
+
+import collections
+import math
+
+import numpy as np
+from scipy import stats
+
+from ml.rl.preprocessing import identify_types
+from ml.rl.preprocessing.identify_types import DEFAULT_MAX_UNIQUE_ENUM
+from ml.rl.preprocessing.normalization import BOX_COX_MARGIN, \
+    BOX_COX_MAX_STDDEV, DEFAULT_MAX_QUANTILE_SIZE, \
+    DEFAULT_QUANTILE_K2_THRESHOLD, MINIMUM_SAMPLES_TO_IDENTIFY, \
+    NormalizationParameters
+from ml.rl.preprocessing.quantile_sketch import QuantileSketch
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESERVOIR_SIZE = 100000
+
+
+def normaltest_from_moments(count, skewness, kurtosis):
+    """
+    D'Agostino and Pearson's K^2 computed from the biased sample skewness and
+    (non-Fisher) kurtosis; the same statistic as `scipy.stats.normaltest`.
+    """
+    n = float(count)
+
+    y = skewness * math.sqrt(((n + 1) * (n + 3)) / (6.0 * (n - 2)))
+    beta2 = (3.0 * (n * n + 27 * n - 70) * (n + 1) * (n + 3)) / \
+        ((n - 2.0) * (n + 5) * (n + 7) * (n + 9))
+    w2 = -1 + math.sqrt(2 * (beta2 - 1))
+    delta = 1 / math.sqrt(0.5 * math.log(w2))
+    alpha = math.sqrt(2.0 / (w2 - 1))
+    if y == 0:
+        y = 1
+    z_skew = delta * math.log(y / alpha + math.sqrt((y / alpha)**2 + 1))
+
+    expected = 3.0 * (n - 1) / (n + 1)
+    variance = 24.0 * n * (n - 2) * (n - 3) / \
+        ((n + 1) * (n + 1.0) * (n + 3) * (n + 5))
+    x = (kurtosis - expected) / math.sqrt(variance)
+    sqrt_beta1 = 6.0 * (n * n - 5 * n + 2) / ((n + 7) * (n + 9)) * \
+        math.sqrt((6.0 * (n + 3) * (n + 5)) / (n * (n - 2) * (n - 3)))
+    a = 6.0 + 8.0 / sqrt_beta1 * \
+        (2.0 / sqrt_beta1 + math.sqrt(1 + 4.0 / (sqrt_beta1**2)))
+    term1 = 1 - 2 / (9.0 * a)
+    denominator = 1 + x * math.sqrt(2 / (a - 4.0))
+    if denominator == 0:
+        z_kurtosis = math.nan
+    else:
+        term2 = math.copysign(
+            ((1 - 2.0 / a) / abs(denominator))**(1 / 3.0), denominator
+        )
+        z_kurtosis = (term1 - term2) / math.sqrt(2 / (9.0 * a))
+
+    k2 = z_skew**2 + z_kurtosis**2
+    return k2, stats.chi2.sf(k2, 2)
+
+
+class NormalizationFitter(object):
+    """
+    Accumulates the statistics identify_parameter needs for one feature.
+
+        fitter = NormalizationFitter()
+        for chunk in chunks:
+            fitter.update(chunk)
+        parameters = fitter.finalize()
+
+    Fitters built with the same arguments on different shards can be combined
+    with `merge` before calling `finalize`.
+    """
+
+    def __init__(
+        self,
+        max_unique_enum_values=DEFAULT_MAX_UNIQUE_ENUM,
+        quantile_size=DEFAULT_MAX_QUANTILE_SIZE,
+        quantile_k2_threshold=DEFAULT_QUANTILE_K2_THRESHOLD,
+        skip_box_cox=False,
+        skip_quantiles=False,
+        feature_type=None,
+        reservoir_size=DEFAULT_RESERVOIR_SIZE,
+        sketch_compression=200,
+        seed=None,
+    ):
+        self.max_unique_enum_values = max_unique_enum_values
+        self.quantile_size = quantile_size
+        self.quantile_k2_threshold = quantile_k2_threshold
+        self.skip_box_cox = skip_box_cox
+        self.skip_quantiles = skip_quantiles
+        self.feature_type = feature_type
+        self.reservoir_size = reservoir_size
+        self._rng = np.random.RandomState(seed)
+
+        # Central moments: sums of the 2nd, 3rd and 4th powers of deviations
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self._m3 = 0.0
+        self._m4 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+        self._all_zero_or_one = True
+        self._all_integers = True
+        # Distinct values, or None once there are too many to be an ENUM
+        self._distinct = set()
+
+        self._sketch = QuantileSketch(compression=sketch_compression)
+        self._reservoir = np.zeros(0, dtype=np.float64)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.size == 0:
+            return
+
+        mean = float(np.mean(values))
+        deviations = values - mean
+        squares = deviations * deviations
+        self._merge_moments(
+            values.size,
+            mean,
+            float(np.sum(squares)),
+            float(np.sum(squares * deviations)),
+            float(np.sum(squares * squares)),
+        )
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+
+        self._all_zero_or_one = self._all_zero_or_one and bool(
+            np.all(np.logical_or(values == 0, values == 1))
+        )
+        self._all_integers = self._all_integers and bool(
+            np.all(np.modf(values)[0] == 0)
+        )
+        if self._distinct is not None:
+            self._add_distinct(np.unique(values))
+
+        self._sketch.update(values)
+        self._update_reservoir(values)
+
+    def merge(self, other):
+        """
+        Folds the statistics of `other`, fitted on a disjoint shard, into this
+        fitter.
+        """
+        if other.count == 0:
+            return
+        reservoir_count = self.count
+        self._merge_moments(
+            other.count, other.mean, other._m2, other._m3, other._m4
+        )
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._all_zero_or_one = self._all_zero_or_one and \
+            other._all_zero_or_one
+        self._all_integers = self._all_integers and other._all_integers
+        if self._distinct is not None:
+            if other._distinct is None:
+                self._distinct = None
+            else:
+                self._add_distinct(other._distinct)
+        self._sketch.merge(other._sketch)
+        self._merge_reservoir(reservoir_count, other)
+
+    def identify_type(self):
+        """
+        Same decision as `identify_types.identify_type` on all values seen.
+        """
+        if self._all_zero_or_one or self.min == self.max:
+            return identify_types.BINARY
+        if 0 <= self.min and self.max <= 1:
+            return identify_types.PROBABILITY
+        if self.min >= 0 and self._all_integers and \
+                self._distinct is not None:
+            return identify_types.ENUM
+        return identify_types.CONTINUOUS
+
+    def finalize(self):
+        feature_type = self.feature_type
+        if feature_type is None:
+            feature_type = self.identify_type()
+
+        boxcox_lambda = None
+        boxcox_shift = 0
+        mean = 0
+        stddev = 1
+        possible_values = None
+        quantiles = None
+        assert feature_type in [
+            identify_types.CONTINUOUS,
+            identify_types.PROBABILITY,
+            identify_types.BINARY,
+            identify_types.ENUM,
+        ], "unknown type {}".format(feature_type)
+        assert self.count >= MINIMUM_SAMPLES_TO_IDENTIFY, \
+            "insufficient information to identify parameter"
+
+        # Statistics of the values used for mean and stddev; replaced by
+        #     the Box-Cox output if the transform is applied.
+        count, values_mean, variance = self.count, self.mean, self._variance()
+        if feature_type == identify_types.CONTINUOUS:
+            assert self.min < self.max, "Binary feature marked as continuous"
+            k2_original, p_original = normaltest_from_moments(
+                self.count, self._skewness(), self._kurtosis()
+            )
+
+            boxcox_shift = float(self.min * -1)
+            candidate_values, lmbda = stats.boxcox(
+                np.maximum(self._reservoir + boxcox_shift, BOX_COX_MARGIN)
+            )
+            k2_boxcox, p_boxcox = stats.normaltest(candidate_values)
+            # K^2 grows linearly with the sample size for a fixed
+            #     distribution, scale it up to the full data.
+            k2_boxcox *= self.count / float(len(candidate_values))
+            logger.info(
+                "Feature stats.  Original K2: {} P: {} Boxcox K2: {} P: {}".
+                format(k2_original, p_original, k2_boxcox, p_boxcox)
+            )
+            if lmbda < 0.9 or lmbda > 1.1:
+                if k2_original > k2_boxcox * 10 and \
+                        k2_boxcox <= self.quantile_k2_threshold:
+                    boxcox_stddev = np.std(candidate_values, ddof=1)
+                    if np.isfinite(boxcox_stddev) and \
+                       boxcox_stddev < BOX_COX_MAX_STDDEV and \
+                       not np.isclose(boxcox_stddev, 0):
+                        count = len(candidate_values)
+                        values_mean = float(np.mean(candidate_values))
+                        variance = float(boxcox_stddev)**2
+                        boxcox_lambda = float(lmbda)
+            if boxcox_lambda is None or self.skip_box_cox:
+                boxcox_shift = None
+                boxcox_lambda = None
+            if boxcox_lambda is not None:
+                feature_type = identify_types.BOXCOX
+            if boxcox_lambda is None and \
+                    k2_original > self.quantile_k2_threshold and \
+                    not self.skip_quantiles:
+                feature_type = identify_types.QUANTILE
+                quantiles = np.unique(
+                    self._sketch.quantiles(
+                        np.arange(self.quantile_size + 1, dtype=np.float64) /
+                        float(self.quantile_size)
+                    )
+                ).astype(float).tolist()
+                logger.info(
+                    "Feature is non-normal, using quantiles: {}".
+                    format(quantiles)
+                )
+
+        if feature_type == identify_types.CONTINUOUS or \
+                feature_type == identify_types.BOXCOX:
+            mean = float(values_mean)
+            stddev = math.sqrt(variance) if count > 1 else math.nan
+            if np.isclose(stddev, 0) or not np.isfinite(stddev):
+                stddev = 1
+
+        if feature_type == identify_types.ENUM:
+            possible_values = sorted(int(v) for v in self._distinct)
+
+        return NormalizationParameters(
+            feature_type, boxcox_lambda, boxcox_shift, mean, stddev,
+            possible_values, quantiles
+        )
+
+    def _variance(self):
+        if self.count < 2:
+            return math.nan
+        return self._m2 / (self.count - 1)
+
+    def _skewness(self):
+        m2 = self._m2 / self.count
+        return (self._m3 / self.count) / m2**1.5
+
+    def _kurtosis(self):
+        m2 = self._m2 / self.count
+        return (self._m4 / self.count) / m2**2
+
+    def _merge_moments(self, count, mean, m2, m3, m4):
+        # Pairwise update of the central moments (Chan et al., Pebay)
+        n_a = float(self.count)
+        n_b = float(count)
+        n = n_a + n_b
+        delta = mean - self.mean
+        delta_n = delta / n
+        self._m4 = self._m4 + m4 + \
+            delta * delta_n**3 * n_a * n_b * (n_a * n_a - n_a * n_b + n_b * n_b) + \
+            6 * delta_n**2 * (n_a * n_a * m2 + n_b * n_b * self._m2) + \
+            4 * delta_n * (n_a * m3 - n_b * self._m3)
+        self._m3 = self._m3 + m3 + \
+            delta * delta_n**2 * n_a * n_b * (n_a - n_b) + \
+            3 * delta_n * (n_a * m2 - n_b * self._m2)
+        self._m2 = self._m2 + m2 + delta * delta_n * n_a * n_b
+        self.mean = self.mean + delta_n * n_b
+        self.count += count
+
+    def _add_distinct(self, values):
+        self._distinct.update(float(v) for v in values)
+        if len(self._distinct) > self.max_unique_enum_values:
+            self._distinct = None
+
+    def _update_reservoir(self, values):
+        # Algorithm R, vectorized over the chunk.  self.count already
+        #     includes `values`.
+        seen = self.count - values.size
+        free = max(0, min(self.reservoir_size - len(self._reservoir), values.size))
+        if free > 0:
+            self._reservoir = np.concatenate([self._reservoir, values[:free]])
+        if free == values.size:
+            return
+        positions = np.arange(seen + free + 1, seen + values.size + 1)
+        slots = (self._rng.random_sample(positions.size) * positions
+                 ).astype(np.int64)
+        accepted = slots < self.reservoir_size
+        self._reservoir[slots[accepted]] = values[free:][accepted]
+
+    def _merge_reservoir(self, count, other):
+        # Each reservoir element stands for count / len(reservoir) values
+        reservoir = np.concatenate([self._reservoir, other._reservoir])
+        if len(reservoir) <= self.reservoir_size:
+            self._reservoir = reservoir
+            return
+        weights = np.concatenate([
+            np.full(len(self._reservoir), count / len(self._reservoir)),
+            np.full(len(other._reservoir), other.count / len(other._reservoir)),
+        ])
+        self._reservoir = self._rng.choice(
+            reservoir,
+            size=self.reservoir_size,
+            replace=False,
+            p=weights / np.sum(weights),
+        )
+
+
+def fit_normalization_parameters(chunks, **kwargs):
+    """
+    Fits every feature in an iterable of {feature: values} chunks, e.g. pages
+    read from disk.  Extra arguments are passed to each NormalizationFitter.
+    """
+    fitters = collections.OrderedDict()
+    for chunk in chunks:
+        for feature, values in chunk.items():
+            if feature not in fitters:
+                fitters[feature] = NormalizationFitter(**kwargs)
+            fitters[feature].update(values)
+    return collections.OrderedDict(
+        (feature, fitter.finalize()) for feature, fitter in fitters.items()
+    )
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+import collections
+import contextlib
+import json
+import math
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from caffe2.python import core, workspace
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """ Aggregates samples into power-of-two buckets, so memory stays constant
+    no matter how many samples are added.  Bucket i holds samples in
+    [min_value * 2^(i-1), min_value * 2^i); bucket 0 holds everything below
+    min_value.
+    """
+
+    def __init__(self, min_value: float = 1e-6, num_buckets: int = 40) -> None:
+        self.min_value = min_value
+        self.buckets = [0] * num_buckets
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value < self.min_value:
+            bucket = 0
+        else:
+            bucket = int(math.log2(value / self.min_value)) + 1
+        self.buckets[min(bucket, len(self.buckets) - 1)] += 1
+
+    def merge(self, other: 'Histogram') -> None:
+        """
+        Adds the samples of `other`, which must have the same buckets.
+        """
+        assert self.min_value == other.min_value and \
+            len(self.buckets) == len(other.buckets), "Incompatible histograms"
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for bucket, bucket_count in enumerate(other.buckets):
+            self.buckets[bucket] += bucket_count
+
+    def bucket_upper_bound(self, bucket: int) -> float:
+        return self.min_value * (2 ** bucket)
+
+    def percentile(self, percentile: float) -> float:
+        """
+        Returns an upper bound of the given percentile (the upper edge of the
+        bucket that contains it, capped by the largest sample).
+        """
+        if self.count == 0:
+            return 0.0
+        target = percentile / 100.0 * self.count
+        seen = 0
+        for bucket, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= target and bucket_count > 0:
+                return min(self.bucket_upper_bound(bucket), self.max)
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': {
+                str(self.bucket_upper_bound(i)): c
+                for i, c in enumerate(self.buckets) if c > 0
+            },
+        }
+
+
+class Profiler(object):
+    """ Opt-in timing for the workspace calls made by trainers and predictors.
+    When disabled, every method is a thin pass-through to `workspace`.
+
+    Times are in seconds.  Per-operator timings come from Caffe2's net
+    benchmarking and are in milliseconds, as reported by Caffe2.
+
+    Calls go to the current workspace unless `ws` is set to another object
+    with the same FeedBlob / FetchBlob / RunNet / CreateNet methods, e.g. an
+    `InstanceWorkspace`.
+    """
+
+    def __init__(self, enabled: bool = False, ws=None) -> None:
+        self.enabled = enabled
+        self.ws = ws if ws is not None else workspace
+        self.reset()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        self.net_times: Dict[str, Histogram] = collections.defaultdict(Histogram)
+        self.feed_times: Dict[str, Histogram] = collections.defaultdict(Histogram)
+        self.fetch_times: Dict[str, Histogram] = collections.defaultdict(
+            Histogram
+        )
+        self.feed_bytes: Dict[str, int] = collections.defaultdict(int)
+        self.fetch_bytes: Dict[str, int] = collections.defaultdict(int)
+        self.operator_times: Dict[str, Dict[str, float]] = {}
+
+    def run_net(self, name: str, net) -> None:
+        """
+        Runs an already created net, recording its wall time under `name`.
+        """
+        if not self.enabled:
+            self.ws.RunNet(net)
+            return
+        start = time.perf_counter()
+        self.ws.RunNet(net)
+        self.net_times[name].add(time.perf_counter() - start)
+
+    def feed_blob(self, name: str, value: np.ndarray) -> None:
+        if not self.enabled:
+            self.ws.FeedBlob(name, value)
+            return
+        start = time.perf_counter()
+        self.ws.FeedBlob(name, value)
+        self.feed_times[str(name)].add(time.perf_counter() - start)
+        self.feed_bytes[str(name)] += getattr(value, 'nbytes', 0)
+
+    def fetch_blob(self, name: str) -> np.ndarray:
+        if not self.enabled:
+            return self.ws.FetchBlob(name)
+        start = time.perf_counter()
+        value = self.ws.FetchBlob(name)
+        self.fetch_times[str(name)].add(time.perf_counter() - start)
+        self.fetch_bytes[str(name)] += getattr(value, 'nbytes', 0)
+        return value
+
+    def benchmark_net(
+        self,
+        name: str,
+        net,
+        warmup_runs: int = 1,
+        main_runs: int = 10,
+    ) -> Dict[str, float]:
+        """
+        Benchmarks every operator of an already created net and stores the
+        average time per run, summed by operator type, under `name`.  Note that
+        benchmarking a training net also runs its parameter updates.
+        """
+        net_proto = net.Proto() if isinstance(net, core.Net) else net
+        results = workspace.BenchmarkNet(
+            net_proto.name, warmup_runs, main_runs, True
+        )
+        # First entry is the time of the whole net, then one entry per op
+        operator_times: Dict[str, float] = collections.defaultdict(float)
+        operator_times['__net__'] = float(results[0])
+        for op, op_time in zip(net_proto.op, results[1:]):
+            operator_times[op.type] += float(op_time)
+        self.operator_times[name] = dict(operator_times)
+        return self.operator_times[name]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'nets': {k: v.to_dict() for k, v in self.net_times.items()},
+            'feed': {
+                k: dict(v.to_dict(), bytes=self.feed_bytes[k])
+                for k, v in self.feed_times.items()
+            },
+            'fetch': {
+                k: dict(v.to_dict(), bytes=self.fetch_bytes[k])
+                for k, v in self.fetch_times.items()
+            },
+            'operators': self.operator_times,
+        }
+
+    def to_json(self, path: Optional[str] = None) -> str:
+        """
+        Returns the summary as a JSON string, also writing it to `path` if
+        given.
+        """
+        summary_json = json.dumps(self.summary(), indent=2, sort_keys=True)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(summary_json)
+        return summary_json
+
+    def log_summary(self) -> None:
+        lines: List[str] = []
+        for name, histogram in sorted(self.net_times.items()):
+            lines.append(
+                "{}: {} runs, {:.6f}s mean".format(
+                    name, histogram.count, histogram.total / histogram.count
+                )
+            )
+        logger.info("Net timings:\n" + "\n".join(lines))
+
+
+class LatencyTracker(object):
+    """ Opt-in breakdown of where the time of each predictor call goes.
+    A call is split into stages (building input arrays from dicts, feeding,
+    running the net, fetching, decoding outputs) by `mark` calls, and each
+    stage's time is kept per method and batch-size bucket.  Percentiles are
+    computed over the last `window` calls of each bucket.
+
+    Calls made from inside another tracked call (e.g. `predict` calling
+    `predict_array`) count toward the outer call only.  Times are in seconds.
+    """
+
+    def __init__(self, enabled: bool = False, window: int = 1000) -> None:
+        self.enabled = enabled
+        self.window = window
+        self._active: Optional[Dict[str, float]] = None
+        self._last_mark = 0.0
+        self.reset()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        # (method, batch size bucket) -> stage -> recent times
+        self.samples: Dict[Any, Dict[str, collections.deque]] = {}
+
+    @staticmethod
+    def batch_size_bucket(batch_size: int) -> int:
+        """
+        The smallest power of two that is at least `batch_size`.
+        """
+        return 1 << max(batch_size - 1, 0).bit_length()
+
+    @contextlib.contextmanager
+    def call(self, method: str, batch_size: int):
+        if not self.enabled or self._active is not None:
+            yield
+            return
+        start = time.perf_counter()
+        self._active = collections.defaultdict(float)
+        self._last_mark = start
+        try:
+            yield
+            stage_times = self._active
+            stage_times['total'] = time.perf_counter() - start
+            self._record(method, batch_size, stage_times)
+        finally:
+            self._active = None
+
+    def mark(self, stage: str) -> None:
+        """
+        Ends `stage` of the current call: the time since the previous mark (or
+        the start of the call) is added to it.
+        """
+        if self._active is None:
+            return
+        now = time.perf_counter()
+        self._active[stage] += now - self._last_mark
+        self._last_mark = now
+
+    def _record(self, method, batch_size, stage_times) -> None:
+        key = (method, self.batch_size_bucket(batch_size))
+        stages = self.samples.get(key)
+        if stages is None:
+            stages = self.samples[key] = {}
+        for stage, stage_time in stage_times.items():
+            if stage not in stages:
+                stages[stage] = collections.deque(maxlen=self.window)
+            stages[stage].append(stage_time)
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        {method: {batch size bucket: {stage: {count, mean, p50, p95, p99}}}}
+        """
+        summary: Dict[str, Any] = collections.defaultdict(dict)
+        for (method, bucket), stages in sorted(self.samples.items()):
+            bucket_summary = {}
+            for stage, times in stages.items():
+                values = np.array(times)
+                p50, p95, p99 = np.percentile(values, [50, 95, 99])
+                bucket_summary[stage] = {
+                    'count': len(values),
+                    'mean': float(values.mean()),
+                    'p50': float(p50),
+                    'p95': float(p95),
+                    'p99': float(p99),
+                }
+            summary[method][str(bucket)] = bucket_summary
+        return dict(summary)
+
+    def to_json(self, path: Optional[str] = None) -> str:
+        """
+        Returns the summary as a JSON string, also writing it to `path` if
+        given.
+        """
+        summary_json = json.dumps(self.summary(), indent=2, sort_keys=True)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(summary_json)
+        return summary_json
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Serves a saved predictor:
+
+    python -m ml.rl.serving --model db_path --db-type minidb --workers 4 \
+        --unix-socket /tmp/predictor.sock
+
+See `ml.rl.serving.client` for a client and load generator.
+"""
+
+import argparse
+import logging
+import signal
+import sys
+
+from ml.rl.serving.server import PredictionServer
+from ml.rl.training.continuous_action_dqn_predictor import \
+    ContinuousActionDQNPredictor
+from ml.rl.training.discrete_action_predictor import DiscreteActionPredictor
+
+logger = logging.getLogger(__name__)
+
+PREDICTOR_CLASSES = {
+    'discrete': DiscreteActionPredictor,
+    'parametric': ContinuousActionDQNPredictor,
+}
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="Serve predict/policy requests for a saved model."
+    )
+    parser.add_argument("--model", required=True, help="Path of the model db.")
+    parser.add_argument("--db-type", default="minidb", help="Type of the db.")
+    parser.add_argument(
+        "--model-type",
+        choices=sorted(PREDICTOR_CLASSES.keys()),
+        default='discrete',
+    )
+    parser.add_argument(
+        "--int-features",
+        action="store_true",
+        help="The model takes int_features input blobs.",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=1, help="Worker processes."
+    )
+    parser.add_argument("--unix-socket", help="Path of the socket to serve.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, default=None, help="TCP port to serve."
+    )
+    args = parser.parse_args(args)
+    if args.unix_socket is not None:
+        address = args.unix_socket
+    elif args.port is not None:
+        address = (args.host, args.port)
+    else:
+        parser.error("One of --unix-socket or --port is required")
+
+    predictor = PREDICTOR_CLASSES[args.model_type].load(
+        args.model, args.db_type, args.int_features
+    )
+    server = PredictionServer(predictor, address)
+    server.start_workers(args.workers)
+
+    def shutdown(signum, frame):
+        server.stop()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    server.wait()
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
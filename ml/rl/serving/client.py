@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""
+Client for the prediction server, and a load generator for benchmarking it:
+
+    python -m ml.rl.serving.client --unix-socket /tmp/predictor.sock \
+        --num-features 10 --clients 8 --requests 1000
+"""
+
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+
+from ml.rl.profiler import Histogram
+from ml.rl.serving import protocol
+from ml.rl.serving.server import Address
+from ml.rl.training.rl_predictor import sparse_features
+
+
+def connect(address: Address) -> socket.socket:
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.connect(address)
+    return sock
+
+
+class PredictionClient(object):
+    """
+    One connection to a PredictionServer, with the predictor's `predict`,
+    `predict_array` and `policy` methods.  Not safe to share between threads.
+    """
+
+    def __init__(self, address: Address) -> None:
+        self.socket = connect(address)
+
+    def close(self) -> None:
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _call(self, method, float_state_features, int_state_features):
+        protocol.write_frame(
+            self.socket,
+            protocol.encode_request(
+                method,
+                sparse_features(float_state_features, np.float32),
+                None if int_state_features is None else
+                sparse_features(int_state_features, np.int32),
+            )
+        )
+        payload = protocol.read_frame(self.socket)
+        if payload is None:
+            raise ConnectionError("Server closed the connection")
+        return protocol.decode_response(payload)
+
+    def predict_array(self, float_state_features, int_state_features=None):
+        return self._call(
+            protocol.METHOD_PREDICT_ARRAY, float_state_features,
+            int_state_features
+        )
+
+    def predict(self, float_state_features, int_state_features=None):
+        q_values, action_names = self.predict_array(
+            float_state_features, int_state_features
+        )
+        return [dict(zip(action_names, row)) for row in q_values]
+
+    def policy(self, float_state_features, int_state_features=None):
+        """ Returns [a1_maxq, a1_softmax, a2_maxq, a2_softmax, ...], see
+        `RLPredictor.policy`.  For parametric models, put the action features
+        in the float state features.
+        """
+        return self._call(
+            protocol.METHOD_POLICY, float_state_features, int_state_features
+        )
+
+
+def run_load(
+    address: Address,
+    states: List[Dict[int, float]],
+    num_clients: int = 4,
+    num_requests: int = 1000,
+    batch_size: int = 1,
+    method: str = 'predict_array',
+) -> Dict[str, Any]:
+    """
+    Sends `num_requests` requests of `batch_size` states from each of
+    `num_clients` connections at once, and returns the throughput and the
+    request latencies in seconds.
+    """
+    latencies = Histogram()
+    lock = threading.Lock()
+    errors: List[Exception] = []
+
+    def client_loop(seed):
+        rng = np.random.RandomState(seed)
+        client_latencies = Histogram()
+        try:
+            with PredictionClient(address) as client:
+                call = getattr(client, method)
+                for _ in range(num_requests):
+                    batch = [
+                        states[i] for i in
+                        rng.randint(0, len(states), size=batch_size)
+                    ]
+                    start = time.perf_counter()
+                    call(batch)
+                    client_latencies.add(time.perf_counter() - start)
+        except Exception as e:
+            errors.append(e)
+        with lock:
+            latencies.merge(client_latencies)
+
+    threads = [
+        threading.Thread(target=client_loop, args=(seed, ))
+        for seed in range(num_clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if len(errors) > 0:
+        raise errors[0]
+    return {
+        'requests_per_second': latencies.count / elapsed,
+        'states_per_second': latencies.count * batch_size / elapsed,
+        'latency': latencies.to_dict(),
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="Send synthetic load to a prediction server."
+    )
+    parser.add_argument("--unix-socket", help="Path of the server socket.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument(
+        "--num-features",
+        type=int,
+        default=10,
+        help="Number of float features, with ids 0..num-features-1, per state."
+    )
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument(
+        "--method", choices=['predict_array', 'policy'], default='predict_array'
+    )
+    args = parser.parse_args(args)
+    if args.unix_socket is not None:
+        address: Address = args.unix_socket
+    elif args.port is not None:
+        address = (args.host, args.port)
+    else:
+        parser.error("One of --unix-socket or --port is required")
+
+    rng = np.random.RandomState(0)
+    states = [
+        dict(enumerate(rng.randn(args.num_features).astype(float)))
+        for _ in range(1000)
+    ]
+    results = run_load(
+        address, states, args.clients, args.requests, args.batch_size,
+        args.method
+    )
+    print(json.dumps(results, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
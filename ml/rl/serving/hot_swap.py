@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""
+Replaces the model behind a serving process without stopping traffic.  New
+models load into their own PredictorPool, so requests keep running against
+the old model's workspaces during the load and warm-up, and then switch to
+the new model with a single reference assignment.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from ml.rl.serving.predictor_pool import PredictorPool
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def resident_bytes() -> Optional[int]:
+    """
+    Resident memory of this process, or None where /proc is unavailable.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _delta(after: Optional[int], before: Optional[int]) -> Optional[int]:
+    if after is None or before is None:
+        return None
+    return after - before
+
+
+class HotSwapManager(object):
+    def __init__(
+        self,
+        predictor_class,
+        num_instances: int = 1,
+        int_features: bool = False,
+        warmup_states: Optional[List[Dict[int, float]]] = None,
+        cache_entries: int = 0,
+        cache_ttl: Optional[float] = None,
+    ) -> None:
+        """
+        :param predictor_class: DiscreteActionPredictor or
+            ContinuousActionDQNPredictor
+        :param num_instances: Predictors per model, see PredictorPool
+        :param int_features: Whether int_features blobs will be present
+        :param warmup_states: Float feature examples every new predictor runs
+            before it takes traffic.  For parametric models, include the
+            action features.
+        :param cache_entries: If positive, every predictor caches this many
+            states (see `RLPredictor.enable_cache`).  Each model starts with
+            empty caches, so a swap never serves the old model's values.
+        :param cache_ttl: Seconds a cached state stays valid, or None
+        """
+        self.predictor_class = predictor_class
+        self.num_instances = num_instances
+        self.int_features = int_features
+        self.warmup_states = warmup_states
+        self.cache_entries = cache_entries
+        self.cache_ttl = cache_ttl
+        self.generation = 0
+        self.last_swap: Dict[str, Any] = {}
+        self._pool: Optional[PredictorPool] = None
+        # Loads run one at a time, so that the model swapped in last is the
+        #     one loaded last, generations are numbered in swap order, and two
+        #     models are never loaded into memory at once
+        self._load_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def pool(self) -> PredictorPool:
+        pool = self._pool
+        if pool is None:
+            raise RuntimeError("No model loaded")
+        return pool
+
+    def load(self, db_path: str, db_type: str) -> Dict[str, Any]:
+        """
+        Loads and warms up the model at `db_path`, then sends all new requests
+        to it.  Requests already running finish on the old model, whose
+        workspaces are freed when the last of them returns.  Returns load
+        time, warm-up time and resident memory deltas.
+        """
+        with self._load_lock:
+            rss_before = resident_bytes()
+            start = time.perf_counter()
+            pool = PredictorPool(
+                db_path, db_type, self.num_instances, self.predictor_class,
+                self.int_features
+            )
+            load_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            if self.warmup_states:
+                pool.warm_up(self.warmup_states)
+            warmup_seconds = time.perf_counter() - start
+            if self.cache_entries > 0:
+                pool.enable_cache(self.cache_entries, self.cache_ttl)
+            rss_loaded = resident_bytes()
+
+            old_pool = self._pool
+            self._pool = pool
+            self.generation += 1
+            del old_pool
+            stats = {
+                'db_path': db_path,
+                'generation': self.generation,
+                'load_seconds': load_seconds,
+                'warmup_seconds': warmup_seconds,
+                'loaded_rss_delta_bytes': _delta(rss_loaded, rss_before),
+                'rss_delta_bytes': _delta(resident_bytes(), rss_before),
+            }
+            self.last_swap = stats
+        logger.info("Swapped in model: {}".format(stats))
+        return stats
+
+    def load_async(self, db_path: str, db_type: str) -> Future:
+        """
+        Runs `load` on a background thread, returning a Future for its stats.
+        """
+        return self._executor.submit(self.load, db_path, db_type)
+
+    def predict(self, *args, **kwargs):
+        return self.pool.predict(*args, **kwargs)
+
+    def predict_array(self, *args, **kwargs):
+        return self.pool.predict_array(*args, **kwargs)
+
+    def policy(self, *args, **kwargs):
+        return self.pool.policy(*args, **kwargs)
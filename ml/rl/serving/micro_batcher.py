@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""
+Coalesces single-state requests from concurrent callers into batched
+predictor calls.  Each call pays the feed / run / fetch overhead once, so
+serving one state at a time costs almost as much as serving a few dozen.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+
+from ml.rl.profiler import Histogram
+
+import logging
+logger = logging.getLogger(__name__)
+
+BATCHED_METHODS = ('policy', 'predict', 'predict_array')
+
+
+class _Request(object):
+    __slots__ = ['float_state', 'int_state', 'future', 'submit_time']
+
+    def __init__(self, float_state, int_state) -> None:
+        self.float_state = float_state
+        self.int_state = int_state
+        self.future: Future = Future()
+        self.submit_time = time.perf_counter()
+
+
+def _split(method: str, result, batch_size: int) -> List:
+    """
+    Splits the result of one batched predictor call into one result per state.
+    """
+    if method == 'policy':
+        # [a1_maxq, a1_softmax, a2_maxq, a2_softmax, ...]
+        return list(result.reshape(batch_size, -1))
+    if method == 'predict_array':
+        q_values, action_names = result
+        return [(row, action_names) for row in q_values]
+    return list(result)
+
+
+class MicroBatcher(object):
+    def __init__(
+        self,
+        predictor,
+        method: str = 'policy',
+        max_batch_size: int = 32,
+        max_wait: float = 0.002,
+        num_threads: int = 1,
+    ) -> None:
+        """
+        Starts background threads that take submitted states off a queue and
+        run them through `predictor` in batches.  A batch is dispatched once it
+        has `max_batch_size` states, or `max_wait` seconds after its first
+        state arrived, whichever comes first.  Requests that arrive while a
+        batch runs are queued, so batches grow with load and stay small when
+        traffic is light.
+
+        :param predictor: An RLPredictor, or a PredictorPool when
+            `num_threads` > 1
+        :param method: Predictor method to batch, one of BATCHED_METHODS
+        :param max_batch_size: Largest number of states per predictor call
+        :param max_wait: Longest time in seconds a request waits for others to
+            join its batch
+        :param num_threads: Number of batches that can run at the same time
+        """
+        assert method in BATCHED_METHODS, \
+            "method must be one of {}".format(BATCHED_METHODS)
+        assert max_batch_size > 0, "max_batch_size must be positive"
+        self.predictor = predictor
+        self.method = method
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._requests: queue.Queue = queue.Queue()
+        self._closed = False
+        # Held while checking `_closed` and queueing, so no request can be
+        #     queued behind the stop sentinels and never served
+        self._submit_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self.batch_sizes = Histogram(min_value=1)
+        self.queue_depths = Histogram(min_value=1)
+        self.queue_times = Histogram()
+
+        self._threads = [
+            threading.Thread(
+                target=self._serve, name='micro_batcher_{}'.format(i)
+            ) for i in range(num_threads)
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(
+        self,
+        float_state_features: Dict[int, float],
+        int_state_features: Optional[Dict[int, int]] = None,
+    ) -> Future:
+        """
+        Queues one state and returns a Future for its result: the state's row
+        of `policy`, its {action: value} dict from `predict`, or a
+        (values, action names) pair from `predict_array`.
+        """
+        request = _Request(float_state_features, int_state_features)
+        with self._submit_lock:
+            if self._closed:
+                raise RuntimeError("MicroBatcher is closed")
+            self._requests.put(request)
+        return request.future
+
+    def call(
+        self,
+        float_state_features: Dict[int, float],
+        int_state_features: Optional[Dict[int, int]] = None,
+        timeout: Optional[float] = None,
+    ):
+        """
+        Submits one state and blocks until its result is ready.
+        """
+        return self.submit(float_state_features,
+                           int_state_features).result(timeout)
+
+    async def submit_async(
+        self,
+        float_state_features: Dict[int, float],
+        int_state_features: Optional[Dict[int, int]] = None,
+    ):
+        """
+        Submits one state from a coroutine, without blocking the event loop.
+        """
+        return await asyncio.wrap_future(
+            self.submit(float_state_features, int_state_features)
+        )
+
+    def close(self) -> None:
+        """
+        Stops accepting requests, serves the ones already queued and stops the
+        background threads.
+        """
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+            for _ in self._threads:
+                self._requests.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                'batch_size': self.batch_sizes.to_dict(),
+                'queue_depth': self.queue_depths.to_dict(),
+                'queue_time': self.queue_times.to_dict(),
+            }
+
+    def _next_batch(self):
+        """
+        Blocks for the first request, then collects more until the batch is
+        full or `max_wait` has passed.  Returns the batch and whether the
+        batcher was closed while collecting it.
+        """
+        first = self._requests.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    request = self._requests.get(timeout=remaining)
+                else:
+                    request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _serve(self) -> None:
+        closed = False
+        while not closed:
+            batch, closed = self._next_batch()
+            batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+            if len(batch) > 0:
+                self._run_batch(batch)
+
+    def _run_batch(self, batch: List[_Request]) -> None:
+        dispatch_time = time.perf_counter()
+        with self._stats_lock:
+            self.batch_sizes.add(len(batch))
+            self.queue_depths.add(self._requests.qsize())
+            for request in batch:
+                self.queue_times.add(dispatch_time - request.submit_time)
+
+        float_states = [r.float_state for r in batch]
+        int_states = None
+        if any(r.int_state is not None for r in batch):
+            int_states = [
+                r.int_state if r.int_state is not None else {} for r in batch
+            ]
+        try:
+            result = getattr(self.predictor, self.method)(
+                float_states, int_states
+            )
+            results = _split(self.method, result, len(batch))
+        except Exception as e:
+            logger.exception("Batched {} call failed".format(self.method))
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        for request, request_result in zip(batch, results):
+            request.future.set_result(request_result)
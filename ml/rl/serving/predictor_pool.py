@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+"""
+Serves one saved model from several threads.  Predictors feed and fetch
+fixed blob names such as 'input/float_features.values', so two of them cannot
+run in the same workspace at once.  A PredictorPool gives each instance its
+own Caffe2 workspace for inputs, intermediate blobs and outputs, while the
+model parameters are loaded once into a parent workspace that every instance
+reads from.
+"""
+
+import contextlib
+import queue
+from typing import List
+
+import numpy as np
+
+from caffe2.proto import metanet_pb2
+from caffe2.python import core, workspace
+from caffe2.python.predictor_constants import predictor_constants
+from caffe2.python.predictor.predictor_py_utils import GetBlobs, GetNet
+
+from ml.rl.training.rl_predictor import RLPredictor, sparse_features
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class InstanceWorkspace(object):
+    """
+    The part of the `workspace` module API that predictors use, bound to one
+    Caffe2 workspace object instead of the current workspace.  Running a net
+    releases the GIL, so instances in different threads run in parallel.
+    """
+
+    def __init__(self, ws) -> None:
+        self.ws = ws
+
+    def FeedBlob(self, name, value) -> None:
+        self.ws.create_blob(str(name)).feed(value)
+
+    def FetchBlob(self, name) -> np.ndarray:
+        return self.ws.blobs[str(name)].fetch()
+
+    def HasBlob(self, name) -> bool:
+        return str(name) in self.ws.blobs
+
+    def CreateNet(self, net) -> None:
+        self.ws.create_net(net, True)
+
+    def RunNet(self, net) -> None:
+        if hasattr(net, 'Proto'):
+            name = net.Proto().name
+        elif hasattr(net, 'name'):
+            name = net.name
+        else:
+            name = str(net)
+        self.ws.nets[name].run()
+
+
+def _placeholder(name: str) -> np.ndarray:
+    """
+    A value for an input blob so that the net can be created before the
+    first request feeds it.
+    """
+    if name.endswith('.lengths'):
+        return np.zeros(1, dtype=np.int32)
+    if name.endswith('.keys'):
+        return np.zeros(1, dtype=np.int64)
+    if name.startswith('input/int_features'):
+        return np.zeros(1, dtype=np.int32)
+    if name == 'input/image':
+        return np.zeros([1, 1, 1, 1], dtype=np.int32)
+    return np.zeros(1, dtype=np.float32)
+
+
+def _load_model(ws, db_path: str, db_type: str):
+    """
+    Loads the model saved at `db_path` into the workspace object `ws`, as
+    load_from_db and prepare_prediction_net do for the current workspace.
+    Returns the MetaNetDef and the predict NetDef.
+    """
+    ws.run(
+        core.CreateOperator(
+            'CreateDB', [], [predictor_constants.PREDICTOR_DBREADER],
+            db=db_path,
+            db_type=db_type
+        )
+    )
+    ws.run(
+        core.CreateOperator(
+            'Load', [predictor_constants.PREDICTOR_DBREADER],
+            [predictor_constants.META_NET_DEF]
+        )
+    )
+    serialized = ws.blobs[predictor_constants.META_NET_DEF].fetch()
+    if not isinstance(serialized, bytes):
+        serialized = str(serialized).encode('utf-8')
+    meta = metanet_pb2.MetaNetDef()
+    meta.ParseFromString(serialized)
+    ws.run(GetNet(meta, predictor_constants.GLOBAL_INIT_NET_TYPE))
+    ws.run(GetNet(meta, predictor_constants.PREDICT_INIT_NET_TYPE))
+    return meta, GetNet(meta, predictor_constants.PREDICT_NET_TYPE)
+
+
+def _child_workspace(parent):
+    """
+    A workspace that reads the blobs of `parent` without copying them.
+    Builds whose Workspace cannot be constructed from a parent get a copy.
+    """
+    try:
+        return workspace.C.Workspace(parent)
+    except TypeError:
+        logger.warning(
+            "Workspace sharing is unavailable, copying parameters per instance"
+        )
+        child = workspace.C.Workspace()
+        for name, blob in parent.blobs.items():
+            child.create_blob(name).feed(blob.fetch())
+        return child
+
+
+class PredictorPool(object):
+    def __init__(
+        self,
+        db_path: str,
+        db_type: str,
+        num_instances: int,
+        predictor_class,
+        int_features: bool = False,
+    ) -> None:
+        """
+        Loads the model saved at `db_path` once and creates `num_instances`
+        predictors that can run concurrently.
+
+        :param db_path: see load_from_db
+        :param db_type: see load_from_db
+        :param num_instances: Number of predictors, i.e. the number of
+            requests that can run at the same time
+        :param predictor_class: DiscreteActionPredictor or
+            ContinuousActionDQNPredictor
+        :param int_features: Whether int_features blobs will be present
+        """
+        assert num_instances > 0, "A pool needs at least one instance"
+        assert issubclass(predictor_class, RLPredictor), \
+            "PredictorPool serves RLPredictor subclasses"
+        # A private workspace object, so that loading leaves the current
+        #     workspace alone, e.g. when HotSwapManager loads on its thread
+        loading_workspace = workspace.C.Workspace()
+        meta, net_proto = _load_model(loading_workspace, db_path, db_type)
+        parameters = GetBlobs(meta, predictor_constants.PARAMETERS_BLOB_TYPE)
+        written = {output for op in net_proto.op for output in op.output}
+        # Blobs the net writes, even if they are parameters (e.g. filled
+        #     constants), must belong to each instance.
+        self.shared_parameters = [p for p in parameters if p not in written]
+        local_parameters = {
+            p: loading_workspace.blobs[p].fetch()
+            for p in parameters if p in written
+        }
+        self._parameter_workspace = workspace.C.Workspace()
+        for parameter in self.shared_parameters:
+            self._parameter_workspace.create_blob(parameter).feed(
+                loading_workspace.blobs[parameter].fetch()
+            )
+        del loading_workspace
+
+        shared = set(self.shared_parameters)
+        self.num_instances = num_instances
+        self._instances: List = []
+        self._available: queue.Queue = queue.Queue()
+        for _ in range(num_instances):
+            ws = InstanceWorkspace(
+                _child_workspace(self._parameter_workspace)
+            )
+            for name, value in local_parameters.items():
+                ws.FeedBlob(name, value)
+            for name in net_proto.external_input:
+                if name not in shared and not ws.HasBlob(name):
+                    ws.FeedBlob(name, _placeholder(name))
+            ws.CreateNet(net_proto)
+            predictor = predictor_class(net_proto, parameters, int_features)
+            predictor.use_workspace(ws)
+            self._instances.append(predictor)
+            self._available.put(predictor)
+
+    def warm_up(self, float_state_features) -> None:
+        """
+        Runs every instance on the given examples, so that the first requests
+        do not pay for net creation and buffer allocation.  Int feature
+        inputs, if any, keep their placeholder values.
+        """
+        float_features = sparse_features(float_state_features, np.float32)
+        for predictor in self._instances:
+            predictor.predict_array_sparse(float_features)
+            predictor.policy_sparse(float_features)
+
+    def enable_cache(self, max_entries=10000, ttl=None) -> None:
+        """
+        Gives every instance its own result cache, see
+        `RLPredictor.enable_cache`.
+        """
+        for predictor in self._instances:
+            predictor.enable_cache(max_entries, ttl)
+
+    @contextlib.contextmanager
+    def instance(self, timeout=None):
+        """
+        Checks out a predictor for the duration of a `with` block, waiting up
+        to `timeout` seconds (forever if None) for one to be free.
+        """
+        predictor = self._available.get(timeout=timeout)
+        try:
+            yield predictor
+        finally:
+            self._available.put(predictor)
+
+    def predict(self, *args, **kwargs):
+        with self.instance() as predictor:
+            return predictor.predict(*args, **kwargs)
+
+    def predict_array(self, *args, **kwargs):
+        with self.instance() as predictor:
+            return predictor.predict_array(*args, **kwargs)
+
+    def policy(self, *args, **kwargs):
+        with self.instance() as predictor:
+            return predictor.policy(*args, **kwargs)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+"""
+Binary framing used by the prediction server and client.
+
+Every message is a frame: a little-endian uint32 payload size followed by the
+payload.  States travel as the (lengths, keys, values) arrays the predictor
+net takes as input, so neither side builds per-feature Python objects:
+
+    request:  uint8 method, uint8 has_int_features, uint32 num_states,
+              uint32 num_float_values, [uint32 num_int_values],
+              int32 lengths[num_states], int64 keys[], float32 values[],
+              then the same arrays for int features (int32 values)
+    response: uint8 status, then
+              VALUES: uint32 rows, uint32 columns, float32 values[rows *
+                      columns], strings (action names)
+              POLICY: strings (two action names per state)
+              ERROR:  utf-8 message
+
+Strings are sent as a uint32 count, uint32 byte lengths[count] and the
+concatenated utf-8 bytes.
+"""
+
+import socket
+import struct
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+METHOD_PREDICT_ARRAY = 0
+METHOD_POLICY = 1
+
+STATUS_VALUES = 0
+STATUS_POLICY = 1
+STATUS_ERROR = 2
+
+_SIZE = struct.Struct('<I')
+_REQUEST_HEADER = struct.Struct('<BBII')
+_STATUS = struct.Struct('<B')
+_SHAPE = struct.Struct('<II')
+
+SparseFeatures = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> Optional[bytearray]:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            return None
+        received += count
+    return buffer
+
+
+def read_frame(sock: socket.socket) -> Optional[bytearray]:
+    """
+    Returns the next payload, or None if the peer closed the connection.
+    """
+    header = _recv_exactly(sock, _SIZE.size)
+    if header is None:
+        return None
+    payload = _recv_exactly(sock, _SIZE.unpack(header)[0])
+    if payload is None:
+        raise ConnectionError("Connection closed in the middle of a frame")
+    return payload
+
+
+def write_frame(sock: socket.socket, parts: List[bytes]) -> None:
+    sock.sendall(
+        b''.join([_SIZE.pack(sum(len(p) for p in parts))] + list(parts))
+    )
+
+
+def encode_request(
+    method: int,
+    float_features: SparseFeatures,
+    int_features: Optional[SparseFeatures] = None,
+) -> List[bytes]:
+    lengths, keys, values = float_features
+    parts = [
+        _REQUEST_HEADER.pack(
+            method, int_features is not None, len(lengths), len(values)
+        )
+    ]
+    if int_features is not None:
+        parts.append(_SIZE.pack(len(int_features[2])))
+    parts.extend(
+        [
+            np.ascontiguousarray(lengths, dtype='<i4').tobytes(),
+            np.ascontiguousarray(keys, dtype='<i8').tobytes(),
+            np.ascontiguousarray(values, dtype='<f4').tobytes(),
+        ]
+    )
+    if int_features is not None:
+        lengths, keys, values = int_features
+        parts.extend(
+            [
+                np.ascontiguousarray(lengths, dtype='<i4').tobytes(),
+                np.ascontiguousarray(keys, dtype='<i8').tobytes(),
+                np.ascontiguousarray(values, dtype='<i4').tobytes(),
+            ]
+        )
+    return parts
+
+
+def decode_request(
+    payload
+) -> Tuple[int, SparseFeatures, Optional[SparseFeatures]]:
+    """
+    Returns the method and the float and int features.  Arrays are views of
+    `payload`.
+    """
+    method, has_int_features, num_states, num_float_values = \
+        _REQUEST_HEADER.unpack_from(payload)
+    offset = _REQUEST_HEADER.size
+    num_int_values = 0
+    if has_int_features:
+        num_int_values = _SIZE.unpack_from(payload, offset)[0]
+        offset += _SIZE.size
+
+    def take(dtype, count):
+        nonlocal offset
+        array = np.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+        offset += array.nbytes
+        return array
+
+    float_features = (
+        take('<i4', num_states),
+        take('<i8', num_float_values),
+        take('<f4', num_float_values),
+    )
+    int_features = None
+    if has_int_features:
+        int_features = (
+            take('<i4', num_states),
+            take('<i8', num_int_values),
+            take('<i4', num_int_values),
+        )
+    return method, float_features, int_features
+
+
+def _encode_strings(strings) -> List[bytes]:
+    encoded = [
+        s if isinstance(s, bytes) else str(s).encode('utf-8') for s in strings
+    ]
+    return [
+        _SIZE.pack(len(encoded)),
+        np.array([len(s) for s in encoded], dtype='<u4').tobytes(),
+        b''.join(encoded),
+    ]
+
+
+def _decode_strings(payload, offset: int) -> List[str]:
+    count = _SIZE.unpack_from(payload, offset)[0]
+    offset += _SIZE.size
+    sizes = np.frombuffer(payload, dtype='<u4', count=count, offset=offset)
+    offset += sizes.nbytes
+    strings = []
+    for size in sizes:
+        strings.append(bytes(payload[offset:offset + size]).decode('utf-8'))
+        offset += size
+    return strings
+
+
+def encode_values(q_values: np.ndarray, action_names) -> List[bytes]:
+    q_values = np.ascontiguousarray(q_values, dtype='<f4')
+    return [
+        _STATUS.pack(STATUS_VALUES),
+        _SHAPE.pack(*q_values.shape),
+        q_values.tobytes(),
+    ] + _encode_strings(action_names)
+
+
+def encode_policy(actions) -> List[bytes]:
+    return [_STATUS.pack(STATUS_POLICY)] + _encode_strings(actions)
+
+
+def encode_error(message: str) -> List[bytes]:
+    return [_STATUS.pack(STATUS_ERROR), message.encode('utf-8')]
+
+
+def decode_response(payload):
+    """
+    Returns (values, action names) for a VALUES response and the list of
+    actions for a POLICY response.  Raises RuntimeError with the server's
+    message for an ERROR response.
+    """
+    status = _STATUS.unpack_from(payload)[0]
+    offset = _STATUS.size
+    if status == STATUS_ERROR:
+        raise RuntimeError(bytes(payload[offset:]).decode('utf-8'))
+    if status == STATUS_POLICY:
+        return _decode_strings(payload, offset)
+    if status != STATUS_VALUES:
+        raise ValueError("Unknown response status {}".format(status))
+    rows, columns = _SHAPE.unpack_from(payload, offset)
+    offset += _SHAPE.size
+    q_values = np.frombuffer(
+        payload, dtype='<f4', count=rows * columns, offset=offset
+    ).reshape(rows, columns)
+    offset += q_values.nbytes
+    return q_values, _decode_strings(payload, offset)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""
+Serves a loaded predictor over a Unix or TCP socket, see `protocol` for the
+wire format.  The parent process loads the model and opens the listening
+socket, then forks workers that accept connections from that socket.  Workers
+read the parameters the parent loaded through copy-on-write pages, so the
+model is in memory once no matter how many workers run.
+"""
+
+import os
+import signal
+import socket
+import threading
+from typing import List, Union, Tuple
+
+from ml.rl.serving import protocol
+
+import logging
+logger = logging.getLogger(__name__)
+
+Address = Union[str, Tuple[str, int]]
+
+
+def listen(address: Address, backlog: int = 128) -> socket.socket:
+    """
+    Opens a listening socket: a Unix socket if `address` is a path, a TCP
+    socket for a (host, port) pair.
+    """
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.unlink(address)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+class PredictionServer(object):
+    def __init__(self, predictor, address: Address) -> None:
+        """
+        :param predictor: RLPredictor to serve.  Its net must already be
+            created in the current workspace.
+        :param address: Path of a Unix socket, or a (host, port) pair.  Port 0
+            picks a free port, see `address`.
+        """
+        self.predictor = predictor
+        self.socket = listen(address)
+        self.address = self.socket.getsockname()
+        # The predictor feeds fixed blob names, so one request runs at a time
+        #     per process.  Use more workers for more parallelism.
+        self._lock = threading.Lock()
+        self._worker_pids: List[int] = []
+
+    def start_workers(self, num_workers: int) -> None:
+        """
+        Forks `num_workers` processes that serve connections until `stop` is
+        called.
+        """
+        for _ in range(num_workers):
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                try:
+                    self.serve_forever()
+                finally:
+                    os._exit(0)
+            self._worker_pids.append(pid)
+        logger.info(
+            "Serving {} with {} workers".format(self.address, num_workers)
+        )
+
+    def wait(self) -> None:
+        for pid in self._worker_pids:
+            os.waitpid(pid, 0)
+
+    def stop(self) -> None:
+        for pid in self._worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        self.wait()
+        self._worker_pids = []
+        self.socket.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def serve_forever(self) -> None:
+        """
+        Accepts connections in this process, serving each one on its own
+        thread.
+        """
+        while True:
+            connection, _ = self.socket.accept()
+            thread = threading.Thread(
+                target=self.serve_connection, args=(connection, )
+            )
+            thread.daemon = True
+            thread.start()
+
+    def serve_connection(self, connection: socket.socket) -> None:
+        with connection:
+            while True:
+                payload = protocol.read_frame(connection)
+                if payload is None:
+                    return
+                protocol.write_frame(connection, self.handle(payload))
+
+    def handle(self, payload) -> List[bytes]:
+        try:
+            method, float_features, int_features = \
+                protocol.decode_request(payload)
+            with self._lock:
+                if method == protocol.METHOD_PREDICT_ARRAY:
+                    q_values, action_names = \
+                        self.predictor.predict_array_sparse(
+                            float_features, int_features
+                        )
+                    return protocol.encode_values(q_values, action_names)
+                if method == protocol.METHOD_POLICY:
+                    return protocol.encode_policy(
+                        self.predictor.policy_sparse(
+                            float_features, int_features
+                        )
+                    )
+            raise ValueError("Unknown method {}".format(method))
+        except Exception as e:
+            logger.exception("Request failed")
+            return protocol.encode_error(str(e))
@@ -29,6 +29,9 @@ class Gridworld(GridworldBase):
         possible_next_actions: List[List[str]],
         reward_timelines: Optional[List[Dict[int, float]]],
         minibatch_size: int,
+        embed_enums: bool = False,
+        fused: bool = False,
+        sparse_states: bool = False,
     ) -> List[TrainingDataPage]:
         return self.preprocess_samples_discrete(
             states,
@@ -40,4 +43,7 @@ class Gridworld(GridworldBase):
             possible_next_actions,
             reward_timelines,
             minibatch_size,
+            embed_enums,
+            fused,
+            sparse_states,
         )
@@ -5,10 +5,10 @@ import collections
 import numpy as np
 import random
 from typing import Tuple, List, Dict, Optional
-from caffe2.python import core, workspace
 
-from ml.rl.caffe_utils import C2, StackedAssociativeArray
-from ml.rl.preprocessing.preprocessor_net import PreprocessorNet
+from ml.rl.caffe_utils import StackedAssociativeArray
+from ml.rl.preprocessing.preprocessor_net_cache import \
+    get_sparse_preprocessing_net
 from ml.rl.training.training_data_page import TrainingDataPage
 from ml.rl.test.utils import default_normalizer
 
@@ -22,6 +22,19 @@ S = 2  # Starting position
 G = 3  # Goal position
 
 
+def sparse_rows(matrix: np.ndarray) -> StackedAssociativeArray:
+    """
+    The non-zero entries of each row of a normalized matrix, as the (column,
+    value) pairs trainers with sparse_input take.
+    """
+    rows, columns = np.nonzero(matrix)
+    return StackedAssociativeArray(
+        np.bincount(rows, minlength=matrix.shape[0]).astype(np.int32),
+        columns.astype(np.int32),
+        matrix[rows, columns].astype(np.float32),
+    )
+
+
 class GridworldBase(object):
     """Implements a simple grid world, a domain often used as a very simple
     to solve benchmark for reinforcement learning algorithms, also see:
@@ -361,7 +374,14 @@ class GridworldBase(object):
         possible_next_actions: List[List[str]],
         reward_timelines: Optional[List[Dict[int, float]]],
         minibatch_size: int,
+        embed_enums: bool = False,
+        fused: bool = False,
+        sparse_states: bool = False,
     ) -> List[TrainingDataPage]:
+        """
+        Normalizes and shuffles the samples into minibatches.  With
+        sparse_states, states and next_states are stored as `sparse_rows`.
+        """
         # Shuffle
         if reward_timelines is None:
             merged = list(
@@ -384,26 +404,11 @@ class GridworldBase(object):
             states, actions, rewards, next_states, next_actions, \
                 is_terminals, possible_next_actions, reward_timelines = zip(*merged)
 
-        net = core.Net('gridworld_preprocessing')
-        C2.set_net(net)
-        preprocessor = PreprocessorNet(net, True)
-        saa = StackedAssociativeArray.from_dict_list(states, 'states')
-        state_matrix, _ = preprocessor.normalize_sparse_matrix(
-            saa.lengths,
-            saa.keys,
-            saa.values,
-            self.normalization,
-            'state_norm',
-        )
-        saa = StackedAssociativeArray.from_dict_list(next_states, 'next_states')
-        next_state_matrix, _ = preprocessor.normalize_sparse_matrix(
-            saa.lengths,
-            saa.keys,
-            saa.values,
-            self.normalization,
-            'next_state_norm',
+        preprocessing_net = get_sparse_preprocessing_net(
+            self.normalization, True, embed_enums, fused
         )
-        workspace.RunNetOnce(net)
+        states_ndarray = preprocessing_net.normalize(states)
+        next_states_ndarray = preprocessing_net.normalize(next_states)
         actions_one_hot = np.zeros(
             [len(actions), len(self.ACTIONS)], dtype=np.float32
         )
@@ -431,19 +436,22 @@ class GridworldBase(object):
         if reward_timelines is not None:
             reward_timelines = np.array(reward_timelines, dtype=np.object)
 
-        states_ndarray = workspace.FetchBlob(state_matrix)
-        next_states_ndarray = workspace.FetchBlob(next_state_matrix)
         tdps = []
         for start in range(0, states_ndarray.shape[0], minibatch_size):
             end = start + minibatch_size
             if end > states_ndarray.shape[0]:
                 break
+            page_states = states_ndarray[start:end]
+            page_next_states = next_states_ndarray[start:end]
+            if sparse_states:
+                page_states = sparse_rows(page_states)
+                page_next_states = sparse_rows(page_next_states)
             tdps.append(
                 TrainingDataPage(
-                    states=states_ndarray[start:end],
+                    states=page_states,
                     actions=actions_one_hot[start:end],
                     rewards=rewards[start:end],
-                    next_states=next_states_ndarray[start:end],
+                    next_states=page_next_states,
                     not_terminals=not_terminals[start:end],
                     next_actions=next_actions_one_hot[start:end],
                     possible_next_actions=possible_next_actions_mask[start:end],
@@ -5,10 +5,9 @@ import numpy as np
 import random
 from typing import Tuple, Dict, List
 
-from caffe2.python import core, workspace
-
-from ml.rl.caffe_utils import C2, StackedAssociativeArray, StackedArray
-from ml.rl.preprocessing.preprocessor_net import PreprocessorNet
+from ml.rl.caffe_utils import StackedArray
+from ml.rl.preprocessing.preprocessor_net_cache import \
+    get_sparse_preprocessing_net
 from ml.rl.test.utils import default_normalizer
 from ml.rl.test.gridworld.gridworld_base import GridworldBase
 from ml.rl.training.training_data_page import \
@@ -73,6 +72,7 @@ class GridworldContinuous(GridworldBase):
         possible_next_actions: List[List[Dict[int, float]]],
         reward_timelines: List[Dict[int, float]],
         minibatch_size: int,
+        fused: bool = False,
     ) -> List[TrainingDataPage]:
         # Shuffle
         merged = list(
@@ -85,43 +85,16 @@ class GridworldContinuous(GridworldBase):
         states, actions, rewards, next_states, next_actions, is_terminals, \
             possible_next_actions, reward_timelines = zip(*merged)
 
-        net = core.Net('gridworld_preprocessing')
-        C2.set_net(net)
-        preprocessor = PreprocessorNet(net, True)
-        saa = StackedAssociativeArray.from_dict_list(states, 'states')
-        state_matrix, _ = preprocessor.normalize_sparse_matrix(
-            saa.lengths,
-            saa.keys,
-            saa.values,
-            self.normalization,
-            'state_norm',
-        )
-        saa = StackedAssociativeArray.from_dict_list(next_states, 'next_states')
-        next_state_matrix, _ = preprocessor.normalize_sparse_matrix(
-            saa.lengths,
-            saa.keys,
-            saa.values,
-            self.normalization,
-            'next_state_norm',
-        )
-        saa = StackedAssociativeArray.from_dict_list(actions, 'action')
-        action_matrix, _ = preprocessor.normalize_sparse_matrix(
-            saa.lengths,
-            saa.keys,
-            saa.values,
-            self.normalization_action,
-            'action_norm',
-        )
-        saa = StackedAssociativeArray.from_dict_list(
-            next_actions, 'next_action'
+        state_preprocessing_net = get_sparse_preprocessing_net(
+            self.normalization, True, fused=fused
         )
-        next_action_matrix, _ = preprocessor.normalize_sparse_matrix(
-            saa.lengths,
-            saa.keys,
-            saa.values,
-            self.normalization_action,
-            'next_action_norm',
+        action_preprocessing_net = get_sparse_preprocessing_net(
+            self.normalization_action, True, fused=fused
         )
+        states_ndarray = state_preprocessing_net.normalize(states)
+        next_states_ndarray = state_preprocessing_net.normalize(next_states)
+        actions_ndarray = action_preprocessing_net.normalize(actions)
+        next_actions_ndarray = action_preprocessing_net.normalize(next_actions)
         rewards = np.array(rewards, dtype=np.float32).reshape(-1, 1)
 
         pnas_lengths_list = []
@@ -129,25 +102,9 @@ class GridworldContinuous(GridworldBase):
         for pnas in possible_next_actions:
             pnas_lengths_list.append(len(pnas))
             pnas_flat.extend(pnas)
-        saa = StackedAssociativeArray.from_dict_list(
-            pnas_flat, 'possible_next_actions'
-        )
         pnas_lengths = np.array(pnas_lengths_list, dtype=np.int32)
-        possible_next_actions_matrix, _ = preprocessor.normalize_sparse_matrix(
-            saa.lengths,
-            saa.keys,
-            saa.values,
-            self.normalization_action,
-            'possible_next_action_norm',
-        )
-        workspace.RunNetOnce(net)
-
-        states_ndarray = workspace.FetchBlob(state_matrix)
-        actions_ndarray = workspace.FetchBlob(action_matrix)
-        next_states_ndarray = workspace.FetchBlob(next_state_matrix)
-        next_actions_ndarray = workspace.FetchBlob(next_action_matrix)
-        possible_next_actions_ndarray = workspace.FetchBlob(
-            possible_next_actions_matrix
+        possible_next_actions_ndarray = action_preprocessing_net.normalize(
+            pnas_flat
         )
         tdps = []
         pnas_start = 0
@@ -4,6 +4,10 @@ import random
 import numpy as np
 import unittest
 
+from caffe2.python import workspace
+
+from ml.rl.preprocessing.preprocessor_net_cache import \
+    get_sparse_preprocessing_net
 from ml.rl.training.discrete_action_trainer import DiscreteActionTrainer
 from ml.rl.training.evaluator import Evaluator
 from ml.rl.thrift.core.ttypes import \
@@ -21,10 +25,20 @@ class TestGridworld(unittest.TestCase):
         self.minibatch_size = 1024
         super(self.__class__, self).setUp()
 
-    def get_sarsa_trainer(self, environment):
-        return self.get_sarsa_trainer_reward_boost(environment, {})
+    def get_sarsa_trainer(
+        self, environment, enum_embedding_dim=None, sparse_input=False
+    ):
+        return self.get_sarsa_trainer_reward_boost(
+            environment, {}, enum_embedding_dim, sparse_input
+        )
 
-    def get_sarsa_trainer_reward_boost(self, environment, reward_shape):
+    def get_sarsa_trainer_reward_boost(
+        self,
+        environment,
+        reward_shape,
+        enum_embedding_dim=None,
+        sparse_input=False,
+    ):
         rl_parameters = RLParameters(
             gamma=DISCOUNT,
             target_update_rate=0.5,
@@ -38,6 +52,7 @@ class TestGridworld(unittest.TestCase):
             minibatch_size=self.minibatch_size,
             learning_rate=0.01,
             optimizer='ADAM',
+            enum_embedding_dim=enum_embedding_dim,
         )
         return DiscreteActionTrainer(
             DiscreteActionModelParameters(
@@ -46,7 +61,34 @@ class TestGridworld(unittest.TestCase):
                 training=training_parameters
             ),
             environment.normalization,
+            sparse_input=sparse_input,
+        )
+
+    def train_on_samples(
+        self, environment, trainer, num_samples=10000, embed_enums=False
+    ):
+        """
+        Trains `trainer` for one pass over `num_samples` generated samples.
+        Returns the sampled states and actions.
+        """
+        states, actions, rewards, next_states, next_actions, is_terminal,\
+            possible_next_actions, reward_timelines = \
+            environment.generate_samples(num_samples, 1.0)
+        tdps = environment.preprocess_samples(
+            states,
+            actions,
+            rewards,
+            next_states,
+            next_actions,
+            is_terminal,
+            possible_next_actions,
+            reward_timelines,
+            self.minibatch_size,
+            embed_enums=embed_enums,
         )
+        for tdp in tdps:
+            trainer.train_numpy(tdp, None)
+        return states, actions
 
     def test_trainer_maxq(self):
         environment = Gridworld()
@@ -98,6 +140,50 @@ class TestGridworld(unittest.TestCase):
         print("Post-Training eval", evaluator.evaluate(predictor))
         self.assertLess(evaluator.evaluate(predictor), 0.1)
 
+    def test_trainer_sarsa_sparse_input(self):
+        environment = Gridworld()
+        states, actions, rewards, next_states, next_actions, is_terminal,\
+            possible_next_actions, reward_timelines = \
+            environment.generate_samples(100000, 1.0)
+        evaluator = GridworldEvaluator(environment, False)
+        trainer = self.get_sarsa_trainer(environment, sparse_input=True)
+        predictor = trainer.predictor()
+        tdps = environment.preprocess_samples(
+            states,
+            actions,
+            rewards,
+            next_states,
+            next_actions,
+            is_terminal,
+            possible_next_actions,
+            reward_timelines,
+            self.minibatch_size,
+            sparse_states=True,
+        )
+
+        self.assertGreater(evaluator.evaluate(predictor), 0.15)
+
+        for tdp in tdps:
+            trainer.train_numpy(tdp, None)
+
+        self.assertLess(evaluator.evaluate(predictor), 0.05)
+
+        # The first layer is trained from the pairs, with sparse updates
+        op_types = [op.type for op in trainer.rl_train_model.net.Proto().op]
+        self.assertIn('SparseLengthsWeightedSum', op_types)
+        self.assertIn('SparseAdam', op_types)
+        self.assertNotIn('FCTransposed', op_types)
+
+        # Both exports read the transposed first layer weights
+        q_values, action_names = predictor.predict_array(states[:100])
+        sparse_q_values, sparse_action_names = trainer.predictor(
+            sparse_input=True
+        ).predict_array(states[:100])
+        self.assertEqual(action_names, sparse_action_names)
+        np.testing.assert_allclose(
+            sparse_q_values, q_values, rtol=1e-4, atol=1e-4
+        )
+
     def test_trainer_sarsa(self):
         environment = Gridworld()
         states, actions, rewards, next_states, next_actions, is_terminal,\
@@ -126,6 +212,122 @@ class TestGridworld(unittest.TestCase):
 
         self.assertLess(evaluator.evaluate(predictor), 0.05)
 
+    def test_predict_array(self):
+        environment = Gridworld()
+        states, _, _, _, _, _, _, _ = environment.generate_samples(100, 1.0)
+        predictor = self.get_sarsa_trainer(environment).predictor()
+        q_values, action_names = predictor.predict_array(states)
+        self.assertEqual(q_values.dtype, np.float32)
+        self.assertEqual(q_values.shape, (len(states), len(action_names)))
+        self.assertEqual(set(action_names), set(environment.ACTIONS))
+        for row, prediction in zip(q_values, predictor.predict(states)):
+            self.assertEqual(
+                [prediction[action] for action in action_names], list(row)
+            )
+
+    def test_sparse_input_predictor(self):
+        environment = Gridworld()
+        trainer = self.get_sarsa_trainer(environment)
+        states, _ = self.train_on_samples(environment, trainer)
+
+        dense_q_values = trainer.predictor().predict(states[:100])
+        sparse_q_values = trainer.predictor(sparse_input=True).predict(
+            states[:100]
+        )
+        for dense, sparse in zip(dense_q_values, sparse_q_values):
+            self.assertEqual(dense.keys(), sparse.keys())
+            for action in dense:
+                self.assertAlmostEqual(dense[action], sparse[action], places=4)
+
+    def test_fold_normalization_predictor(self):
+        environment = Gridworld()
+        trainer = self.get_sarsa_trainer(environment)
+        states, _ = self.train_on_samples(environment, trainer)
+
+        predictor = trainer.predictor()
+        with self.assertRaises(AssertionError):
+            trainer.predictor(fold_normalization=True)
+        folded_predictor = trainer.predictor(
+            fold_normalization=True, clip_anomalies=False
+        )
+        expected, action_names = predictor.predict_array(states[:100])
+        q_values, folded_action_names = folded_predictor.predict_array(
+            states[:100]
+        )
+        self.assertEqual(action_names, folded_action_names)
+        np.testing.assert_allclose(q_values, expected, rtol=1e-4, atol=1e-4)
+        self.assertLess(
+            len(folded_predictor._net.Proto().op),
+            len(predictor._net.Proto().op)
+        )
+
+    def test_compact_output_predictor(self):
+        environment = Gridworld()
+        trainer = self.get_sarsa_trainer(environment)
+        states, _ = self.train_on_samples(environment, trainer)
+
+        predictor = trainer.predictor()
+        compact_predictor = trainer.predictor(compact_output=True)
+        self.assertFalse(predictor.compact_output)
+        self.assertTrue(compact_predictor.compact_output)
+        self.assertEqual(len(compact_predictor._output_blobs), 2)
+
+        expected, action_names = predictor.predict_array(states[:100])
+        q_values, compact_action_names = compact_predictor.predict_array(
+            states[:100]
+        )
+        self.assertEqual(action_names, compact_action_names)
+        np.testing.assert_allclose(q_values, expected, rtol=1e-5)
+
+        action_indices, index_names = compact_predictor.policy_indices(
+            states[:100]
+        )
+        self.assertEqual(action_indices.shape, (100, 2))
+        self.assertEqual(index_names, action_names)
+        np.testing.assert_array_equal(
+            action_indices[:, 0], np.argmax(expected, axis=1)
+        )
+        policy = compact_predictor.policy(states[:100])
+        expected_policy = predictor.policy(states[:100])
+        self.assertEqual(list(policy[0::2]), list(expected_policy[0::2]))
+
+    def test_top_k_predictor(self):
+        environment = Gridworld()
+        trainer = self.get_sarsa_trainer(environment)
+        states, _ = self.train_on_samples(environment, trainer)
+
+        predictor = trainer.predictor(
+            compact_output=True, top_k=2, action_mask=True
+        )
+        expected, action_names = predictor.predict_array(states[:100])
+        action_indices, values, top_k_action_names = \
+            predictor.top_k_actions(states[:100])
+        self.assertEqual(top_k_action_names, action_names)
+        self.assertEqual(action_indices.shape, (100, 2))
+        np.testing.assert_array_equal(
+            action_indices, np.argsort(-expected, axis=1)[:, :2]
+        )
+        np.testing.assert_allclose(
+            values, -np.sort(-expected, axis=1)[:, :2], rtol=1e-5
+        )
+
+        # Forbid the best action of every state
+        action_mask = np.ones_like(expected)
+        action_mask[np.arange(100), action_indices[:, 0]] = 0
+        masked_indices, _, _ = predictor.top_k_actions(
+            states[:100], action_mask=action_mask
+        )
+        np.testing.assert_array_equal(
+            masked_indices[:, 0], action_indices[:, 1]
+        )
+        policy_indices, _ = predictor.policy_indices(
+            states[:100], action_mask=action_mask
+        )
+        np.testing.assert_array_equal(
+            policy_indices[:, 0], action_indices[:, 1]
+        )
+        self.assertFalse(np.any(policy_indices[:, 1] == action_indices[:, 0]))
+
     def test_trainer_sarsa_enum(self):
         environment = GridworldEnum()
         states, actions, rewards, next_states, next_actions, is_terminal,\
@@ -154,6 +356,43 @@ class TestGridworld(unittest.TestCase):
 
         self.assertLess(evaluator.evaluate(predictor), 0.05)
 
+    def test_trainer_sarsa_enum_embedding(self):
+        environment = GridworldEnum()
+        trainer = self.get_sarsa_trainer(environment, enum_embedding_dim=4)
+        self.assertTrue(trainer.embed_enums)
+        embedding = trainer.ml_trainer.embeddings[0]
+        target_embedding = trainer.target_network.embeddings[0]
+        initial_embedding = workspace.FetchBlob(embedding).copy()
+        initial_target_embedding = workspace.FetchBlob(target_embedding).copy()
+        states, _ = self.train_on_samples(
+            environment, trainer, embed_enums=True
+        )
+
+        # Sparse updates reach the table, and the target network follows it
+        self.assertFalse(
+            np.allclose(workspace.FetchBlob(embedding), initial_embedding)
+        )
+        self.assertFalse(
+            np.allclose(
+                workspace.FetchBlob(target_embedding),
+                initial_target_embedding
+            )
+        )
+
+        # The exported predictor looks up the same rows as the trainer
+        q_values, _ = trainer.predictor().predict_array(states[:100])
+        preprocessing_net = get_sparse_preprocessing_net(
+            environment.normalization, True, embed_enums=True
+        )
+        workspace.FeedBlob('states', preprocessing_net.normalize(states[:100]))
+        workspace.RunNetOnce(trainer.internal_policy_model.net)
+        np.testing.assert_allclose(
+            q_values,
+            workspace.FetchBlob(trainer.internal_policy_output),
+            rtol=1e-4,
+            atol=1e-4
+        )
+
     def test_evaluator_ground_truth(self):
         environment = Gridworld()
         states, actions, rewards, next_states, next_actions, is_terminal,\
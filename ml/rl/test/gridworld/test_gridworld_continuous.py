@@ -4,6 +4,9 @@ import random
 import numpy as np
 import unittest
 
+from caffe2.python import workspace
+
+from ml.rl.preprocessing.normalization import get_num_output_features
 from ml.rl.training.evaluator import Evaluator
 from ml.rl.thrift.core.ttypes import (
     RLParameters, TrainingParameters, ContinuousActionModelParameters,
@@ -53,6 +56,29 @@ class TestGridworldContinuous(unittest.TestCase):
             environment.normalization_action,
         )
 
+    def train_on_samples(self, environment, trainer, num_samples=10000):
+        """
+        Trains `trainer` for one pass over `num_samples` generated samples.
+        Returns the sampled states and actions.
+        """
+        states, actions, rewards, next_states, next_actions, is_terminal,\
+            possible_next_actions, reward_timelines = \
+            environment.generate_samples(num_samples, 1.0)
+        tdps = environment.preprocess_samples(
+            states,
+            actions,
+            rewards,
+            next_states,
+            next_actions,
+            is_terminal,
+            possible_next_actions,
+            reward_timelines,
+            self.minibatch_size,
+        )
+        for tdp in tdps:
+            trainer.train_numpy(tdp, None)
+        return states, actions
+
     def test_trainer_sarsa(self):
         environment = GridworldContinuous()
         states, actions, rewards, next_states, next_actions, is_terminal,\
@@ -81,6 +107,56 @@ class TestGridworldContinuous(unittest.TestCase):
 
         self.assertLess(evaluator.evaluate(predictor), 0.05)
 
+    def test_sparse_input_predictor(self):
+        environment = GridworldContinuous()
+        trainer = self.get_sarsa_trainer(environment)
+        states, actions = self.train_on_samples(environment, trainer)
+
+        dense_q_values = trainer.predictor().predict(
+            states[:100], None, actions[:100]
+        )
+        sparse_q_values = trainer.predictor(sparse_input=True).predict(
+            states[:100], None, actions[:100]
+        )
+        for dense, sparse in zip(dense_q_values, sparse_q_values):
+            self.assertAlmostEqual(dense['Q'], sparse['Q'], places=4)
+
+    def test_action_catalog_policy(self):
+        environment = GridworldContinuous()
+        num_actions = len(environment.normalization_action)
+        catalog = np.eye(num_actions, dtype=np.float32)
+        trainer = ContinuousActionDQNTrainer(
+            self.get_sarsa_parameters(),
+            environment.normalization,
+            environment.normalization_action,
+            action_catalog=catalog,
+        )
+        states = np.random.uniform(
+            size=[3, get_num_output_features(environment.normalization)]
+        ).astype(np.float32)
+
+        workspace.FeedBlob('states', np.repeat(states, num_actions, axis=0))
+        workspace.FeedBlob('actions', np.tile(catalog, (3, 1)))
+        workspace.RunNetOnce(trainer.internal_policy_model.net)
+        expected = workspace.FetchBlob(trainer.internal_policy_output)
+
+        workspace.FeedBlob('states', states)
+        workspace.FeedBlob(
+            'candidate_indices',
+            np.tile(np.arange(num_actions, dtype=np.int32), 3)
+        )
+        workspace.FeedBlob(
+            'candidate_lengths', np.full(3, num_actions, dtype=np.int32)
+        )
+        workspace.RunNet(
+            trainer.internal_catalog_policy_model.net.Proto().name
+        )
+        np.testing.assert_allclose(
+            workspace.FetchBlob(trainer.internal_catalog_policy_output),
+            expected,
+            rtol=1e-5
+        )
+
     def test_trainer_sarsa_enum(self):
         environment = GridworldContinuousEnum()
         states, actions, rewards, next_states, next_actions, is_terminal,\
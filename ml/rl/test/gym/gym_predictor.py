@@ -31,11 +31,31 @@ class GymPredictor(object):
 class GymDQNPredictor(GymPredictor):
     def __init__(self, trainer, c2_device):
         GymPredictor.__init__(self, trainer, c2_device)
+        self._use_action_catalog = \
+            isinstance(trainer, ContinuousActionDQNTrainer) and \
+            trainer.action_catalog_size is not None
+        # Every step scores the whole catalog; its indices only change with
+        #     the catalog size.
+        self._candidate_indices = np.zeros(0, dtype=np.int32)
 
     def policy(self, states):
         with core.DeviceScope(self.c2_device):
             if isinstance(self.trainer, DiscreteActionTrainer):
                 workspace.FeedBlob('states', states)
+            elif self._use_action_catalog:
+                # The candidate indices cover the catalog once, for one state
+                assert states.shape[0] == 1
+                num_actions = self.trainer.action_catalog_size
+                if len(self._candidate_indices) != num_actions:
+                    self._candidate_indices = np.arange(
+                        num_actions, dtype=np.int32
+                    )
+                workspace.FeedBlob('states', states)
+                workspace.FeedBlob('candidate_indices', self._candidate_indices)
+                workspace.FeedBlob(
+                    'candidate_lengths',
+                    np.array([num_actions], dtype=np.int32)
+                )
             elif isinstance(self.trainer, ContinuousActionDQNTrainer):
                 num_actions = len(self.trainer.action_normalization_parameters)
                 states = np.tile(states, (num_actions, 1))
@@ -46,8 +66,15 @@ class GymDQNPredictor(GymPredictor):
                 raise NotImplementedError(
                     "Invalid trainer passed to GymPredictor"
                 )
-            workspace.RunNetOnce(self.trainer.internal_policy_model.net)
-            policy_output_blob = self.trainer.internal_policy_output
+            if self._use_action_catalog:
+                workspace.RunNet(
+                    self.trainer.internal_catalog_policy_model.net.Proto().name
+                )
+                policy_output_blob = \
+                    self.trainer.internal_catalog_policy_output
+            else:
+                workspace.RunNetOnce(self.trainer.internal_policy_model.net)
+                policy_output_blob = self.trainer.internal_policy_output
             q_scores = workspace.FetchBlob(policy_output_blob)
             if isinstance(self.trainer, DiscreteActionTrainer):
                 assert q_scores.shape[0] == 1
@@ -156,17 +156,15 @@ class OpenAIGymEnvironment:
             workspace.FeedBlob('possible_next_actions', possible_next_actions)
             return
 
-        pnas = []
-        for pna_matrix in possible_next_actions:
-            for row in pna_matrix:
-                pnas.append(row)
-
+        # Parametric transitions store indices into the trainer's action
+        #     catalog rather than action features
         workspace.FeedBlob(
             'possible_next_actions_lengths',
             np.array(possible_next_actions_lengths, dtype=np.int32)
         )
         workspace.FeedBlob(
-            'possible_next_actions', np.array(pnas, dtype=np.float32)
+            'possible_next_actions_indices',
+            np.concatenate(possible_next_actions).astype(np.int32)
         )
 
     @property
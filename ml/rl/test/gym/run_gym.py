@@ -63,6 +63,10 @@ def run(
         predictor = GymDQNPredictor(trainer, c2_device)
 
     total_timesteps = 0
+    if model_type == ModelType.PARAMETRIC_ACTION.value:
+        # Rows of the trainer's action catalog, shared by every transition
+        all_action_indices = np.arange(gym_env.action_dim, dtype=np.int32)
+        no_action_indices = np.zeros(0, dtype=np.int32)
 
     for i in range(num_episodes):
         terminal = False
@@ -100,10 +104,10 @@ def run(
                 possible_next_actions_lengths = gym_env.action_dim
             elif model_type == ModelType.PARAMETRIC_ACTION.value:
                 if terminal:
-                    possible_next_actions = np.array([])
+                    possible_next_actions = no_action_indices
                     possible_next_actions_lengths = 0
                 else:
-                    possible_next_actions = np.eye(gym_env.action_dim)
+                    possible_next_actions = all_action_indices
                     possible_next_actions_lengths = gym_env.action_dim
             elif model_type == ModelType.CONTINUOUS_ACTION.value:
                 possible_next_actions = None
@@ -282,7 +286,10 @@ def run_gym(params, score_bar, gpu_id):
                 knn=KnnParameters(model_type="DQN"),
             )
             trainer = ContinuousActionDQNTrainer(
-                trainer_params, env.normalization, env.normalization_action
+                trainer_params,
+                env.normalization,
+                env.normalization_action,
+                action_catalog=np.eye(env.action_dim, dtype=np.float32),
             )
     elif model_type == ModelType.CONTINUOUS_ACTION.value:
         training_settings = params["shared_training"]
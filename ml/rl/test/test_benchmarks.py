@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from ml.rl.benchmarks.run_benchmarks import compare_to_baseline
+from ml.rl.benchmarks.synthetic_data import (
+    generate_dense_matrix,
+    generate_normalization,
+    generate_sparse_states,
+)
+from ml.rl.preprocessing.identify_types import FEATURE_TYPES
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_synthetic_data(self):
+        normalization = generate_normalization(300)
+        self.assertEqual(len(normalization), 300)
+        self.assertEqual(
+            set(p.feature_type for p in normalization.values()),
+            set(FEATURE_TYPES),
+        )
+
+        features, matrix = generate_dense_matrix(normalization, 50)
+        self.assertEqual(matrix.shape, (50, 300))
+        feature_types = [
+            FEATURE_TYPES.index(normalization[f].feature_type) for f in features
+        ]
+        self.assertEqual(feature_types, sorted(feature_types))
+
+        states = generate_sparse_states(normalization, 20, 7)
+        self.assertEqual(len(states), 20)
+        self.assertTrue(all(len(state) == 7 for state in states))
+        self.assertTrue(
+            all(k in normalization for state in states for k in state)
+        )
+
+    def test_compare_to_baseline(self):
+        baseline = {
+            'train_samples_per_s': 1000.0,
+            'predict_batch_1_p50_ms': 1.0,
+            'predict_batch_1_p99_ms': 2.0,
+            'removed_metric_per_s': 1.0,
+        }
+        results = {
+            'train_samples_per_s': 850.0,
+            'predict_batch_1_p50_ms': 1.05,
+            'predict_batch_1_p99_ms': 3.0,
+            'new_metric_per_s': 1.0,
+        }
+        regressions = compare_to_baseline(results, baseline, 0.1)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('predict_batch_1_p99_ms'))
+        self.assertTrue(regressions[1].startswith('train_samples_per_s'))
+        self.assertEqual(compare_to_baseline(results, baseline, 0.6), [])
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+from ml.rl.serving.hot_swap import HotSwapManager
+from ml.rl.test.gridworld.gridworld import Gridworld
+from ml.rl.test.utils import small_discrete_action_trainer
+from ml.rl.training.discrete_action_predictor import DiscreteActionPredictor
+
+
+class TestHotSwap(unittest.TestCase):
+    def _save_model(self, environment, db_path, states):
+        trainer = small_discrete_action_trainer(environment)
+        predictor = trainer.predictor()
+        predictor.save(db_path, 'minidb')
+        return predictor.predict_array(states)[0]
+
+    def test_swap_under_traffic(self):
+        environment = Gridworld()
+        states, _, _, _, _, _, _, _ = environment.generate_samples(16, 1.0)
+        with tempfile.TemporaryDirectory() as temp_directory_name:
+            first_path = os.path.join(temp_directory_name, 'first')
+            second_path = os.path.join(temp_directory_name, 'second')
+            first_expected = self._save_model(environment, first_path, states)
+            second_expected = self._save_model(
+                environment, second_path, states
+            )
+
+            manager = HotSwapManager(
+                DiscreteActionPredictor, num_instances=2, warmup_states=states
+            )
+            stats = manager.load(first_path, 'minidb')
+            self.assertEqual(stats['generation'], 1)
+            np.testing.assert_allclose(
+                manager.predict_array(states)[0], first_expected, rtol=1e-5
+            )
+
+            errors = []
+            stop = threading.Event()
+
+            def traffic():
+                while not stop.is_set():
+                    try:
+                        q_values, _ = manager.predict_array(states)
+                        self.assertTrue(
+                            np.allclose(q_values, first_expected, rtol=1e-5) or
+                            np.allclose(q_values, second_expected, rtol=1e-5)
+                        )
+                    except Exception as e:
+                        errors.append(e)
+                        return
+
+            threads = [threading.Thread(target=traffic) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            stats = manager.load_async(second_path, 'minidb').result()
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(stats['generation'], 2)
+        self.assertGreaterEqual(stats['load_seconds'], 0)
+        np.testing.assert_allclose(
+            manager.predict_array(states)[0], second_expected, rtol=1e-5
+        )
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from caffe2.python import workspace
+
+from ml.rl.test.gridworld.gridworld import Gridworld
+from ml.rl.test.utils import small_discrete_action_trainer
+from ml.rl.training.discrete_action_predictor import DiscreteActionPredictor
+from ml.rl.training.mapped_model import MappedModel
+
+
+class TestMappedModel(unittest.TestCase):
+    def test_save_and_load(self):
+        environment = Gridworld()
+        trainer = small_discrete_action_trainer(environment)
+        predictor = trainer.predictor()
+        states, _, _, _, _, _, _, _ = environment.generate_samples(16, 1.0)
+        expected, action_names = predictor.predict_array(states)
+        expected_policy = predictor.policy(states)
+
+        with tempfile.TemporaryDirectory() as temp_directory_name:
+            path = os.path.join(temp_directory_name, 'model.rlmodel')
+            predictor.save_mapped(path)
+
+            previous_workspace = workspace.CurrentWorkspace()
+            workspace.SwitchWorkspace('mapped_model_test', True)
+            try:
+                loaded = DiscreteActionPredictor.load_mapped(path, verify=True)
+                q_values, loaded_action_names = loaded.predict_array(states)
+                policy = loaded.policy(states)
+                self.assertTrue(
+                    loaded.mapped_model.verify_in_background().result()
+                )
+            finally:
+                workspace.ResetWorkspace()
+                workspace.SwitchWorkspace(previous_workspace)
+
+            self.assertEqual(loaded_action_names, action_names)
+            np.testing.assert_allclose(q_values, expected, rtol=1e-5)
+            self.assertEqual(list(policy[0::2]), list(expected_policy[0::2]))
+
+            with open(path, 'r+b') as f:
+                f.seek(-1, os.SEEK_END)
+                last_byte = f.read(1)
+                f.seek(-1, os.SEEK_END)
+                f.write(bytes([last_byte[0] ^ 0xFF]))
+            with self.assertRaises(ValueError):
+                MappedModel(path).verify()
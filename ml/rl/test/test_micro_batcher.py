@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ml.rl.serving.micro_batcher import MicroBatcher
+
+
+class FakePredictor(object):
+    """ Returns [x, -x] for each state {0: x}, like the [max_q, softmax]
+    pairs of `RLPredictor.policy`. """
+
+    def __init__(self):
+        self.batch_sizes = []
+        self.lock = threading.Lock()
+
+    def policy(self, float_state_features, int_state_features=None):
+        with self.lock:
+            self.batch_sizes.append(len(float_state_features))
+        values = np.array([e[0] for e in float_state_features])
+        return np.stack([values, -values], axis=1).flatten()
+
+
+class TestMicroBatcher(unittest.TestCase):
+    def test_results_are_scattered_to_callers(self):
+        predictor = FakePredictor()
+        with MicroBatcher(predictor, max_batch_size=8, max_wait=0.05) as \
+                batcher:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                results = list(
+                    executor.map(
+                        lambda x: batcher.call({0: float(x)}), range(64)
+                    )
+                )
+            stats = batcher.stats()
+        for x, result in enumerate(results):
+            np.testing.assert_array_equal(result, [x, -x])
+        self.assertEqual(sum(predictor.batch_sizes), 64)
+        self.assertLessEqual(max(predictor.batch_sizes), 8)
+        self.assertLess(len(predictor.batch_sizes), 64)
+        self.assertEqual(stats['batch_size']['count'], len(predictor.batch_sizes))
+        self.assertEqual(stats['queue_time']['count'], 64)
+
+    def test_errors_reach_every_caller(self):
+        class FailingPredictor(object):
+            def policy(self, float_state_features, int_state_features=None):
+                raise ValueError("bad batch")
+
+        with MicroBatcher(FailingPredictor(), max_wait=0.01) as batcher:
+            futures = [batcher.submit({0: 1.0}) for _ in range(4)]
+            for future in futures:
+                with self.assertRaises(ValueError):
+                    future.result(timeout=5)
+
+    def test_submit_async(self):
+        async def run(batcher):
+            return await asyncio.gather(
+                *[batcher.submit_async({0: float(x)}) for x in range(10)]
+            )
+
+        with MicroBatcher(FakePredictor(), max_wait=0.01) as batcher:
+            loop = asyncio.new_event_loop()
+            try:
+                results = loop.run_until_complete(run(batcher))
+            finally:
+                loop.close()
+        for x, result in enumerate(results):
+            np.testing.assert_array_equal(result, [x, -x])
+
+    def test_submit_racing_close(self):
+        batcher = MicroBatcher(FakePredictor(), max_wait=0.001, num_threads=2)
+        futures = []
+
+        def submit_until_closed():
+            while True:
+                try:
+                    futures.append(batcher.submit({0: 1.0}))
+                except RuntimeError:
+                    return
+
+        submitters = [
+            threading.Thread(target=submit_until_closed) for _ in range(4)
+        ]
+        for submitter in submitters:
+            submitter.start()
+        batcher.close()
+        for submitter in submitters:
+            submitter.join()
+        for future in futures:
+            np.testing.assert_array_equal(future.result(timeout=5), [1, -1])
@@ -10,7 +10,8 @@ from caffe2.python import core, workspace
 from ml.rl.caffe_utils import C2
 from ml.rl.preprocessing import identify_types
 from ml.rl.preprocessing import normalization
-from ml.rl.preprocessing.preprocessor_net import PreprocessorNet
+from ml.rl.preprocessing.preprocessor_net import PreprocessorNet, \
+    get_folded_affine, sort_features_by_normalization
 from ml.rl.test import preprocessing_util
 from ml.rl.preprocessing.normalization import NormalizationParameters
 from ml.rl.preprocessing.identify_types import CONTINUOUS, BOXCOX, ENUM
@@ -189,6 +190,248 @@ class TestNormalization(unittest.TestCase):
             normalized_feature_matrix
         )
 
+    def test_normalize_dense_matrix_enum_unknown(self):
+        normalization_parameters = {
+            'f1':
+                NormalizationParameters(
+                    identify_types.ENUM, None, None, None, None, [12, 4, 2],
+                    None
+                ),
+        }
+        norm_net = core.Net("net")
+        C2.set_net(norm_net)
+        preprocessor = PreprocessorNet(norm_net, False)
+        input_blob = norm_net.NextBlob('input_blob')
+        workspace.FeedBlob(
+            input_blob,
+            np.array(
+                [[2], [5], [2.5], [normalization.MISSING_VALUE]],
+                dtype=np.float32
+            )
+        )
+        normalized_output_blob, _ = preprocessor.normalize_dense_matrix(
+            input_blob, ['f1'], normalization_parameters, ''
+        )
+        workspace.RunNetOnce(norm_net)
+        np.testing.assert_allclose(
+            np.array([[0, 0, 1], [0, 0, 0], [0, 0, 0], [0, 0, 0]]),
+            workspace.FetchBlob(normalized_output_blob)
+        )
+        # The one-hot is written with a single scatter, without the
+        #     batch x num_values one-hot temporaries
+        op_types = [op.type for op in norm_net.Proto().op]
+        self.assertIn('ScatterAssign', op_types)
+        self.assertNotIn('BatchOneHot', op_types)
+
+    def test_normalize_dense_matrix_enum_ids(self):
+        normalization_parameters = {
+            'f1':
+                NormalizationParameters(
+                    identify_types.ENUM, None, None, None, None, [12, 4, 2],
+                    None
+                ),
+            'f2':
+                NormalizationParameters(
+                    identify_types.CONTINUOUS, None, 0, 0, 1, None, None
+                ),
+            'f3':
+                NormalizationParameters(
+                    identify_types.ENUM, None, None, None, None, [15, 3], None
+                )
+        }
+        norm_net = core.Net("net")
+        C2.set_net(norm_net)
+        preprocessor = PreprocessorNet(norm_net, False, embed_enums=True)
+
+        inputs = np.zeros([4, 3], dtype=np.float32)
+        feature_ids = ['f2', 'f1', 'f3']  # Sorted according to feature type
+        inputs[:, feature_ids.index('f1')] = [12, 4, 2, 2]
+        inputs[:, feature_ids.index('f2')] = [1.0, 2.0, 3.0, 3.0]
+        inputs[:, feature_ids.index('f3')] = [
+            15, 3, 15, normalization.MISSING_VALUE
+        ]
+        input_blob = norm_net.NextBlob('input_blob')
+        workspace.FeedBlob(input_blob, np.array([0], dtype=np.float32))
+        normalized_output_blob, _ = preprocessor.normalize_dense_matrix(
+            input_blob, feature_ids, normalization_parameters, ''
+        )
+        workspace.FeedBlob(input_blob, inputs)
+        workspace.RunNetOnce(norm_net)
+        normalized_feature_matrix = workspace.FetchBlob(normalized_output_blob)
+
+        # f1 owns embedding rows 0-3 and f3 rows 4-6.  The first row of each
+        #     feature is for missing values.
+        np.testing.assert_allclose(
+            np.array(
+                [
+                    [1.0, 3, 6],
+                    [2.0, 2, 5],
+                    [3.0, 1, 6],
+                    [3.0, 1, 4],
+                ]
+            ),
+            normalized_feature_matrix
+        )
+        self.assertEqual(
+            normalization.get_enum_embedding_layout(normalization_parameters),
+            (1, [4, 3])
+        )
+        self.assertEqual(
+            normalization.get_num_output_features(
+                normalization_parameters, 8
+            ), 17
+        )
+
+    def test_fused_matches_unfused(self):
+        features, feature_value_map = preprocessing_util.read_data()
+        normalization_parameters = normalization.identify_parameters(
+            feature_value_map, max_unique_enum_values=10
+        )
+        sorted_features, _ = sort_features_by_normalization(
+            normalization_parameters
+        )
+        input_matrix = np.stack(
+            [feature_value_map[f] for f in sorted_features], axis=1
+        ).astype(np.float32)
+        input_matrix[np.random.RandomState(0).uniform(
+            size=input_matrix.shape
+        ) < 0.1] = normalization.MISSING_VALUE
+
+        outputs = []
+        for fused in [False, True]:
+            norm_net = core.Net("net")
+            C2.set_net(norm_net)
+            preprocessor = PreprocessorNet(norm_net, True, fused=fused)
+            input_blob = norm_net.NextBlob('input_blob')
+            workspace.FeedBlob(input_blob, input_matrix)
+            output_blob, _ = preprocessor.normalize_dense_matrix(
+                input_blob, sorted_features, normalization_parameters, ''
+            )
+            workspace.RunNetOnce(norm_net)
+            outputs.append(workspace.FetchBlob(output_blob))
+            if fused:
+                fused_ops = len(norm_net.Proto().op)
+            else:
+                unfused_ops = len(norm_net.Proto().op)
+        self.assertLess(fused_ops, unfused_ops)
+
+        # Where the outputs may differ, see `PreprocessorNet`
+        missing = input_matrix == normalization.MISSING_VALUE
+        column = 0
+        for i, feature in enumerate(sorted_features):
+            parameters = normalization_parameters[feature]
+            width = len(parameters.possible_values) \
+                if parameters.feature_type == ENUM else 1
+            unfused = outputs[0][:, column:column + width]
+            fused = outputs[1][:, column:column + width]
+            column += width
+            if parameters.feature_type == BOXCOX:
+                np.testing.assert_allclose(
+                    fused[missing[:, i]], 0, atol=1e-4
+                )
+                np.testing.assert_allclose(
+                    fused[~missing[:, i]], unfused[~missing[:, i]], rtol=1e-6
+                )
+            elif parameters.feature_type == CONTINUOUS:
+                np.testing.assert_array_equal(fused[missing[:, i]], 0)
+                np.testing.assert_allclose(
+                    fused[~missing[:, i]], unfused[~missing[:, i]], rtol=1e-6
+                )
+            else:
+                np.testing.assert_array_equal(fused, unfused)
+        self.assertEqual(column, outputs[0].shape[1])
+
+    def test_folded_affine(self):
+        features, feature_value_map = preprocessing_util.read_data()
+        normalization_parameters = normalization.identify_parameters(
+            feature_value_map, max_unique_enum_values=10
+        )
+        sorted_features, _ = sort_features_by_normalization(
+            normalization_parameters
+        )
+        input_matrix = np.stack(
+            [feature_value_map[f] for f in sorted_features], axis=1
+        ).astype(np.float32)
+        input_matrix[np.random.RandomState(0).uniform(
+            size=input_matrix.shape
+        ) < 0.1] = normalization.MISSING_VALUE
+
+        outputs = []
+        for fold_affine in [False, True]:
+            norm_net = core.Net("net")
+            C2.set_net(norm_net)
+            preprocessor = PreprocessorNet(
+                norm_net, False, fused=True, fold_affine=fold_affine
+            )
+            input_blob = norm_net.NextBlob('input_blob')
+            workspace.FeedBlob(input_blob, input_matrix)
+            output_blob, _ = preprocessor.normalize_dense_matrix(
+                input_blob, sorted_features, normalization_parameters, ''
+            )
+            workspace.RunNetOnce(norm_net)
+            outputs.append(workspace.FetchBlob(output_blob))
+        scale, shift = get_folded_affine(normalization_parameters)
+        self.assertEqual(len(scale), outputs[0].shape[1])
+        np.testing.assert_allclose(
+            outputs[1] * scale + shift, outputs[0], rtol=1e-4, atol=1e-4
+        )
+
+    def test_normalize_sparse_features(self):
+        features, feature_value_map = preprocessing_util.read_data()
+        feature_ids = {feature: 10 + i for i, feature in enumerate(features)}
+        normalization_parameters = normalization.identify_parameters(
+            {feature_ids[f]: feature_value_map[f]
+             for f in features},
+            max_unique_enum_values=10
+        )
+        random_state = np.random.RandomState(0)
+        lengths, keys, values = [], [], []
+        for row in range(100):
+            row_features = [
+                f for f in features if random_state.uniform() < 0.5
+            ]
+            keys.extend([feature_ids[f] for f in row_features] + [999])
+            values.extend(
+                [feature_value_map[f][row] for f in row_features] + [1.0]
+            )
+            lengths.append(len(row_features) + 1)
+        # A known feature with a missing value
+        values[0] = normalization.MISSING_VALUE
+
+        norm_net = core.Net("net")
+        C2.set_net(norm_net)
+        preprocessor = PreprocessorNet(norm_net, True)
+        for blob, data, dtype in [
+            ('lengths', lengths, np.int32),
+            ('keys', keys, np.int64),
+            ('values', values, np.float32),
+        ]:
+            workspace.FeedBlob(blob, np.array(data, dtype=dtype))
+        dense_output, _ = preprocessor.normalize_sparse_matrix(
+            'lengths', 'keys', 'values', normalization_parameters, 'dense'
+        )
+        sparse_output, _ = preprocessor.normalize_sparse_features(
+            'lengths', 'keys', 'values', normalization_parameters, 'sparse'
+        )
+        workspace.RunNetOnce(norm_net)
+
+        expected = workspace.FetchBlob(dense_output)
+        self.assertEqual(expected.shape[1], sparse_output.num_columns)
+        actual = np.zeros_like(expected)
+        actual[:, sparse_output.dense_columns] = workspace.FetchBlob(
+            sparse_output.dense_matrix
+        )
+        rows = np.repeat(
+            np.arange(len(lengths)),
+            workspace.FetchBlob(sparse_output.lengths)
+        )
+        np.add.at(
+            actual,
+            (rows, workspace.FetchBlob(sparse_output.columns)),
+            workspace.FetchBlob(sparse_output.values),
+        )
+        np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-5)
+
     def test_persistency(self):
         _, feature_value_map = preprocessing_util.read_data()
         normalization_parameters = {}
@@ -201,6 +444,21 @@ class TestNormalization(unittest.TestCase):
         read_parameters = normalization.deserialize(s)
         self.assertEqual(read_parameters, normalization_parameters)
 
+    def test_identify_parameters_parallel(self):
+        features, feature_value_map = preprocessing_util.read_data()
+        serial = normalization.identify_parameters(
+            feature_value_map, max_unique_enum_values=10
+        )
+        self.assertEqual(list(serial.keys()), list(feature_value_map.keys()))
+
+        matrix = np.stack([feature_value_map[f] for f in features], axis=1)
+        parallel = normalization.identify_parameters(
+            matrix, features, n_jobs=2, max_unique_enum_values=10
+        )
+        self.assertEqual(list(parallel.keys()), features)
+        for feature in features:
+            self.assertEqual(parallel[feature], serial[feature])
+
     def preprocess_feature(self, feature, parameters):
         is_not_empty = 1 - np.isclose(feature, normalization.MISSING_VALUE)
         if parameters.feature_type == identify_types.BINARY:
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+from ml.rl.preprocessing import identify_types
+from ml.rl.preprocessing import normalization
+from ml.rl.preprocessing import normalization_binary
+from ml.rl.preprocessing.normalization import NormalizationParameters
+from ml.rl.test import preprocessing_util
+
+
+class TestNormalizationBinary(unittest.TestCase):
+    def _parameters(self):
+        _, feature_value_map = preprocessing_util.read_data()
+        return normalization.identify_parameters(feature_value_map)
+
+    def test_round_trip(self):
+        parameters = self._parameters()
+        mapped = normalization_binary.MappedNormalizationParameters(
+            normalization_binary.to_bytes(parameters)
+        )
+        self.assertEqual(list(mapped.keys()), list(parameters.keys()))
+        self.assertEqual(mapped.to_dict(), parameters)
+        self.assertEqual(
+            mapped[identify_types.QUANTILE],
+            parameters[identify_types.QUANTILE]
+        )
+
+    def test_int_keys_and_none_fields(self):
+        parameters = {
+            3:
+                NormalizationParameters(
+                    identify_types.ENUM, None, None, None, None, [12, 4, 2],
+                    None
+                ),
+            7:
+                NormalizationParameters(
+                    identify_types.CONTINUOUS, None, 0, 0, 1, None, None
+                ),
+        }
+        mapped = normalization_binary.MappedNormalizationParameters(
+            normalization_binary.to_bytes(parameters)
+        )
+        self.assertEqual(dict(mapped), parameters)
+        self.assertEqual(mapped.array('type_codes').tolist(), [4, 2])
+
+    def test_non_integer_enum_values(self):
+        parameters = {
+            3:
+                NormalizationParameters(
+                    identify_types.ENUM, None, None, None, None, [1, 2.5],
+                    None
+                ),
+        }
+        with self.assertRaises(Exception):
+            normalization_binary.to_bytes(parameters)
+
+    def test_json_conversion(self):
+        parameters_json = normalization.serialize(self._parameters())
+        data = normalization_binary.json_to_bytes(parameters_json)
+        self.assertEqual(
+            normalization.deserialize(
+                normalization_binary.bytes_to_json(data)
+            ), normalization.deserialize(parameters_json)
+        )
+
+    def test_mapped_file_and_cache(self):
+        parameters = self._parameters()
+        with tempfile.TemporaryDirectory() as temp_directory_name:
+            path = os.path.join(temp_directory_name, 'normalization.bin')
+            normalization_binary.write(parameters, path)
+            self.assertEqual(
+                normalization_binary.MappedNormalizationParameters.open(path)
+                .to_dict(), parameters
+            )
+
+            normalization_binary.clear_cache()
+            loaded = normalization_binary.load(path)
+            self.assertIsInstance(
+                loaded, normalization_binary.MappedNormalizationParameters
+            )
+            self.assertEqual(dict(loaded), parameters)
+            self.assertIs(normalization_binary.load(path), loaded)
+
+            # A copy with the same content shares the parameters
+            copy_path = os.path.join(temp_directory_name, 'copy.bin')
+            normalization_binary.write(parameters, copy_path)
+            self.assertIs(normalization_binary.load(copy_path), loaded)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import unittest
+
+from ml.rl.preprocessing import identify_types
+from ml.rl.preprocessing.normalization import NormalizationParameters
+from ml.rl.training.normalization_folding import \
+    CLIPPED_SAMPLE_STDDEVS, sample_states
+
+
+class TestNormalizationFolding(unittest.TestCase):
+    def test_samples_beyond_clipping_range(self):
+        parameters = {
+            1: NormalizationParameters(
+                identify_types.CONTINUOUS, None, 0, 10.0, 2.0, None, None
+            ),
+            2: NormalizationParameters(
+                identify_types.BOXCOX, 0.5, 1.0, 3.0, 0.5, None, None
+            ),
+        }
+        states = sample_states(parameters, 1000, missing_probability=0.0)
+        continuous = np.array([state[1] for state in states])
+        normalized = (continuous - 10.0) / 2.0
+        self.assertGreater(np.max(normalized), 3.0)
+        self.assertLess(np.min(normalized), -3.0)
+
+        boxcox = np.array([state[2] for state in states]) + 1.0
+        normalized = ((np.power(boxcox, 0.5) - 1) / 0.5 - 3.0) / 0.5
+        self.assertGreater(np.max(normalized), 3.0)
+        self.assertLess(np.min(normalized), -3.0)
+
+    def test_clipped_samples_within_clipping_range(self):
+        parameters = {
+            1: NormalizationParameters(
+                identify_types.CONTINUOUS, None, 0, 10.0, 2.0, None, None
+            ),
+        }
+        states = sample_states(
+            parameters,
+            1000,
+            missing_probability=0.0,
+            stddevs=CLIPPED_SAMPLE_STDDEVS
+        )
+        normalized = (np.array([state[1] for state in states]) - 10.0) / 2.0
+        self.assertLess(np.max(np.abs(normalized)), 3.0)
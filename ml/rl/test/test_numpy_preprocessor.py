@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import unittest
+
+from caffe2.python import core, workspace
+
+from ml.rl.caffe_utils import C2, StackedAssociativeArray
+from ml.rl.preprocessing import normalization
+from ml.rl.preprocessing.numpy_preprocessor import NumpyPreprocessor
+from ml.rl.preprocessing.preprocessor_net import PreprocessorNet
+from ml.rl.test import preprocessing_util
+
+
+class TestNumpyPreprocessor(unittest.TestCase):
+    def _normalization(self):
+        features, feature_value_map = preprocessing_util.read_data()
+        parameters = normalization.identify_parameters(
+            feature_value_map, max_unique_enum_values=10
+        )
+        # Integer ids, as the sparse path expects
+        int_parameters = {
+            i: parameters[feature]
+            for i, feature in enumerate(features)
+        }
+        int_values = {
+            i: feature_value_map[feature]
+            for i, feature in enumerate(features)
+        }
+        return int_parameters, int_values
+
+    def _input_matrix(self, preprocessor, values):
+        matrix = np.stack(
+            [values[f] for f in preprocessor.sorted_features], axis=1
+        ).astype(np.float32)
+        # Mark some values as missing
+        rng = np.random.RandomState(0)
+        matrix[rng.uniform(size=matrix.shape) < 0.1] = \
+            normalization.MISSING_VALUE
+        return matrix
+
+    def test_dense_parity(self):
+        parameters, values = self._normalization()
+        for clip_anomalies in [False, True]:
+            numpy_preprocessor = NumpyPreprocessor(parameters, clip_anomalies)
+            matrix = self._input_matrix(numpy_preprocessor, values)
+
+            net = core.Net("numpy_preprocessor_parity")
+            C2.set_net(net)
+            preprocessor = PreprocessorNet(net, clip_anomalies)
+            input_blob = 'numpy_preprocessor_input'
+            workspace.FeedBlob(input_blob, matrix)
+            output_blob, _ = preprocessor.normalize_dense_matrix(
+                input_blob, numpy_preprocessor.sorted_features, parameters, ''
+            )
+            workspace.RunNetOnce(net)
+            expected = workspace.FetchBlob(output_blob)
+
+            actual = numpy_preprocessor.transform(matrix)
+            self.assertEqual(actual.dtype, np.float32)
+            self.assertEqual(
+                actual.shape[1],
+                normalization.get_num_output_features(parameters)
+            )
+            np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-4)
+
+    def test_sparse_parity(self):
+        parameters, values = self._normalization()
+        numpy_preprocessor = NumpyPreprocessor(parameters, True)
+        matrix = self._input_matrix(numpy_preprocessor, values)[:100]
+        rows = [
+            {
+                feature: float(row[i])
+                for i, feature in enumerate(numpy_preprocessor.sorted_features)
+                if row[i] != np.float32(normalization.MISSING_VALUE)
+            } for row in matrix
+        ]
+
+        net = core.Net("numpy_preprocessor_sparse_parity")
+        C2.set_net(net)
+        preprocessor = PreprocessorNet(net, True)
+        saa = StackedAssociativeArray.from_dict_list(rows, 'sparse_parity')
+        output_blob, _ = preprocessor.normalize_sparse_matrix(
+            saa.lengths, saa.keys, saa.values, parameters, 'sparse_parity'
+        )
+        workspace.RunNetOnce(net)
+
+        np.testing.assert_allclose(
+            numpy_preprocessor.transform_sparse(rows),
+            workspace.FetchBlob(output_blob),
+            rtol=1e-4,
+            atol=1e-4,
+        )
+
+    def test_inplace(self):
+        parameters, values = self._normalization()
+        dense_parameters = {
+            k: v
+            for k, v in parameters.items() if v.possible_values is None
+        }
+        numpy_preprocessor = NumpyPreprocessor(dense_parameters, False)
+        matrix = self._input_matrix(numpy_preprocessor, values)
+        expected = numpy_preprocessor.transform(matrix)
+        output = numpy_preprocessor.transform(matrix, inplace=True)
+        self.assertIs(output, matrix)
+        np.testing.assert_array_equal(output, expected)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from ml.rl.serving import protocol
+from ml.rl.serving.client import PredictionClient, run_load
+from ml.rl.serving.server import PredictionServer
+from ml.rl.test.gridworld.gridworld import Gridworld
+from ml.rl.test.utils import small_discrete_action_trainer
+from ml.rl.training.discrete_action_predictor import DiscreteActionPredictor
+from ml.rl.training.rl_predictor import sparse_features
+
+
+class TestProtocol(unittest.TestCase):
+    def test_request_round_trip(self):
+        float_features = sparse_features(
+            [{1: 0.5, 7: -2.0}, {}, {3: 1.0}], np.float32
+        )
+        int_features = sparse_features([{2: 4}, {5: 1, 6: 0}, {}], np.int32)
+        payload = b''.join(
+            protocol.encode_request(
+                protocol.METHOD_POLICY, float_features, int_features
+            )
+        )
+        method, decoded_float, decoded_int = protocol.decode_request(payload)
+        self.assertEqual(method, protocol.METHOD_POLICY)
+        for expected, decoded in zip(
+            float_features + int_features, decoded_float + decoded_int
+        ):
+            np.testing.assert_array_equal(decoded, expected)
+
+    def test_response_round_trip(self):
+        q_values = np.arange(6, dtype=np.float32).reshape(2, 3)
+        values, names = protocol.decode_response(
+            b''.join(protocol.encode_values(q_values, [b'L', 'R', 'U']))
+        )
+        np.testing.assert_array_equal(values, q_values)
+        self.assertEqual(names, ['L', 'R', 'U'])
+        self.assertEqual(
+            protocol.decode_response(
+                b''.join(protocol.encode_policy(['L', 'U']))
+            ), ['L', 'U']
+        )
+        with self.assertRaisesRegex(RuntimeError, "bad input"):
+            protocol.decode_response(
+                b''.join(protocol.encode_error("bad input"))
+            )
+
+
+class TestPredictionServer(unittest.TestCase):
+    def test_workers_match_predictor(self):
+        environment = Gridworld()
+        trainer = small_discrete_action_trainer(environment)
+        states, _, _, _, _, _, _, _ = environment.generate_samples(32, 1.0)
+        with tempfile.TemporaryDirectory() as temp_directory_name:
+            db_path = os.path.join(temp_directory_name, 'model')
+            trainer.predictor().save(db_path, 'minidb')
+            predictor = DiscreteActionPredictor.load(db_path, 'minidb')
+            expected, action_names = predictor.predict_array(states)
+
+            server = PredictionServer(
+                predictor, os.path.join(temp_directory_name, 'socket')
+            )
+            server.start_workers(2)
+            try:
+                with PredictionClient(server.address) as client:
+                    q_values, served_action_names = client.predict_array(
+                        states
+                    )
+                    actions = client.policy(states)
+                results = run_load(
+                    server.address, states, num_clients=2, num_requests=20
+                )
+            finally:
+                server.stop()
+
+        self.assertEqual(served_action_names, action_names)
+        np.testing.assert_allclose(q_values, expected, rtol=1e-5)
+        self.assertEqual(len(actions), 2 * len(states))
+        self.assertTrue(set(actions) <= set(action_names))
+        self.assertEqual(results['latency']['count'], 40)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from caffe2.python import workspace
+
+from ml.rl.serving.predictor_pool import PredictorPool
+from ml.rl.test.gridworld.gridworld import Gridworld
+from ml.rl.test.utils import small_discrete_action_trainer
+from ml.rl.training.discrete_action_predictor import DiscreteActionPredictor
+
+
+class TestPredictorPool(unittest.TestCase):
+    def test_pool_matches_predictor(self):
+        environment = Gridworld()
+        trainer = small_discrete_action_trainer(environment)
+        predictor = trainer.predictor()
+        states, _, _, _, _, _, _, _ = environment.generate_samples(64, 1.0)
+        expected, action_names = predictor.predict_array(states)
+
+        with tempfile.TemporaryDirectory() as temp_directory_name:
+            db_path = os.path.join(temp_directory_name, 'model')
+            predictor.save(db_path, 'minidb')
+            current_workspace = workspace.CurrentWorkspace()
+            workspaces = set(workspace.Workspaces())
+            pool = PredictorPool(db_path, 'minidb', 3, DiscreteActionPredictor)
+        # Loading happens in a private workspace object
+        self.assertEqual(workspace.CurrentWorkspace(), current_workspace)
+        self.assertEqual(set(workspace.Workspaces()), workspaces)
+
+        q_values, pool_action_names = pool.predict_array(states)
+        self.assertEqual(pool_action_names, action_names)
+        np.testing.assert_allclose(q_values, expected, rtol=1e-5)
+
+        starts = list(range(0, len(states), 8)) * 4
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = list(
+                executor.map(
+                    lambda i: pool.predict_array(states[i:i + 8]), starts
+                )
+            )
+        for i, (batch_q_values, _) in zip(starts, results):
+            np.testing.assert_allclose(
+                batch_q_values, expected[i:i + 8], rtol=1e-5
+            )
+
+    def test_action_mask_round_trip(self):
+        environment = Gridworld()
+        predictor = small_discrete_action_trainer(environment).predictor(
+            compact_output=True, action_mask=True
+        )
+        states, _, _, _, _, _, _, _ = environment.generate_samples(16, 1.0)
+        expected, _ = predictor.predict_array(states)
+        # Forbid the best action of every state
+        best_actions = np.argmax(expected, axis=1)
+        action_mask = np.ones_like(expected)
+        action_mask[np.arange(len(states)), best_actions] = 0
+        second_best_actions = np.argsort(-expected, axis=1)[:, 1]
+
+        with tempfile.TemporaryDirectory() as temp_directory_name:
+            db_path = os.path.join(temp_directory_name, 'model')
+            predictor.save(db_path, 'minidb')
+            previous_workspace = workspace.CurrentWorkspace()
+            # A fresh workspace holds only what the db stores
+            workspace.SwitchWorkspace('action_mask_round_trip', True)
+            try:
+                loaded = DiscreteActionPredictor.load(db_path, 'minidb')
+                loaded_indices, _ = loaded.policy_indices(
+                    states, action_mask=action_mask
+                )
+            finally:
+                workspace.ResetWorkspace()
+                workspace.SwitchWorkspace(previous_workspace)
+            pool = PredictorPool(db_path, 'minidb', 2, DiscreteActionPredictor)
+
+        np.testing.assert_array_equal(
+            loaded_indices[:, 0], second_best_actions
+        )
+        with pool.instance() as pool_predictor:
+            pool_indices, _ = pool_predictor.policy_indices(
+                states, action_mask=action_mask
+            )
+        np.testing.assert_array_equal(pool_indices[:, 0], second_best_actions)
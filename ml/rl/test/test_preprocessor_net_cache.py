@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import unittest
+
+from caffe2.python import core, workspace
+
+from ml.rl.caffe_utils import C2, StackedAssociativeArray
+from ml.rl.preprocessing import preprocessor_net_cache
+from ml.rl.preprocessing.preprocessor_net import PreprocessorNet
+from ml.rl.test.gridworld.gridworld import Gridworld
+
+
+class TestPreprocessorNetCache(unittest.TestCase):
+    def test_cache(self):
+        normalization = Gridworld().normalization
+        rows = [{0: 1.0}, {3: 1.0, 5: 0.0}, {}]
+        preprocessor_net_cache.clear_cache()
+        preprocessing_net = preprocessor_net_cache.get_sparse_preprocessing_net(
+            normalization, True
+        )
+        self.assertIs(
+            preprocessor_net_cache.get_sparse_preprocessing_net(
+                normalization, True
+            ), preprocessing_net
+        )
+        self.assertIsNot(
+            preprocessor_net_cache.get_sparse_preprocessing_net(
+                normalization, False
+            ), preprocessing_net
+        )
+        fused_net = preprocessor_net_cache.get_sparse_preprocessing_net(
+            normalization, True, fused=True
+        )
+        self.assertIsNot(fused_net, preprocessing_net)
+        np.testing.assert_allclose(
+            fused_net.normalize(rows),
+            preprocessing_net.normalize(rows),
+            rtol=1e-6
+        )
+        cached = preprocessing_net.normalize(rows)
+        # Calls with other batches reuse the same net
+        self.assertEqual(preprocessing_net.normalize(rows[:1]).shape[0], 1)
+
+        net = core.Net('uncached_preprocessing')
+        C2.set_net(net)
+        preprocessor = PreprocessorNet(net, True)
+        saa = StackedAssociativeArray.from_dict_list(rows, 'uncached')
+        output_blob, _ = preprocessor.normalize_sparse_matrix(
+            saa.lengths, saa.keys, saa.values, normalization, 'uncached'
+        )
+        workspace.RunNetOnce(net)
+        np.testing.assert_array_equal(cached, workspace.FetchBlob(output_blob))
+
+        workspace.ResetWorkspace()
+        self.assertFalse(preprocessing_net.is_valid())
+        rebuilt = preprocessor_net_cache.get_sparse_preprocessing_net(
+            normalization, True
+        )
+        self.assertIsNot(rebuilt, preprocessing_net)
+        np.testing.assert_array_equal(rebuilt.normalize(rows), cached)
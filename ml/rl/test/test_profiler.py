@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import json
+import numpy as np
+import unittest
+
+from caffe2.python import core, workspace
+
+from ml.rl.profiler import Histogram, LatencyTracker, Profiler
+
+
+class TestProfiler(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram(min_value=1.0)
+        for value in [0.5, 1.5, 3.0, 3.5, 100.0]:
+            histogram.add(value)
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.buckets[:3], [1, 1, 2])
+        self.assertEqual(histogram.percentile(50), 4.0)
+        self.assertEqual(histogram.percentile(100), 100.0)
+
+    def test_disabled_records_nothing(self):
+        profiler = Profiler()
+        profiler.feed_blob('profiler_input', np.ones(4, dtype=np.float32))
+        profiler.fetch_blob('profiler_input')
+        self.assertEqual(len(profiler.feed_times), 0)
+        self.assertEqual(len(profiler.fetch_times), 0)
+
+    def test_records_nets_and_blobs(self):
+        net = core.Net("profiler_test_net")
+        net.Relu(['profiler_input'], ['profiler_output'])
+        profiler = Profiler(enabled=True)
+        profiler.feed_blob('profiler_input', np.ones(4, dtype=np.float32))
+        workspace.CreateNet(net)
+        for _ in range(3):
+            profiler.run_net('relu', net)
+        profiler.fetch_blob('profiler_output')
+        operator_times = profiler.benchmark_net('relu', net, 0, 2)
+
+        summary = json.loads(profiler.to_json())
+        self.assertEqual(summary['nets']['relu']['count'], 3)
+        self.assertEqual(summary['feed']['profiler_input']['bytes'], 16)
+        self.assertEqual(summary['fetch']['profiler_output']['bytes'], 16)
+        self.assertIn('Relu', operator_times)
+
+    def test_latency_tracker(self):
+        tracker = LatencyTracker()
+        with tracker.call('policy', 3):
+            tracker.mark('feed')
+        self.assertEqual(tracker.summary(), {})
+
+        tracker.enable()
+        for batch_size in [1, 3, 4, 5]:
+            with tracker.call('policy', batch_size):
+                tracker.mark('build_input')
+                with tracker.call('predict_array', batch_size):
+                    tracker.mark('run')
+                tracker.mark('fetch')
+        summary = json.loads(tracker.to_json())
+        self.assertEqual(sorted(summary.keys()), ['policy'])
+        self.assertEqual(sorted(summary['policy'].keys()), ['1', '4', '8'])
+        self.assertEqual(summary['policy']['4']['total']['count'], 2)
+        self.assertEqual(
+            sorted(summary['policy']['1'].keys()),
+            ['build_input', 'fetch', 'run', 'total'],
+        )
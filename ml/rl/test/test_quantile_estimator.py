@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import unittest
+
+from ml.rl.training.quantile_estimator import P2QuantileEstimator
+
+
+class TestQuantileEstimator(unittest.TestCase):
+    def test_matches_percentile(self):
+        np.random.seed(0)
+        values = np.random.normal(size=20000)
+        for percentile in [10, 50, 90]:
+            estimator = P2QuantileEstimator(percentile)
+            for batch in np.array_split(values, 20):
+                estimator.update(batch)
+            self.assertAlmostEqual(
+                estimator.value(), np.percentile(values, percentile), 1
+            )
+
+    def test_few_observations(self):
+        estimator = P2QuantileEstimator(50)
+        self.assertEqual(estimator.value(), 0.0)
+        estimator.update([3.0, 1.0, 2.0])
+        self.assertEqual(estimator.value(), 2.0)
+
+    def test_reset(self):
+        estimator = P2QuantileEstimator(50)
+        estimator.update(np.arange(100, dtype=np.float32))
+        estimator.reset()
+        self.assertEqual(estimator.count, 0)
+        estimator.update(np.ones(10))
+        self.assertEqual(estimator.value(), 1.0)
+
+    def test_large_batch_merged(self):
+        np.random.seed(0)
+        values = np.random.normal(size=1000)
+        for percentile in [50, 95]:
+            estimator = P2QuantileEstimator(percentile)
+            estimator.update(values)
+            self.assertEqual(estimator.count, len(values))
+            self.assertAlmostEqual(
+                estimator.value(), np.percentile(values, percentile)
+            )
+            # Sorted batches must not bias the markers
+            sorted_estimator = P2QuantileEstimator(percentile)
+            sorted_estimator.update(np.sort(values))
+            self.assertEqual(sorted_estimator.value(), estimator.value())
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+
+import numpy as np
+
+from ml.rl.test.gridworld.gridworld import Gridworld
+from ml.rl.test.utils import small_discrete_action_trainer
+from ml.rl.training.result_cache import ResultCache, select_states, state_keys
+from ml.rl.training.rl_predictor import sparse_features
+
+
+class TestResultCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = ResultCache(max_entries=2)
+        cache.put(b'a', 1)
+        cache.put(b'b', 2)
+        self.assertEqual(cache.get(b'a'), 1)
+        cache.put(b'c', 3)
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(cache.get(b'a'), 1)
+        self.assertEqual(cache.get(b'c'), 3)
+        self.assertEqual(cache.stats()['hits'], 3)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_ttl(self):
+        cache = ResultCache(ttl=0.01)
+        cache.put(b'a', 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(b'a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_state_keys(self):
+        features = sparse_features(
+            [{1: 0.5}, {1: 0.5, 2: 1.0}, {1: 0.5}, {}], np.float32
+        )
+        keys = state_keys(features)
+        self.assertEqual(keys[0], keys[2])
+        self.assertEqual(len(set(keys)), 3)
+        lengths, feature_keys, values = select_states(features, [1, 3])
+        np.testing.assert_array_equal(lengths, [2, 0])
+        np.testing.assert_array_equal(feature_keys, [1, 2])
+        np.testing.assert_array_equal(values, [0.5, 1.0])
+
+    def test_cached_predictor(self):
+        environment = Gridworld()
+        trainer = small_discrete_action_trainer(environment)
+        predictor = trainer.predictor()
+        states, _, _, _, _, _, _, _ = environment.generate_samples(16, 1.0)
+        expected, action_names = predictor.predict_array(states)
+        expected_policy = predictor.policy(states)
+
+        predictor.enable_cache()
+        predictor.predict_array(states[:8])
+        q_values, cached_action_names = predictor.predict_array(states)
+        self.assertEqual(cached_action_names, action_names)
+        np.testing.assert_allclose(q_values, expected, rtol=1e-5)
+        self.assertGreaterEqual(predictor.cache.stats()['hits'], 8)
+
+        policy = predictor.policy(states)
+        self.assertEqual(len(policy), len(expected_policy))
+        self.assertEqual(list(policy[0::2]), list(expected_policy[0::2]))
+        self.assertTrue(
+            set(policy[1::2]) <= set(predictor._action_name_values)
+        )
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import unittest
+
+from scipy import stats
+
+from ml.rl.preprocessing import identify_types
+from ml.rl.preprocessing import normalization
+from ml.rl.preprocessing.quantile_sketch import QuantileSketch
+from ml.rl.preprocessing.streaming_normalization import NormalizationFitter, \
+    fit_normalization_parameters, normaltest_from_moments
+from ml.rl.test import preprocessing_util
+
+
+class TestStreamingNormalization(unittest.TestCase):
+    def _assert_parameters_close(self, expected, actual, quantile_atol):
+        self.assertEqual(expected.feature_type, actual.feature_type)
+        self.assertEqual(expected.possible_values, actual.possible_values)
+        self.assertEqual(expected.boxcox_shift is None,
+                         actual.boxcox_shift is None)
+        if expected.boxcox_lambda is not None:
+            self.assertAlmostEqual(
+                expected.boxcox_lambda, actual.boxcox_lambda, 3
+            )
+        self.assertAlmostEqual(expected.mean, actual.mean, 3)
+        self.assertAlmostEqual(expected.stddev, actual.stddev, 3)
+        if expected.quantiles is not None:
+            np.testing.assert_allclose(
+                expected.quantiles, actual.quantiles, atol=quantile_atol
+            )
+
+    def test_normaltest_from_moments(self):
+        np.random.seed(0)
+        values = stats.expon.rvs(size=1000)
+        k2, p = normaltest_from_moments(
+            len(values), stats.skew(values),
+            stats.kurtosis(values, fisher=False)
+        )
+        expected_k2, expected_p = stats.normaltest(values)
+        self.assertAlmostEqual(k2, expected_k2, 6)
+        self.assertAlmostEqual(p, expected_p, 6)
+
+    def test_quantile_sketch(self):
+        np.random.seed(0)
+        values = np.random.normal(size=100000)
+        sketch = QuantileSketch(buffer_size=10000)
+        other = QuantileSketch(buffer_size=10000)
+        sketch.update(values[:60000])
+        other.update(values[60000:])
+        sketch.merge(other)
+        probabilities = np.linspace(0, 1, 21)
+        np.testing.assert_allclose(
+            sketch.quantiles(probabilities),
+            np.percentile(values, probabilities * 100),
+            atol=0.02,
+        )
+        self.assertLess(len(sketch._means), 400)
+
+    def test_matches_identify_parameter(self):
+        features, feature_value_map = preprocessing_util.read_data()
+        chunks = [
+            {
+                feature: feature_value_map[feature][start:start + 1000]
+                for feature in features
+            } for start in range(0, 10000, 1000)
+        ]
+        streamed = fit_normalization_parameters(
+            chunks, max_unique_enum_values=10
+        )
+        for feature in features:
+            expected = normalization.identify_parameter(
+                feature_value_map[feature], 10
+            )
+            self._assert_parameters_close(
+                expected, streamed[feature], quantile_atol=0.1
+            )
+        self.assertEqual(
+            streamed[identify_types.BOXCOX].feature_type, identify_types.BOXCOX
+        )
+        self.assertEqual(
+            streamed[identify_types.QUANTILE].feature_type,
+            identify_types.QUANTILE
+        )
+
+    def test_merge_shards(self):
+        _, feature_value_map = preprocessing_util.read_data()
+        for feature in [
+            identify_types.CONTINUOUS, identify_types.ENUM,
+            identify_types.QUANTILE
+        ]:
+            values = feature_value_map[feature]
+            shards = []
+            for shard_values in np.array_split(values, 4):
+                fitter = NormalizationFitter(10, seed=0)
+                fitter.update(shard_values)
+                shards.append(fitter)
+            merged = shards[0]
+            for shard in shards[1:]:
+                merged.merge(shard)
+            self.assertEqual(merged.count, len(values))
+            self._assert_parameters_close(
+                normalization.identify_parameter(values, 10),
+                merged.finalize(),
+                quantile_atol=0.1,
+            )
+
+    def test_enum_threshold(self):
+        fitter = NormalizationFitter(max_unique_enum_values=5)
+        fitter.update(np.arange(4, dtype=np.float32) + 2)
+        self.assertEqual(fitter.identify_type(), identify_types.ENUM)
+        fitter.update(np.arange(4, dtype=np.float32) + 10)
+        self.assertEqual(fitter.identify_type(), identify_types.CONTINUOUS)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import numpy as np
 import unittest
 
 from ml.rl.preprocessing import identify_types
@@ -33,3 +34,28 @@ class TestTypeIdentification(unittest.TestCase):
         self.assertEqual(
             types[identify_types.PROBABILITY], identify_types.PROBABILITY
         )
+
+    def test_identification_matrix(self):
+        features, feature_value_map = preprocessing_util.read_data()
+        matrix = np.stack([feature_value_map[f] for f in features], axis=1)
+        types = identify_types.identify_types_matrix(matrix, 10)
+        # The test data names every column after the type it was drawn from,
+        #     with a "_2" suffix for the second column of a type.  BOXCOX and
+        #     QUANTILE columns are not identified yet.
+        expected_types = {
+            identify_types.BOXCOX: identify_types.CONTINUOUS,
+            identify_types.QUANTILE: identify_types.CONTINUOUS,
+        }
+        self.assertEqual(
+            types, [
+                expected_types.get(f.split('_')[0], f.split('_')[0])
+                for f in features
+            ]
+        )
+
+        # Integer columns just under and over the enum threshold
+        matrix = np.stack([np.arange(20) % 10, np.arange(20) % 11], axis=1)
+        self.assertEqual(
+            identify_types.identify_types_matrix(matrix * 100, 10),
+            [identify_types.ENUM, identify_types.CONTINUOUS]
+        )
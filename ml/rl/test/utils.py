@@ -3,6 +3,9 @@
 import collections
 
 from ml.rl.preprocessing.normalization import NormalizationParameters
+from ml.rl.thrift.core.ttypes import \
+    RLParameters, TrainingParameters, DiscreteActionModelParameters
+from ml.rl.training.discrete_action_trainer import DiscreteActionTrainer
 
 
 def default_normalizer(feats):
@@ -23,3 +26,24 @@ def default_normalizer(feats):
         ]
     )
     return normalization
+
+
+def small_discrete_action_trainer(environment):
+    """
+    An untrained DiscreteActionTrainer with one small hidden layer for
+    `environment`, e.g. a Gridworld, for tests that only need a predictor.
+    """
+    return DiscreteActionTrainer(
+        DiscreteActionModelParameters(
+            actions=environment.ACTIONS,
+            rl=RLParameters(gamma=0.9, target_update_rate=0.5),
+            training=TrainingParameters(
+                layers=[-1, 16, -1],
+                activations=['relu', 'linear'],
+                minibatch_size=32,
+                learning_rate=0.01,
+                optimizer='ADAM',
+            ),
+        ),
+        environment.normalization,
+    )
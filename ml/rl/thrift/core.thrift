@@ -37,6 +37,7 @@ struct TrainingParameters {
   8: double dropout_ratio = 0.0,
   9: optional string warm_start_model_path,
   10: optional CNNParameters cnn_parameters,
+  11: optional i32 enum_embedding_dim,
 }
 
 struct ActionBudget {
@@ -44,6 +45,8 @@ struct ActionBudget {
   2: double action_limit,
   3: double quantile_update_rate = 0.01,
   4: i32 quantile_update_frequency = 10,
+  // Deprecated and ignored: the quantile is now a streaming P-square
+  // estimate, see ml/rl/training/quantile_estimator.py
   5: i32 window_size = 16384,
 }
 
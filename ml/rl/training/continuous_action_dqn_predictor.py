@@ -6,7 +6,11 @@ from caffe2.proto import caffe2_pb2
 from caffe2.python.predictor.predictor_exporter import PredictorExportMeta
 from caffe2.python import model_helper, workspace
 from ml.rl.caffe_utils import C2
-from ml.rl.preprocessing.preprocessor_net import PreprocessorNet
+from ml.rl.preprocessing.normalization import get_num_output_features
+from ml.rl.preprocessing.preprocessor_net import FoldedNormalizedInput, \
+    PreprocessorNet, get_folded_affine
+from ml.rl.training.normalization_folding import CLIPPED_SAMPLE_STDDEVS, \
+    SAMPLE_STDDEVS, check_folded_predictor, sample_states
 from ml.rl.training.rl_predictor import RLPredictor
 
 import logging
@@ -32,20 +36,32 @@ class ContinuousActionDQNPredictor(RLPredictor):
         :param int_state_features states as list of feature -> int value dict
         :param actions actions as list of feature -> value dict
         """
-        float_examples = []
-        for i in range(len(float_state_features)):
-            float_examples.append({**float_state_features[i], **actions[i]})
-        if int_state_features is None:
-            return RLPredictor.predict(self, float_examples)
-        return RLPredictor.predict(self, float_examples, int_state_features)
+        with self.latency.call('predict', len(float_state_features)):
+            float_examples = []
+            for i in range(len(float_state_features)):
+                float_examples.append(
+                    {**float_state_features[i], **actions[i]}
+                )
+            self.latency.mark('build_input')
+            if int_state_features is None:
+                return RLPredictor.predict(self, float_examples)
+            return RLPredictor.predict(
+                self, float_examples, int_state_features
+            )
 
     def policy(self, float_state_features, int_state_features, actions):
-        float_examples = []
-        for i in range(len(float_state_features)):
-            float_examples.append({**float_state_features[i], **actions[i]})
-        if int_state_features is None:
-            return RLPredictor.policy(self, float_examples)
-        return RLPredictor.policy(self, float_examples, int_state_features)
+        with self.latency.call('policy', len(float_state_features)):
+            float_examples = []
+            for i in range(len(float_state_features)):
+                float_examples.append(
+                    {**float_state_features[i], **actions[i]}
+                )
+            self.latency.mark('build_input')
+            if int_state_features is None:
+                return RLPredictor.policy(self, float_examples)
+            return RLPredictor.policy(
+                self, float_examples, int_state_features
+            )
 
     def get_predictor_export_meta(self):
         return PredictorExportMeta(
@@ -59,6 +75,10 @@ class ContinuousActionDQNPredictor(RLPredictor):
         state_normalization_parameters,
         action_normalization_parameters,
         int_features=False,
+        sparse_input=False,
+        fold_normalization=False,
+        clip_anomalies=True,
+        fused=False,
     ):
         """ Creates a ContinuousActionDQNPredictor from a ContinuousActionDQNTrainer.
 
@@ -66,6 +86,18 @@ class ContinuousActionDQNPredictor(RLPredictor):
         :param state_normalization_parameters state NormalizationParameters
         :param action_normalization_parameters action NormalizationParameters
         :param int_features boolean indicating if int features blob will be present
+        :param sparse_input boolean indicating if BINARY, PROBABILITY and
+            CONTINUOUS state features are fed to the first layer as sparse
+            (column, value) pairs instead of a dense matrix
+        :param fold_normalization boolean indicating if the mean and stddev
+            of CONTINUOUS and BOXCOX state and action features are folded into
+            the first layer, see `DiscreteActionPredictor.export`
+        :param clip_anomalies boolean indicating if normalized CONTINUOUS and
+            BOXCOX state and action features are clipped to 3 stddevs, as in
+            training.  Must be False with fold_normalization.
+        :param fused boolean indicating if state and action features are
+            preprocessed in the fused mode of `PreprocessorNet`, which
+            fold_normalization always uses
         """
         # ensure state and action IDs have no intersection
         assert (
@@ -74,6 +106,23 @@ class ContinuousActionDQNPredictor(RLPredictor):
                 set(action_normalization_parameters.keys())
             ) == 0
         )
+        if fold_normalization:
+            assert not sparse_input, "Folding needs dense state features"
+            assert not clip_anomalies, \
+                "Folded features cannot be clipped, pass clip_anomalies=False"
+            reference = cls.export(
+                trainer,
+                state_normalization_parameters,
+                action_normalization_parameters,
+                int_features,
+                clip_anomalies=False,
+            )
+            clipped_reference = cls.export(
+                trainer,
+                state_normalization_parameters,
+                action_normalization_parameters,
+                int_features,
+            )
 
         model = model_helper.ModelHelper(name="predictor")
         net = model.net
@@ -127,17 +176,32 @@ class ContinuousActionDQNPredictor(RLPredictor):
                 ['input/float_features.values'], [input_feature_values]
             )
 
-        preprocessor = PreprocessorNet(net, True)
+        preprocessor = PreprocessorNet(
+            net,
+            clip_anomalies,
+            fused=fused or fold_normalization,
+            fold_affine=fold_normalization,
+        )
         parameters = []
         parameters.extend(preprocessor.parameters)
-        state_normalized_dense_matrix, new_parameters = \
-            preprocessor.normalize_sparse_matrix(
-                input_feature_lengths,
-                input_feature_keys,
-                input_feature_values,
-                state_normalization_parameters,
-                'state_norm',
-            )
+        if sparse_input:
+            state_normalized, new_parameters = \
+                preprocessor.normalize_sparse_features(
+                    input_feature_lengths,
+                    input_feature_keys,
+                    input_feature_values,
+                    state_normalization_parameters,
+                    'state_norm',
+                )
+        else:
+            state_normalized, new_parameters = \
+                preprocessor.normalize_sparse_matrix(
+                    input_feature_lengths,
+                    input_feature_keys,
+                    input_feature_values,
+                    state_normalization_parameters,
+                    'state_norm',
+                )
         parameters.extend(new_parameters)
         action_normalized_dense_matrix, new_parameters = \
             preprocessor.normalize_sparse_matrix(
@@ -148,13 +212,54 @@ class ContinuousActionDQNPredictor(RLPredictor):
                 'action_norm',
             )
         parameters.extend(new_parameters)
-        state_action_normalized = 'state_action_normalized'
-        state_action_normalized_dim = 'state_action_normalized_dim'
-        net.Concat(
-            [state_normalized_dense_matrix, action_normalized_dense_matrix],
-            [state_action_normalized, state_action_normalized_dim],
-            axis=1
-        )
+        if sparse_input:
+            # Actions are few, so they join the dense columns that follow the
+            #     state columns
+            num_action_columns = get_num_output_features(
+                action_normalization_parameters
+            )
+            dense_columns = list(state_normalized.dense_columns) + list(
+                range(
+                    state_normalized.num_columns,
+                    state_normalized.num_columns + num_action_columns
+                )
+            )
+            if state_normalized.dense_matrix is None:
+                dense_matrix = action_normalized_dense_matrix
+            else:
+                dense_matrix = 'state_action_normalized_dense'
+                net.Concat(
+                    [
+                        state_normalized.dense_matrix,
+                        action_normalized_dense_matrix
+                    ], [dense_matrix, dense_matrix + '_dim'],
+                    axis=1
+                )
+            state_action_normalized = state_normalized._replace(
+                dense_matrix=dense_matrix,
+                dense_columns=dense_columns,
+                num_columns=state_normalized.num_columns + num_action_columns,
+            )
+        else:
+            state_action_normalized = 'state_action_normalized'
+            state_action_normalized_dim = 'state_action_normalized_dim'
+            net.Concat(
+                [state_normalized, action_normalized_dense_matrix],
+                [state_action_normalized, state_action_normalized_dim],
+                axis=1
+            )
+            if fold_normalization:
+                state_scale, state_shift = get_folded_affine(
+                    state_normalization_parameters
+                )
+                action_scale, action_shift = get_folded_affine(
+                    action_normalization_parameters
+                )
+                state_action_normalized = FoldedNormalizedInput(
+                    state_action_normalized,
+                    np.concatenate([state_scale, action_scale]),
+                    np.concatenate([state_shift, action_shift]),
+                )
         new_parameters, q_values = RLPredictor._forward_pass(
             model,
             trainer,
@@ -231,4 +336,23 @@ class ContinuousActionDQNPredictor(RLPredictor):
 
         workspace.RunNetOnce(model.param_init_net)
         workspace.CreateNet(net)
-        return ContinuousActionDQNPredictor(net, parameters, int_features)
+        predictor = ContinuousActionDQNPredictor(net, parameters, int_features)
+        if fold_normalization:
+            for stddevs, expected in [
+                (SAMPLE_STDDEVS, reference),
+                (CLIPPED_SAMPLE_STDDEVS, clipped_reference),
+            ]:
+                states = sample_states(
+                    state_normalization_parameters, 100, stddevs=stddevs
+                )
+                actions = sample_states(
+                    action_normalization_parameters,
+                    100,
+                    missing_probability=0.0,
+                    stddevs=stddevs
+                )
+                check_folded_predictor(
+                    expected, predictor,
+                    [{**s, **a} for s, a in zip(states, actions)]
+                )
+        return predictor
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 
-from typing import Dict
+from typing import Dict, Optional
 
 import logging
 logger = logging.getLogger(__name__)
 
+import numpy as np
+
 import caffe2.proto.caffe2_pb2 as caffe2_pb2
 from caffe2.python import workspace
 from caffe2.python.model_helper import ModelHelper
@@ -29,8 +31,16 @@ class ContinuousActionDQNTrainer(RLTrainer):
         state_normalization_parameters: Dict[int, NormalizationParameters],
         action_normalization_parameters: Dict[int, NormalizationParameters],
         additional_feature_types:
-        AdditionalFeatureTypes = DEFAULT_ADDITIONAL_FEATURE_TYPES
+        AdditionalFeatureTypes = DEFAULT_ADDITIONAL_FEATURE_TYPES,
+        action_catalog: Optional[np.ndarray] = None,
     ) -> None:
+        """
+        :param action_catalog: Normalized features of a fixed set of candidate
+            actions, one row per action.  When set, the catalog stays in the
+            workspace and possible next actions are given as row indices into
+            it ('possible_next_actions_indices') instead of feature rows.  See
+            `set_action_catalog` and `internal_catalog_policy_model`.
+        """
         self._additional_feature_types = additional_feature_types
         self.state_normalization_parameters = state_normalization_parameters
         self.action_normalization_parameters = action_normalization_parameters
@@ -52,9 +62,31 @@ class ContinuousActionDQNTrainer(RLTrainer):
         parameters.training.layers[0] = num_features
         parameters.training.layers[-1] = 1
 
+        self.action_catalog_size: Optional[int] = None
+        if action_catalog is not None:
+            self.set_action_catalog(action_catalog)
+            workspace.FeedBlob(
+                'possible_next_actions_indices', np.zeros(0, dtype=np.int32)
+            )
+
         RLTrainer.__init__(self, parameters)
 
         self._create_internal_policy_net()
+        if self.action_catalog_size is not None:
+            self._create_internal_catalog_policy_net()
+
+    def set_action_catalog(self, action_catalog: np.ndarray) -> None:
+        """
+        Stores the normalized candidate action matrix in the workspace.  Can be
+        called again to replace the catalog, e.g. when actions are added; the
+        nets read it on every run.
+        """
+        action_catalog = np.asarray(action_catalog, dtype=np.float32)
+        assert action_catalog.ndim == 2 and action_catalog.shape[1] == \
+            get_num_output_features(self.action_normalization_parameters), \
+            "Catalog rows must hold normalized action features"
+        self.action_catalog_size = action_catalog.shape[0]
+        workspace.FeedBlob('action_catalog', action_catalog)
 
     def _create_internal_policy_net(self) -> None:
         self.internal_policy_model = ModelHelper(
@@ -68,7 +100,42 @@ class ContinuousActionDQNTrainer(RLTrainer):
         workspace.CreateNet(self.internal_policy_model.net)
         C2.set_model(None)
 
+    def _create_internal_catalog_policy_net(self) -> None:
+        """
+        Scores candidate actions from the catalog.  Inputs are 'states', the
+        catalog rows to score ('candidate_indices') and how many of them
+        belong to each state ('candidate_lengths'); the output holds one Q
+        value per candidate, grouped by state.
+        """
+        workspace.FeedBlob('candidate_indices', np.zeros(0, dtype=np.int32))
+        workspace.FeedBlob('candidate_lengths', np.zeros(0, dtype=np.int32))
+        self.internal_catalog_policy_model = ModelHelper(
+            name="catalog_q_score_" + self.model_id
+        )
+        C2.set_model(self.internal_catalog_policy_model)
+        stacked_states = C2.LengthsTile('states', 'candidate_lengths')
+        candidate_actions = C2.Gather('action_catalog', 'candidate_indices')
+        self.internal_catalog_policy_output = C2.FlattenToVec(
+            self.get_q_values(stacked_states, candidate_actions, False)
+        )
+        workspace.RunNetOnce(self.internal_catalog_policy_model.param_init_net)
+        workspace.CreateNet(self.internal_catalog_policy_model.net)
+        C2.set_model(None)
+
+    def named_nets(self):
+        nets = RLTrainer.named_nets(self)
+        nets["internal_policy"] = self.internal_policy_model.net
+        if self.action_catalog_size is not None:
+            nets["internal_catalog_policy"] = \
+                self.internal_catalog_policy_model.net
+        return nets
+
     def get_possible_next_actions(self):
+        if self.action_catalog_size is not None:
+            return StackedArray(
+                'possible_next_actions_lengths',
+                C2.Gather('action_catalog', 'possible_next_actions_indices'),
+            )
         return StackedArray(
             'possible_next_actions_lengths',
             'possible_next_actions',
@@ -225,14 +292,34 @@ class ContinuousActionDQNTrainer(RLTrainer):
         workspace.CreateNet(self.rl_train_model.net)
         C2.set_model(None)
 
-    def predictor(self) -> ContinuousActionDQNPredictor:
+    def predictor(
+        self,
+        sparse_input=False,
+        fold_normalization=False,
+        clip_anomalies=True,
+        fused=False,
+    ) -> ContinuousActionDQNPredictor:
         """
         Builds a ContinuousActionPredictor using the MLTrainer underlying this
         ContinuousActionTrainer.
+
+        :param sparse_input: Feed sparse state features to the first layer
+            without densifying them, see
+            `ContinuousActionDQNPredictor.export`.
+        :param fold_normalization: Fold state (and action) normalization
+            into the first layer, see `ContinuousActionDQNPredictor.export`.
+        :param clip_anomalies: Clip normalized state and action features to
+            3 stddevs.  Must be False with fold_normalization.
+        :param fused: Preprocess state and action features in the fused mode
+            of `PreprocessorNet`, see `ContinuousActionDQNPredictor.export`.
         """
         return ContinuousActionDQNPredictor.export(
             self,
             self.state_normalization_parameters,
             self.action_normalization_parameters,
             self._additional_feature_types.int_features,
+            sparse_input,
+            fold_normalization,
+            clip_anomalies,
+            fused,
         )
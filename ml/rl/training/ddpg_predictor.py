@@ -10,7 +10,10 @@ from caffe2.python.predictor_constants import predictor_constants
 from caffe2.python.predictor.predictor_py_utils import GetBlobs
 
 from ml.rl.caffe_utils import C2, PytorchCaffe2Converter
+from ml.rl.profiler import LatencyTracker, Profiler
 from ml.rl.preprocessing.preprocessor_net import PreprocessorNet
+from ml.rl.training.mapped_model import load_mapped, save_mapped
+from ml.rl.training.rl_predictor import sparse_features
 
 import logging
 logger = logging.getLogger(__name__)
@@ -38,6 +41,20 @@ class DDPGPredictor(object):
             'output/float_features.values',
         ]
         self._parameters = parameters
+        # Opt-in timing of feeds, net runs and fetches, see `Profiler`
+        self.profiler = Profiler()
+        # Set by `load_mapped`
+        self.mapped_model = None
+        # Opt-in per-call latency breakdown, see `LatencyTracker`
+        self.latency = LatencyTracker()
+
+    def use_workspace(self, ws):
+        """
+        Sends this predictor's feeds, fetches and net runs to `ws` (see
+        `Profiler`) instead of the current workspace.  The predictor net must
+        already be created there.
+        """
+        self.profiler.ws = ws
 
     def policy(self):
         """TODO: Return actions when exporting final net and fill in this
@@ -51,48 +68,12 @@ class DDPGPredictor(object):
         :param float_state_features A list of feature -> float value dict examples
         :param int_features A list of feature -> int value dict examples
         """
-        workspace.FeedBlob(
-            'input/float_features.lengths',
-            np.array([len(e) for e in float_state_features], dtype=np.int32)
-        )
-        workspace.FeedBlob(
-            'input/float_features.keys',
-            np.array(
-                [list(e.keys()) for e in float_state_features], dtype=np.int64
-            ).flatten()
-        )
-        workspace.FeedBlob(
-            'input/float_features.values',
-            np.array(
-                [list(e.values()) for e in float_state_features],
-                dtype=np.float32
-            ).flatten()
-        )
-
-        if int_state_features:
-            workspace.FeedBlob(
-                'input/int_features.lengths',
-                np.array([len(e) for e in int_state_features], dtype=np.int32)
-            )
-            workspace.FeedBlob(
-                'input/int_features.keys',
-                np.array(
-                    [list(e.keys()) for e in int_state_features],
-                    dtype=np.int64
-                ).flatten()
-            )
-            workspace.FeedBlob(
-                'input/int_features.values',
-                np.array(
-                    [list(e.values()) for e in int_state_features],
-                    dtype=np.int32
-                ).flatten()
-            )
-
-        workspace.RunNet(self._net)
-
-        results = workspace.FetchBlob('output/float_features.values')
-        return results
+        with self.latency.call('actor_prediction', len(float_state_features)):
+            float_features = sparse_features(float_state_features, np.float32)
+            int_features = sparse_features(int_state_features, np.int32) \
+                if int_state_features else None
+            self.latency.mark('build_input')
+            return self._run(float_features, int_features)
 
     def critic_prediction(
         self, float_state_features, int_state_features, actions
@@ -104,49 +85,36 @@ class DDPGPredictor(object):
         :param int_state_features states as list of feature -> int value dict
         :param actions actions as list of feature -> value dict
         """
-        float_examples = []
-        for i in range(len(float_state_features)):
-            float_examples.append({**float_state_features[i], **actions[i]})
-
-        workspace.FeedBlob(
-            'input/float_features.lengths',
-            np.array([len(e) for e in float_examples], dtype=np.int32)
-        )
-        workspace.FeedBlob(
-            'input/float_features.keys',
-            np.array([list(e.keys()) for e in float_examples],
-                     dtype=np.int64).flatten()
-        )
-        workspace.FeedBlob(
-            'input/float_features.values',
-            np.array(
-                [list(e.values()) for e in float_examples], dtype=np.float32
-            ).flatten()
-        )
-
-        if int_state_features is not None:
-            workspace.FeedBlob(
-                'input/int_features.lengths',
-                np.array([len(e) for e in int_state_features], dtype=np.int32)
-            )
-            workspace.FeedBlob(
-                'input/int_features.keys',
-                np.array(
-                    [list(e.keys()) for e in int_state_features],
-                    dtype=np.int64
-                ).flatten()
-            )
-            workspace.FeedBlob(
-                'input/int_features.values',
-                np.array(
-                    [list(e.values()) for e in int_state_features],
-                    dtype=np.int32
-                ).flatten()
-            )
-
-        workspace.RunNet(self._net)
-
-        results = workspace.FetchBlob('output/float_features.values')
+        with self.latency.call('critic_prediction', len(float_state_features)):
+            float_examples = []
+            for i in range(len(float_state_features)):
+                float_examples.append(
+                    {**float_state_features[i], **actions[i]}
+                )
+            float_features = sparse_features(float_examples, np.float32)
+            int_features = sparse_features(int_state_features, np.int32) \
+                if int_state_features is not None else None
+            self.latency.mark('build_input')
+            return self._run(float_features, int_features)
+
+    def _run(self, float_features, int_features):
+        for name, features in [
+            ('float_features', float_features),
+            ('int_features', int_features),
+        ]:
+            if features is None:
+                continue
+            lengths, keys, values = features
+            self.profiler.feed_blob('input/{}.lengths'.format(name), lengths)
+            self.profiler.feed_blob('input/{}.keys'.format(name), keys)
+            self.profiler.feed_blob('input/{}.values'.format(name), values)
+        self.latency.mark('feed')
+
+        self.profiler.run_net('predictor', self._net)
+        self.latency.mark('run')
+
+        results = self.profiler.fetch_blob('output/float_features.values')
+        self.latency.mark('fetch')
         return results
 
     def get_predictor_export_meta(self):
@@ -175,16 +143,40 @@ class DDPGPredictor(object):
         save_to_db(db_type, db_path, meta)
 
     @classmethod
-    def load(cls, db_path, db_type):
+    def load(cls, db_path, db_type, int_features=False):
         """ Creates Predictor by loading from a database
 
         :param db_path see load_from_db
         :param db_type see load_from_db
+        :param int_features bool indicating if int_features are present
         """
         net = prepare_prediction_net(db_path, db_type)
         meta = load_from_db(db_path, db_type)
         parameters = GetBlobs(meta, predictor_constants.PARAMETERS_BLOB_TYPE)
-        return cls(net, parameters)
+        return cls(net, parameters, int_features)
+
+    def save_mapped(self, path):
+        """ Saves network and parameters to a single file that `load_mapped`
+        memory-maps, see `mapped_model`.
+
+        :param path file to write
+        """
+        save_mapped(
+            path, self._net, self._parameters, self._input_blobs,
+            self._output_blobs
+        )
+
+    @classmethod
+    def load_mapped(cls, path, int_features=False, verify=False):
+        """ Creates Predictor from a file written by `save_mapped`, feeding
+        parameters straight from the mapped file
+
+        :param path file written by save_mapped
+        :param int_features bool indicating if int_features are present
+        :param verify bool indicating if the checksum is checked before
+            returning instead of on a background thread
+        """
+        return load_mapped(cls, path, int_features, verify)
 
     @classmethod
     def export_actor(
@@ -8,8 +8,12 @@ from caffe2.python import model_helper
 from caffe2.python import workspace
 
 from ml.rl.caffe_utils import C2
-from ml.rl.training.rl_predictor import RLPredictor
-from ml.rl.preprocessing.preprocessor_net import PreprocessorNet
+from ml.rl.training.normalization_folding import \
+    CLIPPED_SAMPLE_STDDEVS, check_folded_predictor, sample_states
+from ml.rl.training.rl_predictor import ACTION_MASK_BLOB, \
+    POLICY_ACTIONS_BLOB, TOP_K_INDICES_BLOB, TOP_K_VALUES_BLOB, RLPredictor
+from ml.rl.preprocessing.preprocessor_net import FoldedNormalizedInput, \
+    PreprocessorNet, get_folded_affine
 
 import logging
 logger = logging.getLogger(__name__)
@@ -19,13 +23,14 @@ class DiscreteActionPredictor(RLPredictor):
     def __init__(self, net, parameters, int_features=False):
         RLPredictor.__init__(self, net, parameters, int_features)
         self.is_discrete = True
-        self._output_blobs.extend(
-            [
-                'output/string_single_categorical_features.keys',
-                'output/string_single_categorical_features.lengths',
-                'output/string_single_categorical_features.values',
-            ]
-        )
+        if not self.compact_output:
+            self._output_blobs.extend(
+                [
+                    'output/string_single_categorical_features.keys',
+                    'output/string_single_categorical_features.lengths',
+                    'output/string_single_categorical_features.values',
+                ]
+            )
 
     def get_predictor_export_meta(self):
         return PredictorExportMeta(
@@ -38,7 +43,15 @@ class DiscreteActionPredictor(RLPredictor):
         trainer,
         actions,
         state_normalization_parameters,
-        int_features=False
+        int_features=False,
+        embed_enums=False,
+        sparse_input=False,
+        fold_normalization=False,
+        compact_output=False,
+        top_k=None,
+        action_mask=False,
+        clip_anomalies=True,
+        fused=False,
     ):
         """ Creates a DiscreteActionPredictor from a DiscreteActionTrainer.
 
@@ -46,7 +59,55 @@ class DiscreteActionPredictor(RLPredictor):
         :param actions list of action names
         :param state_normalization_parameters state NormalizationParameters
         :param int_features boolean indicating if int features blob will be present
+        :param embed_enums boolean indicating if ENUM features are looked up in
+            the trainer's embedding table instead of one-hot encoded
+        :param sparse_input boolean indicating if BINARY, PROBABILITY and
+            CONTINUOUS state features are fed to the first layer as sparse
+            (column, value) pairs instead of a dense matrix
+        :param fold_normalization boolean indicating if the mean and stddev
+            of CONTINUOUS and BOXCOX state features are folded into the first
+            layer instead of being applied by preprocessing ops.  These
+            features cannot be clipped, so this requires clip_anomalies to be
+            False.  The result is checked on sample states against unfolded
+            exports with and without clipping, see `normalization_folding`.
+        :param compact_output boolean indicating if the net only outputs the
+            q_values matrix and an int32 matrix of [max_q, softmax] action
+            indices per state, instead of string outputs that repeat action
+            names for every state.  Action names are stored once, in the
+            action_names parameter.
+        :param top_k number of best actions whose int32 indices and values
+            the net outputs for each state, found with a TopK op, or None
+        :param action_mask boolean indicating if the net takes a (number of
+            states, number of actions) input/action_mask blob, 1 for possible
+            actions.  Impossible actions are never chosen by the policy or
+            ranked above possible ones in the top k.  q_values are unmasked.
+        :param clip_anomalies boolean indicating if normalized CONTINUOUS and
+            BOXCOX state features are clipped to 3 stddevs, as in training
+        :param fused boolean indicating if state features are preprocessed in
+            the fused mode of `PreprocessorNet`, which fold_normalization
+            always uses
         """
+        if fold_normalization:
+            assert state_normalization_parameters is not None and \
+                not embed_enums and not sparse_input, \
+                "Folding needs dense, one-hot normalized state features"
+            assert not clip_anomalies, \
+                "Folded features cannot be clipped, pass clip_anomalies=False"
+            reference = cls.export(
+                trainer,
+                actions,
+                state_normalization_parameters,
+                int_features,
+                compact_output=compact_output,
+                clip_anomalies=False,
+            )
+            clipped_reference = cls.export(
+                trainer,
+                actions,
+                state_normalization_parameters,
+                int_features,
+                compact_output=compact_output,
+            )
 
         model = model_helper.ModelHelper(name="predictor")
         net = model.net
@@ -105,33 +166,90 @@ class DiscreteActionPredictor(RLPredictor):
 
         parameters = []
         if state_normalization_parameters is not None:
-            preprocessor = PreprocessorNet(net, True)
+            preprocessor = PreprocessorNet(
+                net,
+                clip_anomalies,
+                embed_enums,
+                fused=fused or fold_normalization,
+                fold_affine=fold_normalization,
+            )
             parameters.extend(preprocessor.parameters)
-            normalized_dense_matrix, new_parameters = \
-                preprocessor.normalize_sparse_matrix(
-                    input_feature_lengths,
-                    input_feature_keys,
-                    input_feature_values,
-                    state_normalization_parameters,
-                    'state_norm',
-                )
+            if sparse_input:
+                normalize = preprocessor.normalize_sparse_features
+            else:
+                normalize = preprocessor.normalize_sparse_matrix
+            normalized_input, new_parameters = normalize(
+                input_feature_lengths,
+                input_feature_keys,
+                input_feature_values,
+                state_normalization_parameters,
+                'state_norm',
+            )
             parameters.extend(new_parameters)
+            if fold_normalization:
+                normalized_input = FoldedNormalizedInput(
+                    normalized_input,
+                    *get_folded_affine(state_normalization_parameters)
+                )
         else:
             # Image input.  Note: Currently this does the wrong thing if
             #   more than one image is passed at a time.
-            normalized_dense_matrix = 'input/image'
+            normalized_input = 'input/image'
 
         new_parameters, q_values = RLPredictor._forward_pass(
             model,
             trainer,
-            normalized_dense_matrix,
+            normalized_input,
             actions,
+            compact_output,
         )
         parameters.extend(new_parameters)
 
+        policy_q_values = q_values
+        if action_mask:
+            workspace.FeedBlob(
+                ACTION_MASK_BLOB, np.ones([1, len(actions)], dtype=np.float32)
+            )
+            # Set the q values of impossible actions to a very large negative
+            #    number, as in training
+            impossible_actions = C2.Sub(
+                C2.ConstantFill(ACTION_MASK_BLOB, value=1.0), ACTION_MASK_BLOB
+            )
+            # A named parameter, so that every save format stores it
+            action_not_possible = C2.NextBlob("action_not_possible_val")
+            parameters.append(action_not_possible)
+            workspace.FeedBlob(
+                action_not_possible,
+                np.array([trainer.ACTION_NOT_POSSIBLE_VAL], dtype=np.float32)
+            )
+            policy_q_values = C2.Add(
+                q_values,
+                C2.Mul(impossible_actions, action_not_possible, broadcast=1),
+            )
+
+        if top_k is not None:
+            assert 0 < top_k <= len(actions), \
+                "top_k must be between 1 and the number of actions"
+            workspace.FeedBlob(
+                TOP_K_VALUES_BLOB, np.zeros([1, top_k], dtype=np.float32)
+            )
+            workspace.FeedBlob(
+                TOP_K_INDICES_BLOB, np.zeros([1, top_k], dtype=np.int32)
+            )
+            top_k_indices = C2.NextBlob('top_k_indices')
+            C2.net().TopK(
+                [policy_q_values], [TOP_K_VALUES_BLOB, top_k_indices], k=top_k
+            )
+            C2.net().Cast(
+                [top_k_indices], [TOP_K_INDICES_BLOB],
+                to=caffe2_pb2.TensorProto.INT32
+            )
+
         # Get 1 x n action index tensor under the max_q policy
         max_q_act_idxs = 'max_q_policy_actions'
-        C2.net().Flatten([C2.ArgMax(q_values)], [max_q_act_idxs], axis=0)
+        C2.net().Flatten(
+            [C2.ArgMax(policy_q_values)], [max_q_act_idxs], axis=0
+        )
         shape_of_num_of_states = 'num_states_shape'
         C2.net().FlattenToVec([max_q_act_idxs], [shape_of_num_of_states])
         num_states, _ = C2.Reshape(C2.Size(shape_of_num_of_states), shape=[1])
@@ -142,7 +260,9 @@ class DiscreteActionPredictor(RLPredictor):
         workspace.FeedBlob(
             temperature, np.array([trainer.rl_temperature], dtype=np.float32)
         )
-        tempered_q_values = C2.Div(q_values, "temperature", broadcast=1)
+        tempered_q_values = C2.Div(
+            policy_q_values, "temperature", broadcast=1
+        )
         softmax_values = C2.Softmax(tempered_q_values)
         softmax_act_idxs_nested = 'softmax_act_idxs_nested'
         C2.net().WeightedSample([softmax_values], [softmax_act_idxs_nested])
@@ -159,35 +279,57 @@ class DiscreteActionPredictor(RLPredictor):
         )
         C2.net().Append([max_q_act_blob, softmax_act_blob], [max_q_act_blob])
         transposed_action_idxs = C2.Transpose(max_q_act_blob)
-        flat_transposed_action_idxs = C2.FlattenToVec(transposed_action_idxs)
-        output_values = 'output/string_single_categorical_features.values'
-        workspace.FeedBlob(output_values, np.zeros(1, dtype=np.int64))
-        C2.net().Gather(
-            ["action_names", flat_transposed_action_idxs], [output_values]
-        )
+        if compact_output:
+            workspace.FeedBlob(
+                POLICY_ACTIONS_BLOB, np.zeros([1, 2], dtype=np.int32)
+            )
+            C2.net().Copy([transposed_action_idxs], [POLICY_ACTIONS_BLOB])
+        else:
+            flat_transposed_action_idxs = C2.FlattenToVec(
+                transposed_action_idxs
+            )
+            output_values = 'output/string_single_categorical_features.values'
+            workspace.FeedBlob(output_values, np.zeros(1, dtype=np.int64))
+            C2.net().Gather(
+                ["action_names", flat_transposed_action_idxs], [output_values]
+            )
 
-        output_lengths = 'output/string_single_categorical_features.lengths'
-        workspace.FeedBlob(output_lengths, np.zeros(1, dtype=np.int32))
-        C2.net().ConstantFill(
-            [shape_of_num_of_states], [output_lengths],
-            value=2,
-            dtype=caffe2_pb2.TensorProto.INT32
-        )
+            output_lengths = 'output/string_single_categorical_features.lengths'
+            workspace.FeedBlob(output_lengths, np.zeros(1, dtype=np.int32))
+            C2.net().ConstantFill(
+                [shape_of_num_of_states], [output_lengths],
+                value=2,
+                dtype=caffe2_pb2.TensorProto.INT32
+            )
 
-        output_keys = 'output/string_single_categorical_features.keys'
-        workspace.FeedBlob(output_keys, np.zeros(1, dtype=np.int64))
-        output_keys_tensor, _ = C2.Concat(
-            C2.ConstantFill(
-                shape=[1, 1], value=0, dtype=caffe2_pb2.TensorProto.INT64
-            ),
-            C2.ConstantFill(
-                shape=[1, 1], value=1, dtype=caffe2_pb2.TensorProto.INT64
-            ),
-            axis=0,
-        )
-        output_key_tile = C2.Tile(output_keys_tensor, num_states, axis=0)
-        C2.net().FlattenToVec([output_key_tile], [output_keys])
+            output_keys = 'output/string_single_categorical_features.keys'
+            workspace.FeedBlob(output_keys, np.zeros(1, dtype=np.int64))
+            output_keys_tensor, _ = C2.Concat(
+                C2.ConstantFill(
+                    shape=[1, 1], value=0, dtype=caffe2_pb2.TensorProto.INT64
+                ),
+                C2.ConstantFill(
+                    shape=[1, 1], value=1, dtype=caffe2_pb2.TensorProto.INT64
+                ),
+                axis=0,
+            )
+            output_key_tile = C2.Tile(output_keys_tensor, num_states, axis=0)
+            C2.net().FlattenToVec([output_key_tile], [output_keys])
 
         workspace.RunNetOnce(model.param_init_net)
         workspace.CreateNet(net)
-        return DiscreteActionPredictor(net, parameters, int_features)
+        predictor = DiscreteActionPredictor(net, parameters, int_features)
+        if fold_normalization:
+            check_folded_predictor(
+                reference, predictor,
+                sample_states(state_normalization_parameters, 100)
+            )
+            check_folded_predictor(
+                clipped_reference, predictor,
+                sample_states(
+                    state_normalization_parameters,
+                    100,
+                    stddevs=CLIPPED_SAMPLE_STDDEVS
+                )
+            )
+        return predictor
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from typing import Dict, Optional
+from typing import Dict, Optional, Union
 
 import caffe2.proto.caffe2_pb2 as caffe2_pb2
 from caffe2.python import workspace, core
@@ -10,9 +10,10 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-from ml.rl.caffe_utils import C2
+from ml.rl.caffe_utils import C2, StackedAssociativeArray
 from ml.rl.preprocessing.normalization import (
     NormalizationParameters,
+    get_enum_embedding_layout,
     get_num_output_features,
 )
 from ml.rl.thrift.core.ttypes import (
@@ -20,6 +21,7 @@ from ml.rl.thrift.core.ttypes import (
     AdditionalFeatureTypes,
 )
 from ml.rl.training.discrete_action_predictor import DiscreteActionPredictor
+from ml.rl.training.dnn import EnumEmbedding
 from ml.rl.training.rl_trainer import RLTrainer, DEFAULT_ADDITIONAL_FEATURE_TYPES
 
 
@@ -33,7 +35,17 @@ class DiscreteActionTrainer(RLTrainer):
         parameters: DiscreteActionModelParameters,
         normalization_parameters: Dict[int, NormalizationParameters],
         additional_feature_types: AdditionalFeatureTypes = DEFAULT_ADDITIONAL_FEATURE_TYPES,
+        sparse_input: bool = False,
     ) -> None:
+        """
+        :param parameters: The model parameters
+        :param normalization_parameters: State NormalizationParameters
+        :param additional_feature_types: Additional feature types of the
+            exported predictors
+        :param sparse_input: Train from TrainingDataPages whose states and
+            next_states are StackedAssociativeArrays of normalized (column,
+            value) pairs, see `RLTrainer`.  Requires one-hot ENUM features.
+        """
         self._additional_feature_types = additional_feature_types
         self._actions = parameters.actions if parameters.actions is not None else []
         self.reward_shape = {}  # type: Dict[int, float]
@@ -41,17 +53,33 @@ class DiscreteActionTrainer(RLTrainer):
             for k in parameters.rl.reward_boost.keys():
                 i = self._actions.index(k)
                 self.reward_shape[i] = parameters.rl.reward_boost[k]
+        enum_embedding = None
         if parameters.training.cnn_parameters is None:
             self.state_normalization_parameters: Optional[
                 Dict[int, NormalizationParameters]
             ] = normalization_parameters
-            num_features = get_num_output_features(normalization_parameters)
+            enum_embedding_dim = parameters.training.enum_embedding_dim
+            num_features = get_num_output_features(
+                normalization_parameters, enum_embedding_dim
+            )
             parameters.training.layers[0] = num_features
+            if enum_embedding_dim is not None:
+                assert not sparse_input, \
+                    "Sparse input does not support ENUM embeddings"
+                start_index, num_ids = get_enum_embedding_layout(
+                    normalization_parameters
+                )
+                if len(num_ids) > 0:
+                    enum_embedding = EnumEmbedding(
+                        start_index, num_ids, enum_embedding_dim
+                    )
         else:
             self.state_normalization_parameters = None
         parameters.training.layers[-1] = self.num_actions
+        # When set, states must be preprocessed with `embed_enums=True`
+        self.embed_enums = enum_embedding is not None
 
-        RLTrainer.__init__(self, parameters)
+        RLTrainer.__init__(self, parameters, enum_embedding, sparse_input)
 
         self._create_all_q_score_net()
         self._create_internal_policy_net()
@@ -63,10 +91,18 @@ class DiscreteActionTrainer(RLTrainer):
     def get_possible_next_actions(self):
         return "possible_next_actions"
 
+    def named_nets(self):
+        nets = RLTrainer.named_nets(self)
+        nets["all_q_score"] = self.all_q_score_model.net
+        nets["internal_policy"] = self.internal_policy_model.net
+        return nets
+
     def _create_all_q_score_net(self) -> None:
         self.all_q_score_model = ModelHelper(name="all_q_score_" + self.model_id)
         C2.set_model(self.all_q_score_model)
-        self.all_q_score_output = self.get_q_values_all_actions("states", True)
+        self.all_q_score_output = self.get_q_values_all_actions(
+            self._state_blobs("states"), True
+        )
         workspace.RunNetOnce(self.all_q_score_model.param_init_net)
         workspace.CreateNet(self.all_q_score_model.net)
         C2.set_model(None)
@@ -76,12 +112,19 @@ class DiscreteActionTrainer(RLTrainer):
             name="internal_policy_" + self.model_id
         )
         C2.set_model(self.internal_policy_model)
-        self.internal_policy_output = self.get_q_values_all_actions("states", False)
+        self.internal_policy_output = self.get_q_values_all_actions(
+            self._state_blobs("states"), False
+        )
         workspace.RunNetOnce(self.internal_policy_model.param_init_net)
         workspace.CreateNet(self.internal_policy_model.net)
         C2.set_model(None)
 
-    def update_model(self, states: str, actions: str, q_vals_target: str) -> None:
+    def update_model(
+        self,
+        states: Union[str, StackedAssociativeArray],
+        actions: str,
+        q_vals_target: str,
+    ) -> None:
         """
         Takes in states, actions, and target q values. Updates the model:
 
@@ -91,7 +134,8 @@ class DiscreteActionTrainer(RLTrainer):
             Updates Q Network's weights according to loss and optimizer
 
         :param states: Numpy array with shape (batch_size, state_dim). The ith
-            row is a representation of the ith transition's state.
+            row is a representation of the ith transition's state.  With
+            sparse_input, the blobs of its (column, value) pairs.
         :param actions: Numpy array with shape (batch_size, action_dim). The ith
             row contains the one-hotted representation of the ith action.
         :param q_vals_targets: Numpy array with shape (batch_size, 1). The ith
@@ -105,7 +149,14 @@ class DiscreteActionTrainer(RLTrainer):
             self.conv_ml_trainer.make_conv_pass_ops(model, states, conv_output_blob)
             states = conv_output_blob
 
-        self.ml_trainer.make_forward_pass_ops(model, states, output_blob, False)
+        if isinstance(states, StackedAssociativeArray):
+            self.ml_trainer.make_sparse_input_forward_pass_ops(
+                model, states, output_blob, False
+            )
+        else:
+            self.ml_trainer.make_forward_pass_ops(
+                model, states, output_blob, False
+            )
         q_val_select = C2.ReduceBackSum(C2.Mul(output_blob, actions))
         q_values = C2.ExpandDims(q_val_select, dims=[1])
 
@@ -114,16 +165,27 @@ class DiscreteActionTrainer(RLTrainer):
         for param in model.params:
             if param in model.param_to_grad:
                 param_grad = model.param_to_grad[param]
+                if isinstance(param_grad, core.GradientSlice):
+                    # Embedding tables get sparse gradients
+                    param_grad = param_grad.values
                 param_grad = C2.NanCheck(param_grad)
         self.ml_trainer.addParameterUpdateOps(model)
 
-    def get_q_values(self, states: str, actions: str, use_target_network: bool) -> str:
+    def get_q_values(
+        self,
+        states: Union[str, StackedAssociativeArray],
+        actions: str,
+        use_target_network: bool,
+    ) -> str:
         # actions and possible_next_actions are the same matrix, only that
         # actions is one-hot.  Because of this, we can call get_max_q_values.
         return self.get_max_q_values(states, actions, use_target_network)
 
     def get_max_q_values(
-        self, states: str, possible_actions: str, use_target_network: bool
+        self,
+        states: Union[str, StackedAssociativeArray],
+        possible_actions: str,
+        use_target_network: bool,
     ) -> str:
         """
         Takes in an array of states and outputs an array of the same shape
@@ -150,7 +212,11 @@ class DiscreteActionTrainer(RLTrainer):
         q_values_max = C2.ReduceBackMax(q_values, num_reduce_dims=1)
         return C2.ExpandDims(q_values_max, dims=[1])
 
-    def get_q_values_all_actions(self, states: str, use_target_network: bool) -> str:
+    def get_q_values_all_actions(
+        self,
+        states: Union[str, StackedAssociativeArray],
+        use_target_network: bool,
+    ) -> str:
         """
         Takes in a set of states and runs the test Q Network on them.
 
@@ -160,7 +226,8 @@ class DiscreteActionTrainer(RLTrainer):
         self.action_dim_. Stores blob in self.output_blob and returns its value.
 
         :param states: Numpy array with shape (batch_size, state_dim). Each row
-            contains a representation of a state.
+            contains a representation of a state.  With sparse_input, the
+            blobs of its (column, value) pairs.
         :param possible_next_actions: Numpy array with shape (batch_size, action_dim).
             possible_next_actions[i][j] = 1 iff the agent can take action j from
             state i.
@@ -168,7 +235,13 @@ class DiscreteActionTrainer(RLTrainer):
             trainer's TargetNetwork to compute Q values.
         """
         all_q_values = C2.NextBlob("all_q_values")
-        if use_target_network:
+        if isinstance(states, StackedAssociativeArray):
+            network = self.target_network if use_target_network \
+                else self.ml_trainer
+            network.make_sparse_input_forward_pass_ops(
+                C2.model(), states, all_q_values, True
+            )
+        elif use_target_network:
             if self.conv_target_network is not None:
                 conv_output_blob = C2.NextBlob("conv_output")
                 self.conv_target_network.make_conv_pass_ops(
@@ -203,7 +276,7 @@ class DiscreteActionTrainer(RLTrainer):
                     broadcast=1,
                 )
                 C2.net().Sum(["rewards", action_boost], ["rewards"])
-        self.update_model("states", "actions", "rewards")
+        self.update_model(self._state_blobs("states"), "actions", "rewards")
         workspace.RunNetOnce(self.reward_train_model.param_init_net)
         workspace.CreateNet(self.reward_train_model.net)
         C2.set_model(None)
@@ -225,10 +298,13 @@ class DiscreteActionTrainer(RLTrainer):
 
         if self.maxq_learning:
             next_q_values = self.get_max_q_values(
-                "next_states", self.get_possible_next_actions(), True
+                self._state_blobs("next_states"),
+                self.get_possible_next_actions(), True
             )
         else:
-            next_q_values = self.get_q_values("next_states", "next_actions", True)
+            next_q_values = self.get_q_values(
+                self._state_blobs("next_states"), "next_actions", True
+            )
 
         discount_blob = C2.ConstantFill("time_diff", value=self.rl_discount_rate)
         time_diff_adjusted_discount_blob = C2.Pow(
@@ -249,19 +325,51 @@ class DiscreteActionTrainer(RLTrainer):
             ),
         )
 
-        self.update_model("states", "actions", q_vals_target)
+        self.update_model(self._state_blobs("states"), "actions", q_vals_target)
         workspace.RunNetOnce(self.rl_train_model.param_init_net)
         workspace.CreateNet(self.rl_train_model.net)
         C2.set_model(None)
 
-    def predictor(self) -> DiscreteActionPredictor:
+    def predictor(
+        self,
+        sparse_input=False,
+        fold_normalization=False,
+        compact_output=False,
+        top_k=None,
+        action_mask=False,
+        clip_anomalies=True,
+        fused=False,
+    ) -> DiscreteActionPredictor:
         """
         Builds a DiscreteActionPredictor using the MLTrainer underlying this
         DiscreteActionTrainer.
+
+        :param sparse_input: Feed sparse state features to the first layer
+            without densifying them, see `DiscreteActionPredictor.export`.
+        :param fold_normalization: Fold state normalization into the
+            first layer, see `DiscreteActionPredictor.export`.
+        :param compact_output: Output values and action indices without
+            per-state action names, see `DiscreteActionPredictor.export`.
+        :param top_k: Also output the indices and values of the k best
+            actions of each state, see `DiscreteActionPredictor.export`.
+        :param action_mask: Take a mask of possible actions as input, see
+            `DiscreteActionPredictor.export`.
+        :param clip_anomalies: Clip normalized state features to 3 stddevs.
+            Must be False with fold_normalization.
+        :param fused: Preprocess state features in the fused mode of
+            `PreprocessorNet`, see `DiscreteActionPredictor.export`.
         """
         return DiscreteActionPredictor.export(
             self,
             self._actions,
             self.state_normalization_parameters,
             self._additional_feature_types.int_features,
+            self.embed_enums,
+            sparse_input,
+            fold_normalization,
+            compact_output,
+            top_k,
+            action_mask,
+            clip_anomalies,
+            fused,
         )
@@ -1,16 +1,32 @@
 #!/usr/bin/env python3
 
 
+import functools
 import math
 import numpy as np
-from typing import List
+from collections import namedtuple
+from typing import List, Optional
 
 from caffe2.python import core, workspace, brew
 from caffe2.python.model_helper import ModelHelper
+from caffe2.python.modeling import initializers
+from caffe2.python.modeling.parameter_info import ParameterTags
 
+from ml.rl.caffe_utils import StackedAssociativeArray
 from ml.rl.custom_brew_helpers.fc import fc_explicit_param_names
+from ml.rl.preprocessing.preprocessor_net import FoldedNormalizedInput, \
+    SparseNormalizedInput
 from ml.rl.thrift.core.ttypes import TrainingParameters
 
+EnumEmbedding = namedtuple(
+    'EnumEmbedding',
+    [
+        'start_index',  # Column of the first ENUM id in the input
+        'num_ids',  # Number of embedding rows for each ENUM feature
+        'dim',  # Width of each embedding
+    ]
+)
+
 
 class DNN(object):
     """ This class handles evaluating a DNN.  It supports the ml_trainer
@@ -22,12 +38,22 @@ class DNN(object):
         self,
         name: str,
         parameters: TrainingParameters,
+        enum_embedding: Optional[EnumEmbedding] = None,
+        sparse_input: bool = False,
     ) -> None:
         """
 
         :param name: A unique name for this trainer used to create the data on the
             caffe2 workspace
         :param parameters: The set of training parameters
+        :param enum_embedding: If set, the input holds ENUM ids (see
+            PreprocessorNet's `embed_enums`) that are looked up in a learned
+            embedding table before the first layer.
+        :param sparse_input: If set, the first layer weights are stored
+            transposed, as (input, output), so that
+            `make_sparse_input_forward_pass_ops` can train them from sparse
+            rows with SparseLengthsWeightedSum.  Dense inputs go through
+            FCTransposed.
         """
         if not DNN.registered:
             brew.Register(fc_explicit_param_names)  # type: ignore
@@ -39,6 +65,8 @@ class DNN(object):
         self.dropout_ratio = parameters.dropout_ratio
         self.skip_random_weight_init = \
             (parameters.warm_start_model_path is not None)
+        self.enum_embedding = enum_embedding
+        self.sparse_input = sparse_input
 
         self._validate_inputs()
         self._setup_initial_blobs()
@@ -57,10 +85,31 @@ class DNN(object):
                 "All values in `layers` should be positive integers."
             )
 
+        if self.sparse_input and self.enum_embedding is not None:
+            raise Exception(
+                "Sparse input does not support ENUM embeddings."
+            )
+
     def _setup_initial_blobs(self):
         # Create blobs for model parameters
         self.weights: List[str] = []
         self.biases: List[str] = []
+        self.embeddings: List[str] = []
+
+        if self.enum_embedding is not None:
+            embedding_name = "Embeddings_" + self.model_id
+            self.embeddings.append(embedding_name)
+            if not self.skip_random_weight_init:
+                workspace.RunOperatorOnce(
+                    core.CreateOperator(
+                        "GaussianFill", [], [embedding_name],
+                        shape=[
+                            sum(self.enum_embedding.num_ids),
+                            self.enum_embedding.dim
+                        ],
+                        std=math.sqrt(1 / self.enum_embedding.dim)
+                    )
+                )
 
         for x in range(len(self.layers) - 1):
             dim_in = self.layers[x]
@@ -80,10 +129,14 @@ class DNN(object):
                 workspace.FeedBlob(bias_name, bias)
 
                 gain = math.sqrt(2) if self.activations[x] == 'relu' else 1
+                if x == 0 and self.sparse_input:
+                    shape = [dim_in, dim_out]
+                else:
+                    shape = [dim_out, dim_in]
                 workspace.RunOperatorOnce(
                     core.CreateOperator(
                         "GaussianFill", [], [weight_name],
-                        shape=[dim_out, dim_in],
+                        shape=shape,
                         std=gain * math.sqrt(1 / dim_in)
                     )
                 )
@@ -105,10 +158,262 @@ class DNN(object):
             node dropout.
         """
         model.net.NanCheck([input_blob], [input_blob])
-        model_states = []
+        if self.enum_embedding is not None:
+            input_blob = self._make_embedding_ops(model, input_blob)
+        self._make_layer_ops(model, input_blob, output_blob, 0, is_test)
+        model.net.NanCheck([output_blob], [output_blob])
+
+    def make_sparse_input_forward_pass_ops(
+        self,
+        model: ModelHelper,
+        sparse_input: StackedAssociativeArray,
+        output_blob: str,
+        is_test: bool = False,
+    ) -> None:
+        """
+        Performs a forward pass of a multi-layer perceptron on sparse rows of
+        the normalized input: row i holds the `lengths[i]` (column, value)
+        pairs of `keys` and `values` that are not zero.  The first layer is a
+        SparseLengthsWeightedSum over the transposed weights, so its cost and
+        its gradient, a GradientSlice, are proportional to the pairs in the
+        batch rather than to the number of columns.  Requires `sparse_input`.
+
+        :param model: The ModelHelper object whose net will execute this pass
+        :param sparse_input: Blobs holding the lengths, int32 columns and
+            values of the rows
+        :param output_blob: The blob where the output data will be placed
+        :param is_test: Indicates whether or not this forward pass should skip
+            node dropout.
+        """
+        assert self.sparse_input, \
+            "{} was not created with sparse_input".format(self.model_id)
+        dim_in = self.layers[0]
+        dim_out = self.layers[1]
+        weight = model.create_param(
+            param_name=self.weights[0],
+            shape=[dim_in, dim_out],
+            initializer=initializers.update_initializer(
+                None, (
+                    "GivenTensorFill", {
+                        'values': workspace.FetchBlob(self.weights[0])
+                    }
+                ), ("GaussianFill", {})
+            ),
+            tags=ParameterTags.WEIGHT
+        )
+        bias = model.create_param(
+            param_name=self.biases[0],
+            shape=[dim_out],
+            initializer=initializers.update_initializer(
+                None, (
+                    "GivenTensorFill", {
+                        'values': workspace.FetchBlob(self.biases[0])
+                    }
+                ), ("ConstantFill", {})
+            ),
+            tags=ParameterTags.BIAS
+        )
+
+        model.net.NanCheck([sparse_input.values], [sparse_input.values])
+        weighted_sum = model.net.NextBlob("SparseInput_sum_" + self.model_id)
+        model.net.SparseLengthsWeightedSum(
+            [
+                weight, sparse_input.values, sparse_input.keys,
+                sparse_input.lengths
+            ], [weighted_sum]
+        )
+        if len(self.layers) == 2:
+            first_output = output_blob
+        else:
+            first_output = model.net.NextBlob(
+                "ModelState_1_" + self.model_id
+            )
+        model.net.Add([weighted_sum, bias], [first_output], broadcast=1)
+        self._make_activation_ops(model, 0, first_output, is_test)
+
+        self._make_layer_ops(model, first_output, output_blob, 1, is_test)
+        model.net.NanCheck([output_blob], [output_blob])
+
+    def make_sparse_forward_pass_ops(
+        self,
+        model: ModelHelper,
+        sparse_input: SparseNormalizedInput,
+        output_blob: str,
+    ) -> List[str]:
+        """
+        Performs a test-time forward pass whose first layer reads the output of
+        `PreprocessorNet.normalize_sparse_features`: the (column, value) pairs
+        are summed into rows of the transposed first-layer weights with
+        SparseLengthsWeightedSum and the dense columns go through a narrow FC.
+        Equivalent to `make_forward_pass_ops` on the dense normalized matrix.
+
+        The first layer is built from the current weights, so unlike the
+        other layers it does not follow further training.
+
+        :param model: The ModelHelper object whose net will execute this pass
+        :param sparse_input: Normalized sparse input
+        :param output_blob: The blob where the output data will be placed
+        :returns: The parameter blobs of the first layer
+        """
+        assert self.enum_embedding is None, \
+            "Sparse input does not support ENUM embeddings"
+        assert sparse_input.num_columns == self.layers[0], \
+            "Sparse input has {} columns, the first layer expects {}".format(
+                sparse_input.num_columns, self.layers[0]
+            )
+        weights = self._fetch_first_layer_weights()
+        create_param = functools.partial(self._create_snapshot_param, model)
+
+        # Row i holds the weights of input column i
+        transposed_weights = create_param(
+            self.weights[0] + "_transposed",
+            np.ascontiguousarray(weights.T),
+            ParameterTags.WEIGHT,
+        )
+        bias = create_param(
+            self.biases[0],
+            workspace.FetchBlob(self.biases[0]),
+            ParameterTags.BIAS,
+        )
+        parameters = [transposed_weights, bias]
+
+        if len(self.layers) == 2:
+            first_output = output_blob
+        else:
+            first_output = model.net.NextBlob(
+                "ModelState_1_" + self.model_id
+            )
+        model.net.SparseLengthsWeightedSum(
+            [
+                transposed_weights, sparse_input.values, sparse_input.columns,
+                sparse_input.lengths
+            ], [first_output]
+        )
+        if sparse_input.dense_matrix is not None:
+            dense_weights = create_param(
+                self.weights[0] + "_dense_columns",
+                np.ascontiguousarray(weights[:, sparse_input.dense_columns]),
+                ParameterTags.WEIGHT,
+            )
+            parameters.append(dense_weights)
+            dense_output = model.net.NextBlob(
+                "SparseInput_dense_" + self.model_id
+            )
+            model.net.FC(
+                [sparse_input.dense_matrix, dense_weights, bias],
+                [dense_output]
+            )
+            model.net.Add([first_output, dense_output], [first_output])
+        else:
+            model.net.Add([first_output, bias], [first_output], broadcast=1)
+        self._make_activation_ops(model, 0, first_output, True)
+
+        self._make_layer_ops(model, first_output, output_blob, 1, True)
+        model.net.NanCheck([output_blob], [output_blob])
+        return parameters
+
+    def make_folded_forward_pass_ops(
+        self,
+        model: ModelHelper,
+        folded_input: FoldedNormalizedInput,
+        output_blob: str,
+    ) -> List[str]:
+        """
+        Performs a test-time forward pass whose first layer also applies the
+        per-column affine part of the normalization: with x the input matrix,
+        W (scale * x + shift) + b is computed as (W * scale) x + (W shift + b),
+        so the preprocessing net can skip those ops.
+
+        The first layer is built from the current weights, so unlike the
+        other layers it does not follow further training.
+
+        :param model: The ModelHelper object whose net will execute this pass
+        :param folded_input: Input matrix and the affine transform to fold
+        :param output_blob: The blob where the output data will be placed
+        :returns: The parameter blobs of the first layer
+        """
+        assert self.enum_embedding is None, \
+            "Folded input does not support ENUM embeddings"
+        assert len(folded_input.scale) == self.layers[0], \
+            "Folded input has {} columns, the first layer expects {}".format(
+                len(folded_input.scale), self.layers[0]
+            )
+        weights = self._fetch_first_layer_weights()
+        bias = workspace.FetchBlob(self.biases[0])
+        folded_weights = self._create_snapshot_param(
+            model,
+            self.weights[0] + "_folded",
+            (weights * folded_input.scale[np.newaxis, :]).astype(np.float32),
+            ParameterTags.WEIGHT,
+        )
+        folded_bias = self._create_snapshot_param(
+            model,
+            self.biases[0] + "_folded",
+            (bias + weights.dot(folded_input.shift)).astype(np.float32),
+            ParameterTags.BIAS,
+        )
+
+        model.net.NanCheck([folded_input.matrix], [folded_input.matrix])
+        if len(self.layers) == 2:
+            first_output = output_blob
+        else:
+            first_output = model.net.NextBlob(
+                "ModelState_1_" + self.model_id
+            )
+        model.net.FC(
+            [folded_input.matrix, folded_weights, folded_bias], [first_output]
+        )
+        self._make_activation_ops(model, 0, first_output, True)
+
+        self._make_layer_ops(model, first_output, output_blob, 1, True)
+        model.net.NanCheck([output_blob], [output_blob])
+        return [folded_weights, folded_bias]
+
+    def _fetch_first_layer_weights(self) -> np.ndarray:
+        """
+        The current first layer weights as (output, input), whichever way
+        they are stored.
+        """
+        weights = workspace.FetchBlob(self.weights[0])
+        if self.sparse_input:
+            return weights.T
+        return weights
+
+    def _create_snapshot_param(
+        self, model: ModelHelper, name: str, values: np.ndarray, tags
+    ) -> str:
+        """
+        A parameter initialized to `values`, for test-time layers that are
+        derived from the trained weights.
+        """
+        return model.create_param(
+            param_name=name,
+            shape=list(values.shape),
+            initializer=initializers.update_initializer(
+                None, ("GivenTensorFill", {
+                    'values': values
+                }), ("GaussianFill", {})
+            ),
+            tags=tags
+        )
+
+    def _make_layer_ops(
+        self,
+        model: ModelHelper,
+        input_blob: str,
+        output_blob: str,
+        first_layer: int,
+        is_test: bool,
+    ) -> None:
+        """
+        Adds the fully connected layers from `first_layer` on.
+        """
         num_layer_connections = len(self.layers) - 1
-        for x in range(num_layer_connections + 1):
-            if x == 0:
+        if first_layer == num_layer_connections:
+            return
+        model_states = []
+        for x in range(first_layer, num_layer_connections + 1):
+            if x == first_layer:
                 model_states.append(input_blob)
             elif x == num_layer_connections:
                 model_states.append(output_blob)
@@ -117,11 +422,10 @@ class DNN(object):
                     model.net.
                     NextBlob("ModelState_" + str(x) + "_" + self.model_id)
                 )
-        for x in range(num_layer_connections):
-            inputs = model_states[x]
-            outputs = model_states[x + 1]
+        for x in range(first_layer, num_layer_connections):
+            inputs = model_states[x - first_layer]
+            outputs = model_states[x - first_layer + 1]
 
-            activation = self.activations[x]
             dim_in = self.layers[x]
             dim_out = self.layers[x + 1]
             weight_name = self.weights[x]
@@ -135,6 +439,7 @@ class DNN(object):
                 dim_out=dim_out,
                 bias_name=bias_name,
                 weight_name=weight_name,
+                transposed=(x == 0 and self.sparse_input),
                 weight_init=(
                     "GivenTensorFill", {
                         'values': workspace.FetchBlob(weight_name)
@@ -146,21 +451,91 @@ class DNN(object):
                     }
                 )
             )
+            self._make_activation_ops(model, x, outputs, is_test)
 
-            if activation == 'relu':
-                brew.relu(model, outputs, outputs)
-            elif activation == 'linear':
-                pass
-            else:
-                raise Exception("Unknown activation function")
-
-            if self.dropout_ratio > 0.01:
-                brew.dropout(
-                    model,
-                    outputs,
-                    outputs,
-                    ratio=self.dropout_ratio,
-                    is_test=is_test
-                )
+    def _make_activation_ops(
+        self, model: ModelHelper, x: int, blob: str, is_test: bool
+    ) -> None:
+        activation = self.activations[x]
+        if activation == 'relu':
+            brew.relu(model, blob, blob)
+        elif activation == 'linear':
+            pass
+        else:
+            raise Exception("Unknown activation function")
 
-        model.net.NanCheck([output_blob], [output_blob])
+        if self.dropout_ratio > 0.01:
+            brew.dropout(
+                model, blob, blob, ratio=self.dropout_ratio, is_test=is_test
+            )
+
+    def _make_embedding_ops(self, model: ModelHelper, input_blob: str) -> str:
+        """
+        Replaces the block of ENUM id columns in `input_blob` by their
+        embeddings.  The table is read with Gather, so its gradient is a
+        GradientSlice and optimizers only update the rows that were used.
+        """
+        start_index = self.enum_embedding.start_index
+        num_enums = len(self.enum_embedding.num_ids)
+        dim = self.enum_embedding.dim
+        num_dense_after = self.layers[0] - num_enums * dim - start_index
+        embedding_name = self.embeddings[0]
+
+        embedding_initializer = initializers.update_initializer(
+            None, (
+                "GivenTensorFill", {
+                    'values': workspace.FetchBlob(embedding_name)
+                }
+            ), ("GaussianFill", {})
+        )
+        embedding = model.create_param(
+            param_name=embedding_name,
+            shape=[sum(self.enum_embedding.num_ids), dim],
+            initializer=embedding_initializer,
+            tags=ParameterTags.WEIGHT
+        )
+
+        prefix = "EnumEmbedding_" + self.model_id
+        inputs = []
+        if start_index > 0:
+            dense_before = model.net.NextBlob(prefix + "_dense_before")
+            model.net.Slice(
+                [input_blob], [dense_before],
+                starts=[0, 0],
+                ends=[-1, start_index]
+            )
+            inputs.append(dense_before)
+
+        enum_ids = model.net.NextBlob(prefix + "_ids")
+        model.net.Slice(
+            [input_blob], [enum_ids],
+            starts=[0, start_index],
+            ends=[-1, start_index + num_enums]
+        )
+        int_enum_ids = model.net.NextBlob(prefix + "_int_ids")
+        model.net.Cast([enum_ids], [int_enum_ids], to=core.DataType.INT32)
+        embedded = model.net.NextBlob(prefix + "_embedded")
+        model.net.Gather([embedding, int_enum_ids], [embedded])
+        flat_embedded = model.net.NextBlob(prefix + "_flat_embedded")
+        model.net.Reshape(
+            [embedded], [flat_embedded, flat_embedded + "_old_shape"],
+            shape=[-1, num_enums * dim]
+        )
+        inputs.append(flat_embedded)
+
+        if num_dense_after > 0:
+            dense_after = model.net.NextBlob(prefix + "_dense_after")
+            model.net.Slice(
+                [input_blob], [dense_after],
+                starts=[0, start_index + num_enums],
+                ends=[-1, -1]
+            )
+            inputs.append(dense_after)
+
+        if len(inputs) == 1:
+            return inputs[0]
+        embedded_input = model.net.NextBlob(prefix + "_input")
+        model.net.Concat(
+            inputs, [embedded_input, embedded_input + "_dim"], axis=1
+        )
+        return embedded_input
@@ -1,15 +1,12 @@
 #!/usr/bin/env python3
 
 
-from typing import Dict, Any
-import collections
+from typing import Dict
 import numpy as np
-import six
-
-from caffe2.python import workspace
 
 from ml.rl.preprocessing.normalization import NormalizationParameters
 from ml.rl.training.discrete_action_trainer import DiscreteActionTrainer
+from ml.rl.training.quantile_estimator import P2QuantileEstimator
 from ml.rl.training.rl_trainer import RLTrainer
 
 
@@ -18,10 +15,12 @@ class LimitedActionDiscreteActionTrainer(DiscreteActionTrainer):
     def __init__(
         self, parameters, normalization_parameters: Dict[int, NormalizationParameters]
     ) -> None:
-        self._quantile_states: Any = collections.deque(
-            maxlen=parameters.action_budget.window_size
+        # Streaming estimate of the advantage of the limited action over the
+        #     best other action.  Reset after every quantile update so that it
+        #     only reflects the current model.
+        self._quantile_estimator = P2QuantileEstimator(
+            100 - parameters.action_budget.action_limit
         )
-        self._quantile = 100 - parameters.action_budget.action_limit
         self.quantile_value = 0
         self._limited_action = np.argmax(
             np.array(parameters.actions) == parameters.action_budget.limited_action
@@ -33,14 +32,22 @@ class LimitedActionDiscreteActionTrainer(DiscreteActionTrainer):
         DiscreteActionTrainer.__init__(self, parameters, normalization_parameters)
         self._max_q = parameters.rl.maxq_learning
 
+    def all_action_values(self, states):
+        """
+        Runs the all-actions Q network once and returns a matrix of shape
+        (batch_size, num_actions).
+        """
+        self._feed_states("states", states)
+        self.profiler.run_net("all_q_score", self.all_q_score_model.net)
+        return self.profiler.fetch_blob(self.all_q_score_output)
+
     def action_values(self, states, action_idx):
-        workspace.FeedBlob("states", states)
-        workspace.RunNet(self.all_q_score_model.net)
-        q = workspace.FetchBlob(self.all_q_score_output)
-        return q[:, action_idx]
+        return self.all_action_values(states)[:, action_idx]
 
     def train_numpy(self, tdp, evaluator):
-        self._quantile_states.extendleft(tdp.states)
+        self._quantile_estimator.update(
+            self._limited_action_advantage(self.all_action_values(tdp.states))
+        )
         if (
             self._update_counter % self._quantile_update_frequency
             == self._quantile_update_frequency - 1
@@ -49,17 +56,19 @@ class LimitedActionDiscreteActionTrainer(DiscreteActionTrainer):
         self._update_counter += 1
 
         if self._max_q:
-            workspace.FeedBlob("states", tdp.states)
-            workspace.FeedBlob("actions", tdp.possible_next_actions)
-            workspace.RunNet(self.q_score_model.net)
-            q_values = workspace.FetchBlob(self.q_score_output)
-            q_next_actions = np.argmax(q_values, axis=1).reshape(-1, 1)
-            q_next_actions_mask = np.zeros(
-                [q_next_actions.shape[0], self.num_actions], dtype=np.float32
+            next_q_values = self.all_action_values(tdp.next_states)
+            next_q_values = np.where(
+                tdp.possible_next_actions > 0,
+                next_q_values,
+                self.ACTION_NOT_POSSIBLE_VAL,
+            )
+            q_next_actions = np.zeros(
+                [next_q_values.shape[0], self.num_actions], dtype=np.float32
             )
-            for x in range(q_next_actions.shape[0]):
-                q_next_actions_mask[q_next_actions[x, 0], 0] = 1.0
-            q_next_actions = q_next_actions_mask
+            q_next_actions[
+                np.arange(next_q_values.shape[0]),
+                np.argmax(next_q_values, axis=1),
+            ] = 1.0
         else:
             q_next_actions = tdp.next_actions
         penalty = self._reward_penalty(tdp.actions, q_next_actions, tdp.not_terminals)
@@ -69,22 +78,16 @@ class LimitedActionDiscreteActionTrainer(DiscreteActionTrainer):
         tdp.rewards = tdp.rewards - penalty
         RLTrainer.train_numpy(self, tdp, evaluator)
 
-    def _update_quantile(self):
-        states = np.array(self._quantile_states, dtype=np.float32)
-        limited_action_values = self.action_values(states, self._limited_action)
+    def _limited_action_advantage(self, q_values):
+        limited_action_values = q_values[:, self._limited_action]
         base_action_values = np.max(
-            np.array(
-                [
-                    self.action_values(states, action)
-                    for action in six.moves.range(self.num_actions)
-                    if action != self._limited_action
-                ]
-            ),
-            axis=0,
-        )
-        target = np.percentile(
-            limited_action_values - base_action_values, self._quantile
+            np.delete(q_values, self._limited_action, axis=1), axis=1
         )
+        return limited_action_values - base_action_values
+
+    def _update_quantile(self):
+        target = self._quantile_estimator.value()
+        self._quantile_estimator.reset()
         print("REWARD PENALTY TARGET:", target)
         self.quantile_value += self._quantile_update_rate * target
         print("QUANTILE:", self.quantile_value)
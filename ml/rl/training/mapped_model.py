@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+"""
+Single-file predictor format that loads without deserializing parameters.
+
+    magic (8 bytes) | uint64 header size | JSON header | padding | sections
+
+The header lists the input and output blobs and, for every blob and for the
+serialized NetDef, the offset and size of its section.  Sections start at
+multiples of ALIGNMENT bytes, so on load the file is memory-mapped and each
+tensor is a read-only NumPy view of the mapping: nothing is parsed, and pages
+are read from the page cache as they are fed.  String tensors (e.g. action
+names) are small and stored in the header.
+
+A CRC32 of everything after the header is stored too.  Checking it reads the
+whole file, so loads check it on a background thread unless asked to wait.
+"""
+
+import json
+import mmap
+import struct
+import threading
+import zlib
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from caffe2.proto import caffe2_pb2
+from caffe2.python import workspace
+
+import logging
+logger = logging.getLogger(__name__)
+
+MAGIC = b'RLMODEL1'
+ALIGNMENT = 64
+_HEADER_SIZE = struct.Struct('<Q')
+_CHECKSUM_CHUNK_BYTES = 1 << 24
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _checksum(view) -> int:
+    checksum = 0
+    for start in range(0, len(view), _CHECKSUM_CHUNK_BYTES):
+        checksum = zlib.crc32(
+            view[start:start + _CHECKSUM_CHUNK_BYTES], checksum
+        )
+    return checksum
+
+
+def save_mapped(
+    path: str,
+    net,
+    parameters: List[str],
+    input_blobs: List[str],
+    output_blobs: List[str],
+) -> None:
+    """
+    Writes the predictor net and the current workspace values of its
+    parameters, and of any other external input that exists (e.g. input
+    placeholders), to `path`.
+    """
+    net_proto = net.Proto() if hasattr(net, 'Proto') else net
+    names = list(parameters)
+    # Blobs the net reads before writing them must exist to create the net
+    known = set(parameters)
+    for op in net_proto.op:
+        for name in op.input:
+            if name not in known and workspace.HasBlob(name):
+                names.append(name)
+            known.add(name)
+        known.update(op.output)
+
+    sections: List[bytes] = [net_proto.SerializeToString()]
+    blobs: List[Dict[str, Any]] = []
+    for name in names:
+        value = workspace.FetchBlob(name)
+        if value.dtype.kind in {'U', 'S', 'O'}:
+            blobs.append(
+                {
+                    'name': name,
+                    'strings': [
+                        v.decode('utf-8') if isinstance(v, bytes) else str(v)
+                        for v in value.flatten()
+                    ],
+                    'shape': list(value.shape),
+                }
+            )
+            continue
+        value = np.ascontiguousarray(value)
+        blobs.append(
+            {
+                'name': name,
+                'dtype': value.dtype.str,
+                'shape': list(value.shape),
+                'section': len(sections),
+            }
+        )
+        sections.append(value.tobytes())
+
+    # Offsets are relative to the first section, which starts at an aligned
+    #     position after the header
+    offsets = []
+    size = 0
+    checksum = 0
+    for section in sections:
+        offsets.append(size)
+        padding = _align(size + len(section)) - size - len(section)
+        checksum = zlib.crc32(section, checksum)
+        checksum = zlib.crc32(b'\0' * padding, checksum)
+        size += len(section) + padding
+    for blob in blobs:
+        if 'section' in blob:
+            section = blob.pop('section')
+            blob['offset'] = offsets[section]
+            blob['size'] = len(sections[section])
+
+    header = json.dumps(
+        {
+            'net': {'offset': offsets[0], 'size': len(sections[0])},
+            'parameters': list(parameters),
+            'input_blobs': list(input_blobs),
+            'output_blobs': list(output_blobs),
+            'blobs': blobs,
+            'checksum': checksum,
+        }
+    ).encode('utf-8')
+    prefix = MAGIC + _HEADER_SIZE.pack(len(header)) + header
+    with open(path, 'wb') as f:
+        f.write(prefix)
+        f.write(b'\0' * (_align(len(prefix)) - len(prefix)))
+        for section in sections:
+            f.write(section)
+            f.write(b'\0' * (_align(len(section)) - len(section)))
+
+
+class MappedModel(object):
+    def __init__(self, path: str) -> None:
+        """
+        Maps the file at `path` and reads its header.
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a mapped model file".format(path))
+        header_size = _HEADER_SIZE.unpack_from(self._mmap, len(MAGIC))[0]
+        header_start = len(MAGIC) + _HEADER_SIZE.size
+        self.header = json.loads(
+            self._mmap[header_start:header_start + header_size].decode('utf-8')
+        )
+        self._data_start = _align(header_start + header_size)
+        self.parameters: List[str] = self.header['parameters']
+        self.input_blobs: List[str] = self.header['input_blobs']
+        self.output_blobs: List[str] = self.header['output_blobs']
+        self._checksum_future: Optional[Future] = None
+
+    def _view(self, offset: int, size: int) -> memoryview:
+        start = self._data_start + offset
+        return memoryview(self._mmap)[start:start + size]
+
+    def net_proto(self):
+        net = self.header['net']
+        net_proto = caffe2_pb2.NetDef()
+        net_proto.ParseFromString(
+            self._view(net['offset'], net['size']).tobytes()
+        )
+        return net_proto
+
+    def blob(self, name: str) -> np.ndarray:
+        for blob in self.header['blobs']:
+            if blob['name'] == name:
+                return self._value(blob)
+        raise KeyError(name)
+
+    def _value(self, blob) -> np.ndarray:
+        if 'strings' in blob:
+            return np.array(blob['strings']).reshape(blob['shape'])
+        return np.frombuffer(
+            self._view(blob['offset'], blob['size']), dtype=blob['dtype']
+        ).reshape(blob['shape'])
+
+    def feed(self, ws=workspace) -> None:
+        """
+        Feeds every stored blob to `ws` (the current workspace by default),
+        straight from the mapped pages.
+        """
+        for blob in self.header['blobs']:
+            ws.FeedBlob(blob['name'], self._value(blob))
+
+    def verify(self) -> None:
+        """
+        Raises ValueError if the file does not match its stored checksum.
+        """
+        checksum = _checksum(memoryview(self._mmap)[self._data_start:])
+        if checksum != self.header['checksum']:
+            raise ValueError(
+                "Checksum mismatch in {}: the file is corrupt".format(self.path)
+            )
+
+    def verify_in_background(self) -> Future:
+        """
+        Starts `verify` on a daemon thread.  The returned Future raises the
+        ValueError, if any, from `result()`.
+        """
+        if self._checksum_future is None:
+            future: Future = Future()
+
+            def run():
+                try:
+                    self.verify()
+                    future.set_result(True)
+                except Exception as e:
+                    logger.error(str(e))
+                    future.set_exception(e)
+
+            thread = threading.Thread(target=run, name='mapped_model_checksum')
+            thread.daemon = True
+            thread.start()
+            self._checksum_future = future
+        return self._checksum_future
+
+
+def load_mapped(
+    predictor_class, path: str, int_features: bool = False,
+    verify: bool = False
+):
+    """
+    Creates a predictor from a file written by `save_mapped`.  The checksum
+    is checked before returning if `verify` is set, otherwise in the
+    background; see `predictor.mapped_model.verify_in_background()`.
+    """
+    model = MappedModel(path)
+    if verify:
+        model.verify()
+    else:
+        model.verify_in_background()
+    model.feed()
+    net_proto = model.net_proto()
+    workspace.CreateNet(net_proto, True)
+    predictor = predictor_class(net_proto, model.parameters, int_features)
+    predictor.mapped_model = model
+    return predictor
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 
-from typing import List
+from typing import List, Optional
 
 from enum import Enum
 
@@ -11,7 +11,7 @@ from caffe2.python.optimizer import (
 )
 
 from ml.rl.thrift.core.ttypes import TrainingParameters
-from ml.rl.training.dnn import DNN
+from ml.rl.training.dnn import DNN, EnumEmbedding
 
 
 class GRAD_OPTIMIZER(Enum):
@@ -33,12 +33,16 @@ class MLTrainer(DNN):
         self,
         name: str,
         parameters: TrainingParameters,
+        enum_embedding: Optional[EnumEmbedding] = None,
+        sparse_input: bool = False,
     ) -> None:
         """
 
         :param name: A unique name for this trainer used to create the data on the
             caffe2 workspace
         :param parameters: The set of training parameters
+        :param enum_embedding: See DNN
+        :param sparse_input: See DNN
         """
         self.optimizer = parameters.optimizer
         self.learning_rate = parameters.learning_rate
@@ -46,7 +50,7 @@ class MLTrainer(DNN):
         self.gamma = parameters.gamma
         self.lr_policy = parameters.lr_policy
 
-        DNN.__init__(self, name, parameters)
+        DNN.__init__(self, name, parameters, enum_embedding, sparse_input)
 
     def generateLossOps(
         self,
@@ -81,6 +85,9 @@ class MLTrainer(DNN):
                 .format(self.optimizer, ', '.join(OPTIMIZER_DICT.keys()))
             )
         optimizer_rule = OPTIMIZER_DICT[self.optimizer]
+        # Sparse gradients (embedding tables, sparse input first layers)
+        # repeat a row once per use in the batch; sum them before updating
+        dedup = "sum"
 
         if optimizer_rule == GRAD_OPTIMIZER.SGD:
             build_sgd(
@@ -88,21 +95,46 @@ class MLTrainer(DNN):
                 self.learning_rate,
                 gamma=self.gamma,
                 policy=self.lr_policy,
-                stepsize=1
+                stepsize=1,
+                sparse_dedup_aggregator=dedup
             )
         elif optimizer_rule == GRAD_OPTIMIZER.ADAGRAD:
-            build_adagrad(model, self.learning_rate)
+            build_adagrad(
+                model, self.learning_rate, sparse_dedup_aggregator=dedup
+            )
         elif optimizer_rule == GRAD_OPTIMIZER.ADAM:
-            build_adam(model, self.learning_rate)
+            build_adam(
+                model, self.learning_rate, sparse_dedup_aggregator=dedup
+            )
         elif optimizer_rule == GRAD_OPTIMIZER.FTRL:
-            build_ftrl(model, self.learning_rate)
+            build_ftrl(
+                model, self.learning_rate, sparse_dedup_aggregator=dedup
+            )
         else:
             print(
                 "Unrecognized in caffe2 setting, using default SGD",
                 optimizer_rule
             )
-            build_sgd(model, self.learning_rate)
+            build_sgd(
+                model, self.learning_rate, sparse_dedup_aggregator=dedup
+            )
 
     def build_predictor(self, model, input_blob, output_blob) -> List[str]:
         self.make_forward_pass_ops(model, input_blob, output_blob, is_test=True)
-        return self.weights + self.biases
+        return self.weights + self.biases + self.embeddings
+
+    def build_sparse_predictor(
+        self, model, sparse_input, output_blob
+    ) -> List[str]:
+        first_layer_parameters = self.make_sparse_forward_pass_ops(
+            model, sparse_input, output_blob
+        )
+        return first_layer_parameters + self.weights[1:] + self.biases[1:]
+
+    def build_folded_predictor(
+        self, model, folded_input, output_blob
+    ) -> List[str]:
+        first_layer_parameters = self.make_folded_forward_pass_ops(
+            model, folded_input, output_blob
+        )
+        return first_layer_parameters + self.weights[1:] + self.biases[1:]
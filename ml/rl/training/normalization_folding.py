@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Checks for predictors exported with `fold_normalization`, whose first layer
+absorbs the mean and stddev of CONTINUOUS and BOXCOX features.  Folding drops
+anomaly clipping, so folded predictors are checked against a reference
+exported without clipping on values that reach well past the clipping range,
+and against the default, clipped export on values within it.
+"""
+
+from typing import Dict, List
+
+import numpy as np
+
+from ml.rl.preprocessing import identify_types
+from ml.rl.preprocessing.normalization import NormalizationParameters
+
+# Normalized values of CONTINUOUS and BOXCOX samples stay within this, beyond
+#     the [-3, 3] clipping range
+SAMPLE_STDDEVS = 5.0
+# Within the clipping range, where folded and clipped predictors agree
+CLIPPED_SAMPLE_STDDEVS = 2.9
+
+
+def _sample_value(
+    parameters: NormalizationParameters, rng, stddevs: float
+) -> float:
+    feature_type = parameters.feature_type
+    if feature_type == identify_types.BINARY:
+        return float(rng.randint(0, 2))
+    if feature_type == identify_types.PROBABILITY:
+        return float(rng.uniform(0.05, 0.95))
+    if feature_type == identify_types.ENUM:
+        return float(rng.choice(parameters.possible_values))
+    if feature_type == identify_types.QUANTILE:
+        return float(
+            rng.uniform(parameters.quantiles[0], parameters.quantiles[-1])
+        )
+    normalized = parameters.mean + parameters.stddev * rng.uniform(
+        -stddevs, stddevs
+    )
+    if feature_type == identify_types.CONTINUOUS:
+        return float(normalized)
+    # Inverse Box-Cox transform
+    if parameters.boxcox_lambda == 0:
+        value = np.exp(normalized)
+    else:
+        value = np.power(
+            max(normalized * parameters.boxcox_lambda + 1, 1e-6),
+            1.0 / parameters.boxcox_lambda
+        )
+    return float(value - parameters.boxcox_shift)
+
+
+def sample_states(
+    normalization_parameters: Dict[int, NormalizationParameters],
+    num_states: int,
+    seed: int = 0,
+    missing_probability: float = 0.2,
+    stddevs: float = SAMPLE_STDDEVS,
+) -> List[Dict[int, float]]:
+    """
+    Examples with plausible values for every feature type, each feature left
+    out with `missing_probability`.  CONTINUOUS and BOXCOX values normalize
+    to within `stddevs`.
+    """
+    rng = np.random.RandomState(seed)
+    states = []
+    for _ in range(num_states):
+        state = {}
+        for feature, parameters in normalization_parameters.items():
+            if rng.uniform() >= missing_probability:
+                state[int(feature)] = _sample_value(
+                    parameters, rng, stddevs
+                )
+        states.append(state)
+    return states
+
+
+def check_folded_predictor(
+    reference,
+    folded,
+    states: List[Dict[int, float]],
+    rtol: float = 1e-4,
+    atol: float = 1e-4,
+) -> float:
+    """
+    Raises if `folded` and `reference` predict different values for `states`.
+    Returns the largest absolute difference.
+    """
+    expected, _ = reference.predict_array(states)
+    q_values, _ = folded.predict_array(states)
+    max_difference = float(np.max(np.abs(q_values - expected))) \
+        if q_values.size > 0 else 0.0
+    if not np.allclose(q_values, expected, rtol=rtol, atol=atol):
+        raise Exception(
+            "Folded normalization changed the predictions by up to {}".format(
+                max_difference
+            )
+        )
+    return max_difference
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+
+from typing import List
+
+import numpy as np
+
+
+class P2QuantileEstimator(object):
+    """ Streaming estimate of a single quantile using the P-square algorithm
+    (Jain & Chlamtac, 1985).  Keeps five markers regardless of how many
+    observations have been seen, so updates are O(1) in memory and no window
+    of observations has to be re-sorted.
+    """
+
+    NUM_MARKERS = 5
+    # Batches larger than this are merged into the markers with vectorized
+    #     ops instead of one Python step per observation
+    SUMMARY_SIZE = 64
+
+    def __init__(self, percentile: float) -> None:
+        """
+
+        :param percentile: The quantile to track, in [0, 100] (same convention
+            as np.percentile).
+        """
+        assert 0 <= percentile <= 100, \
+            "Invalid percentile {}".format(percentile)
+        self.percentile = percentile
+        self.reset()
+
+    def reset(self) -> None:
+        p = self.percentile / 100.0
+        self.count = 0
+        self._heights: List[float] = []
+        self._positions = [0.0, 1.0, 2.0, 3.0, 4.0]
+        self._desired = [0.0, 2 * p, 4 * p, 2 + 2 * p, 4.0]
+        # Also the quantile that each marker tracks
+        self._increments = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def update(self, values) -> None:
+        """
+        Adds a batch of observations to the estimate.  Batches of more than
+        SUMMARY_SIZE observations are merged at once, see `_merge`.
+
+        :param values: Array-like of observations.  Flattened before use.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) > self.SUMMARY_SIZE:
+            self._merge(values)
+            return
+        for x in values.tolist():
+            self._add(x)
+
+    def value(self) -> float:
+        """
+        Returns the current estimate.  Falls back to an exact percentile while
+        fewer than NUM_MARKERS observations have been seen.
+        """
+        if self.count == 0:
+            return 0.0
+        if self.count < self.NUM_MARKERS:
+            return float(np.percentile(self._heights, self.percentile))
+        return self._heights[2]
+
+    def _merge(self, values: np.ndarray) -> None:
+        """
+        Places the markers at the quantiles of the observations seen so far
+        and `values`.  The observations seen so far are described by the
+        piecewise linear CDF through the markers, `values` by their exact
+        empirical CDF.  Unlike adding observations one at a time, this does
+        not depend on their order.
+        """
+        fractions = np.array(self._increments)
+        values = np.sort(values)
+        if self.count < self.NUM_MARKERS:
+            values = np.sort(np.concatenate([values, self._heights]))
+            heights = np.percentile(values, fractions * 100.0)
+            count = len(values)
+        else:
+            grid = np.union1d(values, self._heights)
+            seen_cdf = np.interp(
+                grid, self._heights,
+                np.array(self._positions) / (self.count - 1)
+            )
+            batch_cdf = np.searchsorted(values, grid, side='right') / \
+                float(len(values))
+            count = self.count + len(values)
+            merged_cdf = (
+                self.count * seen_cdf + len(values) * batch_cdf
+            ) / count
+            heights = np.interp(fractions, merged_cdf, grid)
+
+        # Marker positions must stay distinct integers
+        positions = np.round(fractions * (count - 1))
+        for i in range(1, self.NUM_MARKERS):
+            positions[i] = max(positions[i], positions[i - 1] + 1)
+        for i in reversed(range(self.NUM_MARKERS - 1)):
+            positions[i] = min(positions[i], positions[i + 1] - 1)
+        self.count = count
+        self._heights = heights.tolist()
+        self._positions = positions.tolist()
+        self._desired = (fractions * (count - 1)).tolist()
+
+    def _add(self, x: float) -> None:
+        self.count += 1
+        q = self._heights
+        if self.count <= self.NUM_MARKERS:
+            q.append(x)
+            q.sort()
+            return
+
+        n = self._positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x < q[1]:
+            k = 0
+        elif x < q[2]:
+            k = 1
+        elif x < q[3]:
+            k = 2
+        elif x <= q[4]:
+            k = 3
+        else:
+            q[4] = x
+            k = 3
+
+        for i in range(k + 1, self.NUM_MARKERS):
+            n[i] += 1
+        for i in range(self.NUM_MARKERS):
+            self._desired[i] += self._increments[i]
+
+        # Adjust the three middle markers if they drifted from their desired
+        #     positions
+        for i in range(1, self.NUM_MARKERS - 1):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or \
+                    (d <= -1 and n[i - 1] - n[i] < -1):
+                step = 1 if d > 0 else -1
+                candidate = self._parabolic(i, step)
+                if q[i - 1] < candidate < q[i + 1]:
+                    q[i] = candidate
+                else:
+                    q[i] = self._linear(i, step)
+                n[i] += step
+
+    def _parabolic(self, i: int, d: int) -> float:
+        q = self._heights
+        n = self._positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def _linear(self, i: int, d: int) -> float:
+        q = self._heights
+        n = self._positions
+        return q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Caches per-state predictor results.  Serving traffic often repeats the same
+states (default contexts, cold-start users), and a cached row skips both the
+preprocessing and the MLP for that state.
+"""
+
+import collections
+import struct
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+_LENGTH = struct.Struct('<I')
+
+
+def state_keys(float_features, int_features=None) -> List[bytes]:
+    """
+    One cache key per state: the raw bytes of its keys and values in the
+    (lengths, keys, values) layout of `sparse_features`.  Features given in a
+    different order produce a different key.
+    """
+    state_bytes = _state_bytes(float_features, np.float32)
+    if int_features is None:
+        return state_bytes
+    return [
+        f + i for f, i in zip(state_bytes, _state_bytes(int_features, np.int32))
+    ]
+
+
+def _state_bytes(features, dtype) -> List[bytes]:
+    lengths, keys, values = features
+    keys = np.ascontiguousarray(keys, dtype=np.int64).tobytes()
+    values = np.ascontiguousarray(values, dtype=dtype).tobytes()
+    value_size = np.dtype(dtype).itemsize
+    result = []
+    start = 0
+    for length in lengths:
+        end = start + int(length)
+        result.append(
+            _LENGTH.pack(end - start) + keys[start * 8:end * 8] +
+            values[start * value_size:end * value_size]
+        )
+        start = end
+    return result
+
+
+def select_states(features, indices: List[int]):
+    """
+    The (lengths, keys, values) arrays of the states at `indices`.
+    """
+    lengths, keys, values = features
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    positions = np.concatenate(
+        [np.arange(starts[i], ends[i], dtype=np.int64) for i in indices] +
+        [np.zeros(0, dtype=np.int64)]
+    )
+    return lengths[indices], keys[positions], values[positions]
+
+
+class ResultCache(object):
+    def __init__(
+        self, max_entries: int = 10000, ttl: Optional[float] = None
+    ) -> None:
+        """
+        :param max_entries: Number of states kept; the least recently used
+            one is evicted first
+        :param ttl: Seconds after which an entry is ignored, or None to keep
+            entries until they are evicted
+        """
+        assert max_entries > 0, "max_entries must be positive"
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: bytes) -> Any:
+        """
+        Returns the value stored under `key`, or None.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl is not None and \
+                time.monotonic() - entry[0] > self.ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: bytes, value) -> None:
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+        }
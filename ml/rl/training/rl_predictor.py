@@ -1,20 +1,60 @@
 #!/usr/bin/env python3
 
+import itertools
+
 import numpy as np
 import six
 
 from caffe2.proto import caffe2_pb2
 from caffe2.python.predictor.predictor_exporter import \
     save_to_db, load_from_db, prepare_prediction_net
-from caffe2.python import workspace
+from caffe2.python import core, workspace
 from caffe2.python.predictor_constants import predictor_constants
 from caffe2.python.predictor.predictor_py_utils import GetBlobs
 
 from ml.rl.caffe_utils import C2
+from ml.rl.preprocessing.preprocessor_net import FoldedNormalizedInput, \
+    SparseNormalizedInput
+from ml.rl.profiler import LatencyTracker, Profiler
+from ml.rl.training.mapped_model import load_mapped, save_mapped
+from ml.rl.training.result_cache import ResultCache, select_states, state_keys
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Blobs written by `_forward_pass`
+Q_VALUES_BLOB = "q_values"
+ACTION_NAMES_BLOB = "action_names"
+# Policy output of nets exported with `compact_output`: an int32 (number of
+#     states, 2) matrix of [max_q, softmax] indices into ACTION_NAMES_BLOB
+POLICY_ACTIONS_BLOB = "output/policy_action_indices"
+# Optional (number of states, number of actions) float input of nets exported
+#     with `action_mask`: 1 where the action is possible, 0 where it is not
+ACTION_MASK_BLOB = "input/action_mask"
+# Outputs of nets exported with `top_k`: (number of states, k) values and
+#     int32 action indices, best first
+TOP_K_VALUES_BLOB = "output/top_k_values"
+TOP_K_INDICES_BLOB = "output/top_k_indices"
+
+
+def sparse_features(examples, dtype):
+    """ Lays out a list of feature -> value dict examples as the (lengths,
+    keys, values) arrays the predictor net takes as input.
+
+    :param examples A list of feature -> value dict examples
+    :param dtype numpy type of the values
+    """
+    lengths = np.array([len(e) for e in examples], dtype=np.int32)
+    keys = np.fromiter(
+        itertools.chain.from_iterable(e.keys() for e in examples),
+        dtype=np.int64
+    )
+    values = np.fromiter(
+        itertools.chain.from_iterable(e.values() for e in examples),
+        dtype=dtype
+    )
+    return lengths, keys, values
+
 
 class RLPredictor(object):
     def __init__(self, net, parameters, int_features=False):
@@ -40,148 +80,357 @@ class RLPredictor(object):
                     'input/int_features.values',
                 ]
             )
-        self._output_blobs = [
-            'output/string_weighted_multi_categorical_features.keys',
-            'output/string_weighted_multi_categorical_features.lengths',
-            'output/string_weighted_multi_categorical_features.values.keys',
-            'output/string_weighted_multi_categorical_features.values.lengths',
-            'output/string_weighted_multi_categorical_features.values.values',
-        ]
+        net_proto = net.Proto() if hasattr(net, 'Proto') else net
+        # Nets exported with `compact_output` only output values and action
+        #     indices; action names are the ACTION_NAMES_BLOB parameter
+        self.compact_output = any(
+            POLICY_ACTIONS_BLOB in op.output for op in net_proto.op
+        )
+        self.action_mask = any(
+            ACTION_MASK_BLOB in op.input for op in net_proto.op
+        )
+        self.top_k = any(
+            TOP_K_INDICES_BLOB in op.output for op in net_proto.op
+        )
+        if self.action_mask:
+            self._input_blobs.append(ACTION_MASK_BLOB)
+        if self.compact_output:
+            self._output_blobs = [Q_VALUES_BLOB, POLICY_ACTIONS_BLOB]
+        else:
+            self._output_blobs = [
+                'output/string_weighted_multi_categorical_features.keys',
+                'output/string_weighted_multi_categorical_features.lengths',
+                'output/string_weighted_multi_categorical_features.values.keys',
+                'output/string_weighted_multi_categorical_features.values.'
+                'lengths',
+                'output/string_weighted_multi_categorical_features.values.'
+                'values',
+            ]
+        if self.top_k:
+            self._output_blobs.extend([TOP_K_VALUES_BLOB, TOP_K_INDICES_BLOB])
         self._parameters = parameters
         self.is_discrete = None
+        self._array_net = None
+        self._top_k_net = None
+        self._action_names = None
+        self._action_name_values = None
+        self._temperature = None
+        # Optional per-state cache of values, see `enable_cache`
+        self.cache = None
+        self._workspace_id = workspace.CurrentWorkspace()
+        # Opt-in timing of feeds, net runs and fetches, see `Profiler`
+        self.profiler = Profiler()
+        # Set by `load_mapped`
+        self.mapped_model = None
+        # Opt-in per-call latency breakdown, see `LatencyTracker`
+        self.latency = LatencyTracker()
+
+    def use_workspace(self, ws):
+        """
+        Sends this predictor's feeds, fetches and net runs to `ws` (see
+        `Profiler`) instead of the current workspace.  The predictor net must
+        already be created there.
+        """
+        self.profiler.ws = ws
+        self._array_net = None
+        self._top_k_net = None
+        self._temperature = None
+        if self.cache is not None:
+            self.cache.clear()
+
+    def enable_cache(self, max_entries=10000, ttl=None):
+        """ Caches the values of each state, so repeated states skip the net.
+        Discrete policies are then computed from the cached values: the max-Q
+        action is the argmax, and the softmax action is still sampled for
+        every call.
+
+        :param max_entries number of states kept, least recently used first out
+        :param ttl seconds an entry stays valid, or None
+        """
+        self.cache = ResultCache(max_entries, ttl)
+
+    def disable_cache(self):
+        self.cache = None
 
     def policy(
-        self, float_state_features, int_state_features=None
+        self, float_state_features, int_state_features=None, action_mask=None
     ) -> np.ndarray:
         """ Returns np array of action names to take for each state
         :param float_state_features A list of feature -> float value dict examples
         :param int_state_features A list of feature -> int value dict examples
+        :param action_mask (number of states, number of actions) array, 1 for
+            possible actions, for predictors exported with `action_mask`.
+            All actions are possible if None.
         """
-        workspace.FeedBlob(
-            'input/float_features.lengths',
-            np.array([len(e) for e in float_state_features], dtype=np.int32)
-        )
-        workspace.FeedBlob(
-            'input/float_features.keys',
-            np.array(
-                [list(e.keys()) for e in float_state_features], dtype=np.int32
-            ).flatten()
-        )
-        workspace.FeedBlob(
-            'input/float_features.values',
-            np.array(
-                [list(e.values()) for e in float_state_features],
-                dtype=np.float32
-            ).flatten()
-        )
-
-        if int_state_features is not None:
-            workspace.FeedBlob(
-                'input/int_features.lengths',
-                np.array([len(e) for e in int_state_features], dtype=np.int32)
-            )
-            workspace.FeedBlob(
-                'input/int_features.keys',
-                np.array(
-                    [list(e.keys()) for e in int_state_features],
-                    dtype=np.int64
-                ).flatten()
-            )
-            workspace.FeedBlob(
-                'input/int_features.values',
-                np.array(
-                    [list(e.values()) for e in int_state_features],
-                    dtype=np.int32
-                ).flatten()
+        with self.latency.call('policy', len(float_state_features)):
+            float_features = sparse_features(float_state_features, np.float32)
+            int_features = None if int_state_features is None else \
+                sparse_features(int_state_features, np.int32)
+            self.latency.mark('build_input')
+            return self.policy_sparse(
+                float_features, int_features, action_mask
             )
 
-        workspace.RunNet(self._net)
+    def policy_sparse(
+        self, float_features, int_features=None, action_mask=None
+    ) -> np.ndarray:
+        """ Same as `policy`, for states already laid out as (lengths, keys,
+        values) arrays, see `sparse_features`.
+        """
+        with self.latency.call('policy', len(float_features[0])):
+            if self.cache is not None and self.is_discrete and \
+                    action_mask is None:
+                q_values, _ = self.predict_array_sparse(
+                    float_features, int_features
+                )
+                actions = self._policy_from_values(q_values)
+                self.latency.mark('decode')
+                return actions
+
+            self._feed_features('float_features', float_features)
+            if int_features is not None:
+                self._feed_features('int_features', int_features)
+            self._feed_action_mask(action_mask, len(float_features[0]))
+            self.latency.mark('feed')
+
+            self.profiler.run_net('predictor', self._net)
+            self.latency.mark('run')
+
+            if self.compact_output:
+                action_indices = self.profiler.fetch_blob(POLICY_ACTIONS_BLOB)
+                self.latency.mark('fetch')
+                self._load_action_names()
+                actions = self._action_name_values[action_indices.flatten()]
+                self.latency.mark('decode')
+                return actions
+            if self.is_discrete:
+                # discrete action policy has string values (action names)
+                actions = self.profiler.fetch_blob(
+                    'output/string_single_categorical_features.values'
+                )
+            elif not self.is_discrete:
+                # [a1_maxq, a1_softmax, a2_maxq, a2_softmax, ...]
+                # parametric action policy has int values (action indexes)
+                actions = self.profiler.fetch_blob(
+                    'output/int_single_categorical_features.values'
+                )
+            else:
+                raise Exception(
+                    'is_discrete property {} not valid'.format(
+                        self.is_discrete
+                    )
+                )
+            self.latency.mark('fetch')
+            return actions
+
+    def policy_indices(
+        self, float_state_features, int_state_features=None, action_mask=None
+    ):
+        """ Returns a (number of states, 2) int32 array of [max_q, softmax]
+        action indices, and the action name of each index.  Only for
+        predictors exported with `compact_output`.
 
-        if self.is_discrete:
-            # discrete action policy has string values (action names)
-            return workspace.FetchBlob(
-                'output/string_single_categorical_features.values'
-            )
-        elif not self.is_discrete:
-            # [a1_maxq, a1_softmax, a2_maxq, a2_softmax, ...]
-            # parametric action policy has int values (action indexes)
-            return workspace.FetchBlob(
-                'output/int_single_categorical_features.values'
+        :param float_state_features A list of feature -> float value dict examples
+        :param int_state_features A list of feature -> int value dict examples
+        :param action_mask see `policy`
+        """
+        assert self.compact_output, \
+            "Action indices are only output by compact_output exports"
+        with self.latency.call('policy_indices', len(float_state_features)):
+            self._feed_features(
+                'float_features',
+                sparse_features(float_state_features, np.float32)
             )
-        else:
-            raise Exception(
-                'is_discrete property {} not valid'.format(self.is_discrete)
+            if int_state_features is not None:
+                self._feed_features(
+                    'int_features',
+                    sparse_features(int_state_features, np.int32)
+                )
+            self._feed_action_mask(action_mask, len(float_state_features))
+            self.latency.mark('feed')
+            self.profiler.run_net('predictor', self._net)
+            self.latency.mark('run')
+            action_indices = self.profiler.fetch_blob(POLICY_ACTIONS_BLOB)
+            self.latency.mark('fetch')
+            self._load_action_names()
+            return action_indices, self._action_names
+
+    def top_k_actions(
+        self, float_state_features, int_state_features=None, action_mask=None
+    ):
+        """ Returns (number of states, k) arrays of the int32 indices of the
+        k best possible actions of each state, best first, and of their
+        values, along with the action name of each index.  Runs only the ops
+        that these depend on.  Only for predictors exported with `top_k`.
+
+        If a state has fewer than k possible actions, its last indices point
+        to impossible actions, with values near -1e9.
+
+        :param float_state_features A list of feature -> float value dict examples
+        :param int_state_features A list of feature -> int value dict examples
+        :param action_mask see `policy`
+        """
+        assert self.top_k, "Top-k actions are only output by top_k exports"
+        with self.latency.call('top_k_actions', len(float_state_features)):
+            self._feed_features(
+                'float_features',
+                sparse_features(float_state_features, np.float32)
             )
+            if int_state_features is not None:
+                self._feed_features(
+                    'int_features',
+                    sparse_features(int_state_features, np.int32)
+                )
+            self._feed_action_mask(action_mask, len(float_state_features))
+            self.latency.mark('feed')
+            if self._top_k_net is None:
+                self._top_k_net = self._build_pruned_net(
+                    'top_k', [TOP_K_VALUES_BLOB, TOP_K_INDICES_BLOB]
+                )
+            self.profiler.run_net('predictor_top_k', self._top_k_net)
+            self.latency.mark('run')
+            action_indices = self.profiler.fetch_blob(TOP_K_INDICES_BLOB)
+            values = self.profiler.fetch_blob(TOP_K_VALUES_BLOB)
+            self.latency.mark('fetch')
+            self._load_action_names()
+            return action_indices, values, self._action_names
 
     def predict(self, float_state_features, int_state_features=None):
         """ Returns values for each state
         :param float_state_features A list of feature -> float value dict examples
         :param int_state_features A list of feature -> int value dict examples
         """
-        workspace.FeedBlob(
-            'input/float_features.lengths',
-            np.array([len(e) for e in float_state_features], dtype=np.int32)
-        )
-        workspace.FeedBlob(
-            'input/float_features.keys',
-            np.array(
-                [list(e.keys()) for e in float_state_features], dtype=np.int64
-            ).flatten()
-        )
-        workspace.FeedBlob(
-            'input/float_features.values',
-            np.array(
-                [list(e.values()) for e in float_state_features],
-                dtype=np.float32
-            ).flatten()
-        )
-
-        if int_state_features is not None:
-            workspace.FeedBlob(
-                'input/int_features.lengths',
-                np.array([len(e) for e in int_state_features], dtype=np.int32)
-            )
-            workspace.FeedBlob(
-                'input/int_features.keys',
-                np.array(
-                    [list(e.keys()) for e in int_state_features],
-                    dtype=np.int64
-                ).flatten()
-            )
-            workspace.FeedBlob(
-                'input/int_features.values',
-                np.array(
-                    [list(e.values()) for e in int_state_features],
-                    dtype=np.int32
-                ).flatten()
+        with self.latency.call('predict', len(float_state_features)):
+            q_values, action_names = self.predict_array(
+                float_state_features, int_state_features
             )
+            result = [dict(zip(action_names, row)) for row in q_values]
+            self.latency.mark('decode')
+            return result
 
-        workspace.RunNet(self._net)
+    def predict_array(self, float_state_features, int_state_features=None):
+        """ Returns a (number of states, number of actions) float32 array of
+        values, and the action name of each column.  Runs only the ops that
+        compute the values, without the string outputs of `predict`'s net.
 
-        output_lengths = workspace.FetchBlob(
-            'output/string_weighted_multi_categorical_features.values.lengths'
-        )
-        output_names = workspace.FetchBlob(
-            'output/string_weighted_multi_categorical_features.values.keys'
+        :param float_state_features A list of feature -> float value dict examples
+        :param int_state_features A list of feature -> int value dict examples
+        """
+        with self.latency.call('predict_array', len(float_state_features)):
+            float_features = sparse_features(float_state_features, np.float32)
+            int_features = None if int_state_features is None else \
+                sparse_features(int_state_features, np.int32)
+            self.latency.mark('build_input')
+            return self.predict_array_sparse(float_features, int_features)
+
+    def predict_array_sparse(self, float_features, int_features=None):
+        """ Same as `predict_array`, for states already laid out as (lengths,
+        keys, values) arrays, see `sparse_features`.
+        """
+        with self.latency.call('predict_array', len(float_features[0])):
+            if self.cache is None or len(float_features[0]) == 0:
+                return self._run_array_net(float_features, int_features)
+
+            keys = state_keys(float_features, int_features)
+            rows = [self.cache.get(key) for key in keys]
+            missing = [i for i, row in enumerate(rows) if row is None]
+            self.latency.mark('cache')
+            if len(missing) > 0:
+                q_values, _ = self._run_array_net(
+                    select_states(float_features, missing),
+                    None if int_features is None else
+                    select_states(int_features, missing),
+                )
+                for i, row in zip(missing, q_values):
+                    rows[i] = np.array(row)
+                    self.cache.put(keys[i], rows[i])
+            q_values = np.stack(rows)
+            self.latency.mark('cache')
+            return q_values, self._action_names
+
+    def _run_array_net(self, float_features, int_features):
+        self._feed_features('float_features', float_features)
+        if int_features is not None:
+            self._feed_features('int_features', int_features)
+        self.latency.mark('feed')
+
+        if self._array_net is None:
+            self._array_net = self._build_pruned_net('array', [Q_VALUES_BLOB])
+            self._load_action_names()
+        self.profiler.run_net('predictor_array', self._array_net)
+        self.latency.mark('run')
+        q_values = self.profiler.fetch_blob(Q_VALUES_BLOB)
+        self.latency.mark('fetch')
+        return q_values, self._action_names
+
+    def _load_action_names(self):
+        if self._action_names is None:
+            self._action_name_values = self.profiler.ws.FetchBlob(
+                ACTION_NAMES_BLOB
+            )
+            self._action_names = [
+                name.decode("utf-8") if isinstance(name, bytes) else str(name)
+                for name in self._action_name_values
+            ]
+
+    def _policy_from_values(self, q_values):
+        """ Same output as the discrete policy net: [a1_maxq, a1_softmax,
+        a2_maxq, a2_softmax, ...], with softmax actions sampled here.
+        """
+        if self._temperature is None:
+            self._temperature = float(
+                self.profiler.ws.FetchBlob('temperature')[0]
+            )
+        max_q_actions = np.argmax(q_values, axis=1)
+        tempered = (q_values - q_values.max(axis=1, keepdims=True)) / \
+            self._temperature
+        probabilities = np.exp(tempered)
+        cumulative = np.cumsum(probabilities, axis=1)
+        samples = np.random.uniform(size=(len(q_values), 1)) * \
+            cumulative[:, -1:]
+        softmax_actions = np.minimum(
+            (cumulative < samples).sum(axis=1), q_values.shape[1] - 1
         )
-        output_values = workspace.FetchBlob(
-            'output/string_weighted_multi_categorical_features.values.values'
+        actions = np.stack([max_q_actions, softmax_actions], axis=1).flatten()
+        return self._action_name_values[actions]
+
+    def _feed_features(self, name, features):
+        lengths, keys, values = features
+        self.profiler.feed_blob('input/{}.lengths'.format(name), lengths)
+        self.profiler.feed_blob('input/{}.keys'.format(name), keys)
+        self.profiler.feed_blob('input/{}.values'.format(name), values)
+
+    def _feed_action_mask(self, action_mask, num_states):
+        if not self.action_mask:
+            assert action_mask is None, \
+                "This predictor was exported without action_mask"
+            return
+        if action_mask is None:
+            self._load_action_names()
+            action_mask = np.ones(
+                [num_states, len(self._action_names)], dtype=np.float32
+            )
+        self.profiler.feed_blob(
+            ACTION_MASK_BLOB, np.asarray(action_mask, dtype=np.float32)
         )
 
-        results = []
-
-        cursor = 0
-        for length in output_lengths:
-            cursor_begin = cursor
-            cursor_end = cursor_begin + length
-            cursor = cursor_end
-
-            result = {}
-            for x in range(cursor_begin, cursor_end):
-                result[output_names[x].decode("utf-8")] = output_values[x]
-            results.append(result)
-
-        return results
+    def _build_pruned_net(self, suffix, output_blobs):
+        """
+        Creates a net with only the ops of the predictor net that
+        `output_blobs` depend on.
+        """
+        net_proto = self._net.Proto() if hasattr(self._net, 'Proto') \
+            else self._net
+        needed = set(output_blobs)
+        ops = []
+        for op in reversed(net_proto.op):
+            if any(output in needed for output in op.output):
+                ops.append(op)
+                needed.update(op.input)
+        pruned_net = core.Net(net_proto.name + '_' + suffix)
+        pruned_net.Proto().op.extend(reversed(ops))
+        self.profiler.ws.CreateNet(pruned_net)
+        return pruned_net
 
     def get_predictor_export_meta(self):
         """
@@ -219,6 +468,29 @@ class RLPredictor(object):
         parameters = GetBlobs(meta, predictor_constants.PARAMETERS_BLOB_TYPE)
         return cls(net, parameters, int_features)
 
+    def save_mapped(self, path):
+        """ Saves network and parameters to a single file that `load_mapped`
+        memory-maps, see `mapped_model`.
+
+        :param path file to write
+        """
+        save_mapped(
+            path, self._net, self._parameters, self._input_blobs,
+            self._output_blobs
+        )
+
+    @classmethod
+    def load_mapped(cls, path, int_features=False, verify=False):
+        """ Creates Predictor from a file written by `save_mapped`, feeding
+        parameters straight from the mapped file
+
+        :param path file written by save_mapped
+        :param int_features bool indicating if int_features are present
+        :param verify bool indicating if the checksum is checked before
+            returning instead of on a background thread
+        """
+        return load_mapped(cls, path, int_features, verify)
+
     def analyze(self, named_features):
         print("==================== Model parameters =========================")
         previous_workspace = workspace.CurrentWorkspace()
@@ -252,21 +524,46 @@ class RLPredictor(object):
         workspace.SwitchWorkspace(previous_workspace)
 
     @classmethod
-    def _forward_pass(cls, model, trainer, normalized_dense_matrix, actions):
+    def _forward_pass(
+        cls,
+        model,
+        trainer,
+        normalized_dense_matrix,
+        actions,
+        compact_output=False,
+    ):
+        """
+        :param normalized_dense_matrix: The normalized input, either a dense
+            matrix blob, a SparseNormalizedInput or a FoldedNormalizedInput
+        :param compact_output: Skip the string_weighted_multi_categorical
+            outputs, which tile the action names for every state; callers
+            read Q_VALUES_BLOB and ACTION_NAMES_BLOB instead
+        """
         C2.set_model(model)
 
         parameters = []
-        q_values = "q_values"
+        q_values = Q_VALUES_BLOB
         workspace.FeedBlob(q_values, np.zeros(1, dtype=np.float32))
-        trainer.build_predictor(model, normalized_dense_matrix, q_values)
+        if isinstance(normalized_dense_matrix, SparseNormalizedInput):
+            trainer.build_sparse_predictor(
+                model, normalized_dense_matrix, q_values
+            )
+        elif isinstance(normalized_dense_matrix, FoldedNormalizedInput):
+            trainer.build_folded_predictor(
+                model, normalized_dense_matrix, q_values
+            )
+        else:
+            trainer.build_predictor(model, normalized_dense_matrix, q_values)
         parameters.extend(model.GetAllParams())
 
-        action_names = C2.NextBlob("action_names")
+        action_names = ACTION_NAMES_BLOB
         parameters.append(action_names)
         workspace.FeedBlob(action_names, np.array(actions))
         action_range = C2.NextBlob("action_range")
         parameters.append(action_range)
         workspace.FeedBlob(action_range, np.array(list(range(len(actions)))))
+        if compact_output:
+            return parameters, q_values
 
         output_shape = C2.Shape(q_values)
         output_shape_row_count = C2.Slice(output_shape, starts=[0], ends=[1])
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from typing import Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
 import logging
 
@@ -11,7 +11,8 @@ import numpy as np
 from caffe2.python import workspace
 from caffe2.python.model_helper import ModelHelper
 
-from ml.rl.caffe_utils import C2, StackedArray
+from ml.rl.caffe_utils import C2, StackedArray, StackedAssociativeArray
+from ml.rl.profiler import Profiler
 from ml.rl.thrift.core.ttypes import (
     DiscreteActionModelParameters,
     ContinuousActionModelParameters,
@@ -19,6 +20,7 @@ from ml.rl.thrift.core.ttypes import (
 )
 from ml.rl.training.conv.conv_ml_trainer import ConvMLTrainer
 from ml.rl.training.conv.conv_target_network import ConvTargetNetwork
+from ml.rl.training.dnn import EnumEmbedding
 from ml.rl.training.ml_trainer import MLTrainer
 from ml.rl.training.target_network import TargetNetwork
 from ml.rl.training.training_data_page import TrainingDataPage
@@ -48,7 +50,17 @@ class RLTrainer(object):
         parameters: Union[
             DiscreteActionModelParameters, ContinuousActionModelParameters
         ],
+        enum_embedding: Optional[EnumEmbedding] = None,
+        sparse_input: bool = False,
     ) -> None:
+        """
+        :param parameters: The model parameters
+        :param enum_embedding: See DNN
+        :param sparse_input: If set, states and next_states are fed as
+            StackedAssociativeArrays of normalized (column, value) pairs and
+            the first layer is trained from them, see
+            `DNN.make_sparse_input_forward_pass_ops`.
+        """
         logger.info(str(parameters))
         RLTrainer.num_trainers += 1
         self.model_id = RL_TRAINER_PREFIX + str(RLTrainer.num_trainers)
@@ -75,9 +87,15 @@ class RLTrainer(object):
         assert (
             parameters.training.layers[0] >= 0
         ), "Set layers[0] to a the number of features"
+        assert not sparse_input or self.conv_ml_trainer is None, \
+            "Sparse input is not supported with convolutional layers"
+        self.sparse_input = sparse_input
 
         self.ml_trainer = MLTrainer(
-            ML_TRAINER_PREFIX + str(RLTrainer.num_trainers), parameters.training
+            ML_TRAINER_PREFIX + str(RLTrainer.num_trainers),
+            parameters.training,
+            enum_embedding,
+            sparse_input,
         )
 
         self.target_network = TargetNetwork(
@@ -95,6 +113,8 @@ class RLTrainer(object):
         self.minibatch_size = parameters.training.minibatch_size
         self.parameters = parameters
         self.loss_blob: Optional[str] = None
+        # Opt-in timing of net runs and blob transfers, see `Profiler`
+        self.profiler = Profiler()
 
         workspace.FeedBlob("states", np.array([0], dtype=np.float32))
         workspace.FeedBlob("actions", np.array([0], dtype=np.float32))
@@ -106,6 +126,18 @@ class RLTrainer(object):
         workspace.FeedBlob(
             "possible_next_actions_lengths", np.array([0], dtype=np.float32)
         )
+        if self.sparse_input:
+            for name in ["states", "next_states"]:
+                state_blobs = self._state_blobs(name)
+                workspace.FeedBlob(
+                    state_blobs.lengths, np.array([0], dtype=np.int32)
+                )
+                workspace.FeedBlob(
+                    state_blobs.keys, np.zeros(0, dtype=np.int32)
+                )
+                workspace.FeedBlob(
+                    state_blobs.values, np.zeros(0, dtype=np.float32)
+                )
         # Setting to 1 serves as a 1 unit time_diff if not set by user
         workspace.FeedBlob("time_diff", np.array([1], dtype=np.float32))
 
@@ -119,6 +151,28 @@ class RLTrainer(object):
         assert self.reward_train_model is not None
         assert self.q_score_model is not None
 
+    def _state_blobs(self, name: str):
+        """
+        The blob holding the `name` states, or with sparse_input the
+        StackedAssociativeArray of blobs holding their (column, value) pairs.
+        """
+        if not self.sparse_input:
+            return name
+        return StackedAssociativeArray(
+            name + "_lengths", name + "_keys", name + "_values"
+        )
+
+    def _feed_states(self, name: str, states) -> None:
+        if not self.sparse_input:
+            self.profiler.feed_blob(name, states)
+            return
+        assert isinstance(states, StackedAssociativeArray), \
+            "Trainers with sparse_input take StackedAssociativeArray states"
+        state_blobs = self._state_blobs(name)
+        self.profiler.feed_blob(state_blobs.lengths, states.lengths)
+        self.profiler.feed_blob(state_blobs.keys, states.keys)
+        self.profiler.feed_blob(state_blobs.values, states.values)
+
     def get_possible_next_actions(self):
         raise NotImplementedError()
 
@@ -174,30 +228,33 @@ class RLTrainer(object):
     def _create_q_score_net(self) -> None:
         self.q_score_model = ModelHelper(name="q_score_" + self.model_id)
         C2.set_model(self.q_score_model)
-        self.q_score_output = self.get_q_values("states", "actions", True)
+        self.q_score_output = self.get_q_values(
+            self._state_blobs("states"), "actions", True
+        )
         workspace.RunNetOnce(self.q_score_model.param_init_net)
         workspace.CreateNet(self.q_score_model.net)
         C2.set_model(None)
 
     def train_numpy(self, tdp: TrainingDataPage, evaluator: Optional[Evaluator]):
-        workspace.FeedBlob("states", tdp.states)
-        workspace.FeedBlob("actions", tdp.actions)
-        workspace.FeedBlob("rewards", tdp.rewards)
-        workspace.FeedBlob("next_states", tdp.next_states)
-        workspace.FeedBlob("not_terminals", tdp.not_terminals)
-        workspace.FeedBlob("time_diff", np.array([1], dtype=np.float32))
+        profiler = self.profiler
+        self._feed_states("states", tdp.states)
+        profiler.feed_blob("actions", tdp.actions)
+        profiler.feed_blob("rewards", tdp.rewards)
+        self._feed_states("next_states", tdp.next_states)
+        profiler.feed_blob("not_terminals", tdp.not_terminals)
+        profiler.feed_blob("time_diff", np.array([1], dtype=np.float32))
         if self.maxq_learning:
             if isinstance(tdp.possible_next_actions, StackedArray):
-                workspace.FeedBlob(
+                profiler.feed_blob(
                     "possible_next_actions", tdp.possible_next_actions.values
                 )
-                workspace.FeedBlob(
+                profiler.feed_blob(
                     "possible_next_actions_lengths", tdp.possible_next_actions.lengths
                 )
             else:
-                workspace.FeedBlob("possible_next_actions", tdp.possible_next_actions)
+                profiler.feed_blob("possible_next_actions", tdp.possible_next_actions)
         else:
-            workspace.FeedBlob("next_actions", tdp.next_actions)
+            profiler.feed_blob("next_actions", tdp.next_actions)
         ground_truth = np.array(
             [
                 test_values_from_timeline(self.rl_discount_rate, rt)
@@ -219,23 +276,58 @@ class RLTrainer(object):
                 self.target_network.enable_slow_updates()
                 if self.conv_target_network:
                     self.conv_target_network.enable_slow_updates()
-            workspace.RunNet(self.rl_train_model.net)
+            self.profiler.run_net("rl_train", self.rl_train_model.net)
         else:
-            workspace.RunNet(self.reward_train_model.net)
+            self.profiler.run_net("reward_train", self.reward_train_model.net)
 
-        workspace.RunNet(self.target_network._update_model.net)
+        self.profiler.run_net(
+            "target_update", self.target_network._update_model.net
+        )
         if self.conv_target_network:
-            workspace.RunNet(self.conv_target_network._update_model.net)
+            self.profiler.run_net(
+                "conv_target_update", self.conv_target_network._update_model.net
+            )
         self.training_iteration += 1
-        workspace.RunNet(self.q_score_model.net)
+        self.profiler.run_net("q_score", self.q_score_model.net)
         if evaluator is not None:
             assert self.loss_blob is not None
             evaluator.report(
                 episode_values,
-                workspace.FetchBlob(self.q_score_output),
-                workspace.FetchBlob(self.loss_blob),
+                self.profiler.fetch_blob(self.q_score_output),
+                self.profiler.fetch_blob(self.loss_blob),
             )
 
+    def named_nets(self) -> Dict[str, Any]:
+        """
+        Returns the nets this trainer runs, keyed by the names used in
+        `self.profiler`.
+        """
+        assert self.rl_train_model is not None
+        assert self.reward_train_model is not None
+        assert self.q_score_model is not None
+        nets = {
+            "rl_train": self.rl_train_model.net,
+            "reward_train": self.reward_train_model.net,
+            "target_update": self.target_network._update_model.net,
+            "q_score": self.q_score_model.net,
+        }
+        if self.conv_target_network:
+            nets["conv_target_update"] = \
+                self.conv_target_network._update_model.net
+        return nets
+
+    def benchmark_nets(
+        self, warmup_runs: int = 1, main_runs: int = 10
+    ) -> Dict[str, Dict[str, float]]:
+        """
+        Per-operator timings of every net in `named_nets`, using the blobs
+        currently in the workspace as inputs.  Running the training nets
+        updates the model, so only call this from profiling runs.
+        """
+        for name, net in self.named_nets().items():
+            self.profiler.benchmark_net(name, net, warmup_runs, main_runs)
+        return self.profiler.operator_times
+
     def build_predictor(self, model, input_blob, output_blob) -> List[str]:
         retval: List[str] = []
         if self.conv_ml_trainer is not None:
@@ -248,3 +340,28 @@ class RLTrainer(object):
             input_blob = conv_output_flat
         retval += self.ml_trainer.build_predictor(model, input_blob, output_blob)
         return retval
+
+    def build_sparse_predictor(
+        self, model, sparse_input, output_blob
+    ) -> List[str]:
+        """
+        Like `build_predictor`, for the output of
+        `PreprocessorNet.normalize_sparse_features`.
+        """
+        assert self.conv_ml_trainer is None, \
+            "Sparse input is not supported with convolutional layers"
+        return self.ml_trainer.build_sparse_predictor(
+            model, sparse_input, output_blob
+        )
+
+    def build_folded_predictor(
+        self, model, folded_input, output_blob
+    ) -> List[str]:
+        """
+        Like `build_predictor`, for a FoldedNormalizedInput.
+        """
+        assert self.conv_ml_trainer is None, \
+            "Folded input is not supported with convolutional layers"
+        return self.ml_trainer.build_folded_predictor(
+            model, folded_input, output_blob
+        )
@@ -34,7 +34,13 @@ class TargetNetwork(DNN):
         self._target_update_rate = target_update_rate
         self.enabled_slow_updates = False
 
-        DNN.__init__(self, name, parameters)
+        DNN.__init__(
+            self,
+            name,
+            parameters,
+            source_trainer.enum_embedding,
+            source_trainer.sparse_input,
+        )
 
         self._setup_update_net(source_trainer)
 
@@ -62,6 +68,7 @@ class TargetNetwork(DNN):
         )
         self._add_update_ops(source_trainer.weights, self.weights)
         self._add_update_ops(source_trainer.biases, self.biases)
+        self._add_update_ops(source_trainer.embeddings, self.embeddings)
 
     def _add_update_ops(self, source_params, target_params):
         for source_param, target_param in zip(source_params, target_params):
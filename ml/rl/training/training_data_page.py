@@ -1,6 +1,26 @@
 #!/usr/bin/env python3
 
 
+import numpy as np
+
+from ml.rl.caffe_utils import StackedAssociativeArray
+
+
+def _slice_states(states, start, end):
+    """
+    Rows `start` to `end` of a states matrix, or of a StackedAssociativeArray
+    of (column, value) pairs for trainers with sparse_input.
+    """
+    if not isinstance(states, StackedAssociativeArray):
+        return states[start:end]
+    offsets = np.concatenate([[0], np.cumsum(states.lengths)])
+    first, last = offsets[start], offsets[min(end, len(states.lengths))]
+    return StackedAssociativeArray(
+        states.lengths[start:end],
+        states.keys[first:last],
+        states.values[first:last],
+    )
+
 
 class TrainingDataPage(object):
     __slots__ = [
@@ -30,7 +50,9 @@ class TrainingDataPage(object):
         Creates a TrainingDataPage object.
 
         In the case where `not_terminals` can be determined by next_actions or
-        possible_next_actions, feel free to omit it.
+        possible_next_actions, feel free to omit it.  `states` and
+        `next_states` are StackedAssociativeArrays of normalized (column,
+        value) pairs for trainers created with sparse_input.
         """
         self.states = states
         self.actions = actions
@@ -42,6 +64,8 @@ class TrainingDataPage(object):
         self.not_terminals = not_terminals
 
     def size(self) -> int:
+        if isinstance(self.states, StackedAssociativeArray):
+            return len(self.states.lengths)
         return len(self.states)
 
     def get_sub_page(self, start, end):
@@ -55,10 +79,10 @@ class TrainingDataPage(object):
             sub_pna = self.possible_next_actions[start:end],
 
         return TrainingDataPage(
-            self.states[start:end],
+            _slice_states(self.states, start, end),
             self.actions[start:end],
             self.rewards[start:end],
-            self.next_states[start:end],
+            _slice_states(self.next_states, start, end),
             self.next_actions[start:end],
             sub_pna,
             self.reward_timelines[start:end],